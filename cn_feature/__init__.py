@@ -1,6 +1,13 @@
+from __future__ import print_function
+import time
+
+import numpy as np
+
 from .cn_extractor import CNFeat
 
 _cn_extractor = CNFeat()
+# (32768, 10), the color names of each bgr color quantized to 5 bits per channel, see get_table
+_cn_table = None
 
 
 def extract(image):
@@ -11,4 +18,85 @@ def extract(image):
     """
     return _cn_extractor.extract(image)
 
-__all__ = ["extract"]
\ No newline at end of file
+
+def _get_color_index(images):
+    _images = images.astype(np.int32) >> 3
+    return (_images[..., 0] << 10) | (_images[..., 1] << 5) | _images[..., 2]
+
+
+def get_table():
+    """
+    The color names are a per-pixel lookup of the quantized color, so the table is read from the native extractor
+    once, on an image holding every quantized color. No copy of the table is shipped, it needs the native build
+    like extract does.
+    """
+    global _cn_table
+    if _cn_table is None:
+        _index = np.arange(32 ** 3, dtype=np.int32)
+        _colors = np.stack([_index >> 10, (_index >> 5) & 31, _index & 31], axis=1) << 3
+        _image = _colors.astype(np.uint8).reshape(128, 256, 3)
+        # pixel i of the image has the color index i
+        _table = np.asarray(extract(_image), dtype=np.float32).reshape(32 ** 3, -1)
+        # the lookup drops the 3 low bits of each channel, the native extractor must not depend on them
+        _check_image = np.random.RandomState(0).randint(0, 256, (16, 16, 3)).astype(np.uint8)
+        assert np.allclose(extract(_check_image), _table[_get_color_index(_check_image)], atol=1e-5), \
+            'the color names of the native extractor are not a lookup of the 5 bit color'
+        _cn_table = _table
+    return _cn_table
+
+
+def extract_batch(images, cell_size=1):
+    """
+    Color names of a batch with a single gather in the table.
+
+    :param images: ndarray, (n, h, w, 3) bgr uint8, or a list of images of the same size
+    :param cell_size: the features are averaged over cell_size x cell_size cells, the pixels beyond the last full
+                      cell are dropped
+    :return: ndarray, (n, h // cell_size, w // cell_size, 10) float32
+    """
+    images = np.asarray(images)
+    if cell_size > 1:
+        _h = images.shape[1] // cell_size * cell_size
+        _w = images.shape[2] // cell_size * cell_size
+        images = images[:, :_h, :_w, :]
+    features = get_table()[_get_color_index(images)]
+    if cell_size > 1:
+        n, h, w, c = features.shape
+        features = features.reshape(n, h // cell_size, cell_size, w // cell_size, cell_size, c).mean(axis=(2, 4))
+    return features
+
+
+def _test_table_equivalence(batch_size=3, size=(80, 144), tolerance=1e-5):
+    # extract_batch against the native extract on random colors, the low bits dropped by the table included
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, (batch_size,) + size + (3,)).astype(np.uint8)
+    native = np.stack([extract(image) for image in images], axis=0)
+    diff = np.max(np.abs(native - extract_batch(images)))
+    assert diff <= tolerance, 'the table differs from the native extractor by {:.1e}'.format(diff)
+    print('table and native extractor agree, max diff {:.1e}'.format(diff))
+
+
+def _benchmark(batch_size=3, size=(80, 144), repeat=20):
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, (batch_size,) + size + (3,)).astype(np.uint8)
+    get_table()
+
+    native = np.stack([extract(image) for image in images], axis=0)
+    start = time.time()
+    for _ in range(repeat):
+        np.stack([extract(image) for image in images], axis=0)
+    native_time = (time.time() - start) / repeat
+
+    table = extract_batch(images)
+    start = time.time()
+    for _ in range(repeat):
+        extract_batch(images)
+    table_time = (time.time() - start) / repeat
+
+    _pixel_num = images.size / 3 / 1e6
+    print('native: {:8.2f}ms, {:7.2f}Mpix/s | table: {:8.2f}ms, {:7.2f}Mpix/s | max diff {:.1e}'.format(
+        native_time * 1000, _pixel_num / native_time, table_time * 1000, _pixel_num / table_time,
+        np.max(np.abs(native - table))))
+
+
+__all__ = ["extract", "extract_batch", "get_table"]
@@ -1,22 +1,40 @@
 from __future__ import print_function
 import os
+import math
 
 import numpy as np
 
 import tensorflow as tf
 
 from conv_reg_config import ConvRegressionCfg
+import conv_reg_solver
+import conv_reg_filter
+import conv_reg_numpy
+import tf_session
 import display
 
 
+def _weighted_l2_loss(output_response, label_response, weight_a, weight_b, threshold):
+    _weight_map = weight_a * tf.exp(weight_b * label_response)
+    _diff_map = output_response - label_response
+    _sign_map = (tf.sign(tf.abs(_diff_map) - threshold) + 1) / 2
+    _sum_map = tf.multiply(tf.multiply(_weight_map, _sign_map), _diff_map)
+    _l2_loss = tf.reduce_sum(_sum_map * _sum_map, reduction_indices=[1, 2, 3])
+    return tf.reduce_mean(_l2_loss, reduction_indices=0), tf.multiply(_weight_map, _sign_map)
+
+
 class ConvRegression(object):
 
-    def __init__(self, init_features, conv_size):
-        self._regularization_coef = ConvRegressionCfg.REGULARIZATION_COEF
+    def __init__(self, init_features, conv_size, regularization_coef=None):
+        if regularization_coef is None:
+            regularization_coef = ConvRegressionCfg.REGULARIZATION_COEF
+        self._regularization_coef = regularization_coef
         self._learning_rate = ConvRegressionCfg.SGD_LEARNING_RATE
         self._update_learning_rate = ConvRegressionCfg.SGD_UPDATE_LEARNING_RATE
         self._momentum = ConvRegressionCfg.SGD_MOMENTUM
         self._verbose = ConvRegressionCfg.VERBOSE
+        self._solver_name = ConvRegressionCfg.SOLVER
+        self._solver = None
         self._global_step = None
         self._input_holder = None
         self._response_holder = None
@@ -24,6 +42,19 @@ class ConvRegression(object):
         self._output_response = None
         self._weight = None
         self._bias = None
+        self._filter_structure = ConvRegressionCfg.FILTER_STRUCTURE
+        self._filter_rank = ConvRegressionCfg.FILTER_RANK
+        # the variables the filter is made of, [self._weight] for the 'full' structure
+        self._factors = None
+        self._factor_holders = None
+        self._bias_holder = None
+        self._assign_op = None
+        self._conv_size = tuple(conv_size)
+        self._weights_version = 0
+        self._numpy_inference = None
+        if ConvRegressionCfg.INFERENCE_BACKEND == 'numpy':
+            self._numpy_inference = conv_reg_numpy.NumpyInference(self)
+        self._fused_inference = None
         self.graph = None
         self.session = None
 
@@ -43,6 +74,8 @@ class ConvRegression(object):
 
         self._show_response_fid = ConvRegressionCfg.SHOW_RESPONSE_FID
         self._show_step = ConvRegressionCfg.SHOW_STEP
+        self._multigrid_factor = ConvRegressionCfg.MULTIGRID_FACTOR
+        self._multigrid_coarse_step_ratio = ConvRegressionCfg.MULTIGRID_COARSE_STEP_RATIO
 
         input_size = init_features.shape
         input_mean = np.mean(np.abs(init_features))
@@ -51,30 +84,32 @@ class ConvRegression(object):
     def _build_graph(self, input_size, conv_size, input_mean):
         assert len(input_size) == 4 and len(conv_size) == 2
         self.graph = tf.Graph()
-        with self.graph.as_default():
-            _input_shape = (None, input_size[1], input_size[2], input_size[3])
+        with self.graph.as_default(), tf_session.jit_scope():
+            # the spatial size is left open so that sub-windows of the search region can be evaluated
+            _input_shape = (None, None, None, input_size[3])
             self._input_holder = tf.placeholder(tf.float32, _input_shape, name='input_feature')
-            _output_shape = (None, input_size[1]-conv_size[0]+1, input_size[2]-conv_size[1]+1, 1)
+            _output_shape = (None, None, None, 1)
             self._response_holder = tf.placeholder(tf.float32, _output_shape, name='label_response')
             self._global_step = tf.Variable(0, trainable=False, name='global_step')
 
-            _weight_shape = [conv_size[0], conv_size[1], input_size[3], 1]
             _weight_size = conv_size[0]*conv_size[1]*input_size[3]
             _weight_std = min(1/input_mean/_weight_size/4, 1)
             # _weight_init = tf.zeros(shape=_weight_shape, dtype=tf.float32)
-            _weight_init = tf.random_normal(_weight_shape, stddev=_weight_std)
-            self._weight = tf.Variable(_weight_init, name='conv_weight')
+            self._factors, self._weight, _conv_out = conv_reg_filter.build_structured_filter(
+                self._input_holder, self._filter_structure, conv_size, input_size[3], self._filter_rank, _weight_std)
             self._bias = tf.Variable(0.0, name='conv_bias')
+            self._factor_holders = [tf.placeholder(tf.float32, f.shape) for f in self._factors]
+            self._bias_holder = tf.placeholder(tf.float32, ())
+            self._assign_op = tf.group(tf.assign(self._bias, self._bias_holder),
+                                       *[tf.assign(f, h) for f, h in zip(self._factors, self._factor_holders)])
+            # adam steps have a fixed size, so they are scaled with the magnitude of the factors
+            _learning_rate_scale = conv_reg_filter.get_factor_std(self._filter_structure, _weight_std,
+                                                                  self._filter_rank) / _weight_std
 
-            _conv_out = tf.nn.conv2d(self._input_holder, self._weight, [1, 1, 1, 1], 'VALID')
             self._output_response = tf.add(_conv_out, self._bias)
 
-            _weight_map = self._loss_weight_a * tf.exp(self._loss_weight_b*self._response_holder)
-            _diff_map = self._output_response - self._response_holder
-            _sign_map = (tf.sign(tf.abs(_diff_map) - self._loss_threshold) + 1) / 2
-            _sum_map = tf.multiply(tf.multiply(_weight_map, _sign_map), _diff_map)
-            _l2_loss = tf.reduce_sum(_sum_map * _sum_map, reduction_indices=[1,2,3])
-            self._pred_loss = tf.reduce_mean(_l2_loss, reduction_indices=0)
+            self._pred_loss, _scale_map = _weighted_l2_loss(self._output_response, self._response_holder,
+                                                self._loss_weight_a, self._loss_weight_b, self._loss_threshold)
             # self._pred_loss = tf.nn.l2_loss(_mean_loss, name='l2_loss')
             self._regu_loss = 0.5*self._regularization_coef * \
                               (tf.reduce_sum(tf.square(self._weight)) + tf.multiply(self._bias, self._bias))
@@ -82,11 +117,23 @@ class ConvRegression(object):
 
             # self._init_train_op = tf.train.GradientDescentOptimizer(learning_rate=self._learning_rate) \
             #     .minimize(self._total_loss, global_step=self._global_step)
-            self._init_train_op = tf.train.AdamOptimizer(self._learning_rate) \
+            self._init_train_op = tf.train.AdamOptimizer(self._learning_rate * _learning_rate_scale) \
                 .minimize(self._total_loss, global_step=self._global_step)
-            self._update_train_op = tf.train.AdamOptimizer(self._update_learning_rate) \
+            self._update_train_op = tf.train.AdamOptimizer(self._update_learning_rate * _learning_rate_scale) \
                 .minimize(self._total_loss, global_step=self._global_step)
-            self.session = tf.Session(graph=self.graph)
+            self.session = tf_session.create_session(self.graph)
+            if self._solver_name != 'adam':
+                # the diagonal preconditioner is only known for the full filter
+                _preconditioner = None
+                if self._filter_structure == 'full':
+                    _preconditioner = conv_reg_solver.conv_hessian_diagonal(self._input_holder, self._weight,
+                                                                            self._bias, _scale_map,
+                                                                            self._regularization_coef)
+                self._solver = conv_reg_solver.SOLVERS[self._solver_name](self.session,
+                                                                          self._factors + [self._bias],
+                                                                          self._total_loss,
+                                                                          self._global_step,
+                                                                          _preconditioner)
             self.session.run(tf.global_variables_initializer())
 
             # tf.train.SummaryWriter('./log', graph=self.graph)
@@ -98,9 +145,38 @@ class ConvRegression(object):
         else:
             return -1
 
+    def get_weights(self):
+        weight, bias = self.session.run([self._weight, self._bias])
+        return weight, bias
+
+    def get_conv_size(self):
+        return self._conv_size
+
+    def get_weights_version(self):
+        return self._weights_version
+
+    def set_weights(self, weight, bias):
+        """
+        With a structured filter, the nearest filter of the structure is set, see factorize_filter.
+        """
+        self._weights_version += 1
+        feed_dict = {self._bias_holder: bias}
+        _factors = conv_reg_filter.factorize_filter(self._filter_structure, weight, self._filter_rank)
+        feed_dict.update(zip(self._factor_holders, _factors))
+        self.session.run(self._assign_op, feed_dict=feed_dict)
+
+    def evaluate_loss(self, features, response):
+        feed_dict = {self._input_holder: features,
+                     self._response_holder: response}
+        return self.session.run(self._total_loss, feed_dict=feed_dict)
+
     def train(self, features, response, max_step_num, loss_th):
         feed_dict = {self._input_holder: features,
                      self._response_holder: response}
+        self._weights_version += 1
+        if self._solver:
+            self._solver.minimize(feed_dict, max_step_num, loss_th)
+            return
         i = 0
         max_idx = np.argmax(response)
         # snr_list = []
@@ -145,6 +221,10 @@ class ConvRegression(object):
     def update(self, features, response, max_step_num, loss_th):
         feed_dict = {self._input_holder: features,
                      self._response_holder: response}
+        self._weights_version += 1
+        if self._solver:
+            self._solver.minimize(feed_dict, max_step_num, loss_th)
+            return
         i = 0
         while i < max_step_num:
             if self._verbose:
@@ -168,13 +248,246 @@ class ConvRegression(object):
         # if i >= max_step_num:
         #     print('Warning, total_loss larger than loss_th even after {:d}steps'.format(i))
 
+    def train_coarse_to_fine(self, features, response, max_step_num, loss_th):
+        """
+        Fit the filter on sum-pooled features first, then upsample it and refine at full resolution.
+
+        With sum pooling, a coarse filter replicated over its pooling cells gives the same response as the
+        coarse one at the sampled positions (exactly when the filter size is a multiple of the factor), so the
+        coarse solution is a consistent initialization.
+        """
+        factor = self._multigrid_factor
+        coarse_step_num = int(max_step_num * self._multigrid_coarse_step_ratio)
+        if factor <= 1 or min(self._conv_size) < 2*factor or coarse_step_num <= 0:
+            self.train(features, response, max_step_num, loss_th)
+            return
+
+        coarse_features = pool_features(features, factor)
+        coarse_conv_size = (int(math.ceil(self._conv_size[0] / float(factor))),
+                            int(math.ceil(self._conv_size[1] / float(factor))))
+        coarse_response_h = coarse_features.shape[1] - coarse_conv_size[0] + 1
+        coarse_response_w = coarse_features.shape[2] - coarse_conv_size[1] + 1
+        coarse_response = response[:, ::factor, ::factor, :][:, :coarse_response_h, :coarse_response_w, :]
+
+        # every coarse weight stands for factor**2 fine weights with the same value
+        coarse_regression = ConvRegression(coarse_features, coarse_conv_size,
+                                           self._regularization_coef * factor * factor)
+        coarse_regression.train(coarse_features, coarse_response, coarse_step_num, loss_th)
+        coarse_weight, coarse_bias = coarse_regression.get_weights()
+        used_step_num = coarse_regression.get_global_step()
+        coarse_regression.close()
+
+        weight = np.repeat(np.repeat(coarse_weight, factor, axis=0), factor, axis=1)
+        self.set_weights(weight[:self._conv_size[0], :self._conv_size[1], :, :], coarse_bias)
+        self.train(features, response, max(1, max_step_num - used_step_num), loss_th)
+
     def inference(self, features):
+        if self._numpy_inference:
+            return self._numpy_inference.inference(features)
         feed_dict = {self._input_holder: features}
         response = self.session.run(self._output_response, feed_dict=feed_dict)
         return response
 
+    def inference_fused(self, raw_features, pca, window=None):
+        """
+        See NumpyInference.inference_fused, the training stays in the reduced space.
+        """
+        if self._fused_inference is None:
+            self._fused_inference = self._numpy_inference or conv_reg_numpy.NumpyInference(self)
+        return self._fused_inference.inference_fused(raw_features, pca, window)
+
+    def inference_window(self, features, window):
+        """
+        Evaluate the response only inside a window, the rest of the response map is left at zero.
+
+        :param features: ndarray, (n, h, w, c)
+        :param window: (y0, y1, x0, x1), the response indices [y0, y1) x [x0, x1) to evaluate
+        :return: ndarray, (n, h-kh+1, w-kw+1, 1) like inference
+        """
+        y0, y1, x0, x1 = window
+        kh, kw = self._conv_size
+        n, h, w = features.shape[:3]
+        response = np.zeros((n, h-kh+1, w-kw+1, 1), dtype=np.float32)
+        if y1 > y0 and x1 > x0:
+            response[:, y0:y1, x0:x1, :] = self.inference(features[:, y0:y1+kh-1, x0:x1+kw-1, :])
+        return response
+
     def close(self):
         if self.session is not None:
             self.session.close()
             self.session = None
 
+
+def pool_features(features, factor):
+    """
+    Sum pooling over factor x factor cells, the trailing rows and columns are dropped.
+
+    :param features: ndarray, (n, h, w, c)
+    :return: ndarray, (n, h // factor, w // factor, c)
+    """
+    n, h, w, c = features.shape
+    ph, pw = h // factor, w // factor
+    _cropped = features[:, :ph*factor, :pw*factor, :]
+    return _cropped.reshape((n, ph, factor, pw, factor, c)).sum(axis=(2, 4))
+
+
+SWEEP_CFG_NAMES = ('REGULARIZATION_COEF', 'SGD_LEARNING_RATE', 'SGD_UPDATE_LEARNING_RATE',
+                   'LOSS_WEIGHT_A', 'LOSS_WEIGHT_B', 'LOSS_THRESHOLD')
+
+
+def make_sweep_configs(**grid):
+    """
+    Build the cartesian product of the given config values.
+
+    :param grid: ConvRegressionCfg attribute name -> list of values, e.g. LOSS_WEIGHT_B=[1.0, 3.0]
+    :return: list of dicts, one per config, usable by ConvRegressionSweep
+    """
+    configs = [dict()]
+    for name in sorted(grid):
+        assert name in SWEEP_CFG_NAMES, 'can not sweep over {:s}'.format(name)
+        configs = [dict(cfg, **{name: value}) for cfg in configs for value in grid[name]]
+    return configs
+
+
+class ConvRegressionSweep(object):
+    """
+    K independent regression filters trained on the same features in one graph.
+
+    The filters are stacked along the output channel axis, each one with its own loss coefficients and
+    its own optimizers, so every config converges exactly as a stand-alone ConvRegression would. The gradients of
+    all the configs come from one backward pass of the summed losses, the loss of a config only depends on its own
+    filter.
+    """
+
+    def __init__(self, init_features, conv_size, sweep_configs):
+        assert len(sweep_configs) > 0
+        self._configs = []
+        for cfg in sweep_configs:
+            _full_cfg = dict((name, getattr(ConvRegressionCfg, name)) for name in SWEEP_CFG_NAMES)
+            _full_cfg.update(cfg)
+            assert len(_full_cfg) == len(SWEEP_CFG_NAMES), 'unknown sweep config: {}'.format(cfg)
+            self._configs.append(_full_cfg)
+        self._config_num = len(self._configs)
+        self._verbose = ConvRegressionCfg.VERBOSE
+        self._global_step = None
+        self._step_op = None
+        self._input_holder = None
+        self._response_holder = None
+        self._output_response = None
+        self._weights = []
+        self._biases = []
+        self._total_losses = []
+        self._init_train_ops = []
+        self._update_train_ops = []
+        self.graph = None
+        self.session = None
+
+        self._last_losses = np.zeros(self._config_num, dtype=np.float32)
+        self._step_nums = np.zeros(self._config_num, dtype=np.int32)
+
+        input_size = init_features.shape
+        input_mean = np.mean(np.abs(init_features))
+        self._build_graph(input_size, conv_size, input_mean)
+
+    def _build_graph(self, input_size, conv_size, input_mean):
+        assert len(input_size) == 4 and len(conv_size) == 2
+        self.graph = tf.Graph()
+        with self.graph.as_default(), tf_session.jit_scope():
+            _input_shape = (None, input_size[1], input_size[2], input_size[3])
+            self._input_holder = tf.placeholder(tf.float32, _input_shape, name='input_feature')
+            _output_shape = (None, input_size[1]-conv_size[0]+1, input_size[2]-conv_size[1]+1, 1)
+            self._response_holder = tf.placeholder(tf.float32, _output_shape, name='label_response')
+            self._global_step = tf.Variable(0, trainable=False, name='global_step')
+            self._step_op = tf.assign_add(self._global_step, 1)
+
+            _weight_shape = [conv_size[0], conv_size[1], input_size[3], 1]
+            _weight_size = conv_size[0]*conv_size[1]*input_size[3]
+            _weight_std = min(1/input_mean/_weight_size/4, 1)
+            # all the configs start from the same filter so that they can be compared fairly
+            _weight_init = tf.random_normal(_weight_shape, stddev=_weight_std)
+            for k in range(self._config_num):
+                self._weights.append(tf.Variable(_weight_init, name='conv_weight_{:d}'.format(k)))
+                self._biases.append(tf.Variable(0.0, name='conv_bias_{:d}'.format(k)))
+
+            _conv_out = tf.nn.conv2d(self._input_holder, tf.concat(self._weights, axis=3), [1, 1, 1, 1], 'VALID')
+            self._output_response = tf.add(_conv_out, tf.stack(self._biases))
+
+            for k, cfg in enumerate(self._configs):
+                _weight, _bias = self._weights[k], self._biases[k]
+                _pred_loss, _ = _weighted_l2_loss(self._output_response[:, :, :, k:k+1], self._response_holder,
+                                               cfg['LOSS_WEIGHT_A'], cfg['LOSS_WEIGHT_B'], cfg['LOSS_THRESHOLD'])
+                _regu_loss = 0.5*cfg['REGULARIZATION_COEF'] * \
+                    (tf.reduce_sum(tf.square(_weight)) + tf.multiply(_bias, _bias))
+                self._total_losses.append(_pred_loss + _regu_loss)
+
+            _grads = tf.gradients(tf.add_n(self._total_losses), self._weights + self._biases)
+            for k, cfg in enumerate(self._configs):
+                _grads_and_vars = [(_grads[k], self._weights[k]),
+                                   (_grads[self._config_num + k], self._biases[k])]
+                self._init_train_ops.append(tf.train.AdamOptimizer(cfg['SGD_LEARNING_RATE'])
+                                            .apply_gradients(_grads_and_vars))
+                self._update_train_ops.append(tf.train.AdamOptimizer(cfg['SGD_UPDATE_LEARNING_RATE'])
+                                              .apply_gradients(_grads_and_vars))
+            self.session = tf_session.create_session(self.graph)
+            self.session.run(tf.global_variables_initializer())
+
+    def get_configs(self):
+        return self._configs
+
+    def get_global_step(self):
+        if self.session:
+            global_step = self.session.run(self._global_step)
+            return global_step
+        else:
+            return -1
+
+    def get_losses(self):
+        """
+        :return: the total loss of each config, evaluated at its last train step
+        """
+        return self._last_losses.copy()
+
+    def get_step_nums(self):
+        """
+        :return: the number of steps each config needed in the last call of train or update
+        """
+        return self._step_nums.copy()
+
+    def _run_steps(self, train_ops, features, response, max_step_num, loss_th):
+        feed_dict = {self._input_holder: features,
+                     self._response_holder: response}
+        # configs are dropped once their own loss is below loss_th, like the stopping rule of ConvRegression
+        active = list(range(self._config_num))
+        self._step_nums[:] = 0
+        i = 0
+        while i < max_step_num and active:
+            fetches = [self._step_op,
+                       [train_ops[k] for k in active],
+                       [self._total_losses[k] for k in active]]
+            _, _, total_losses = self.session.run(fetches, feed_dict=feed_dict)
+            self._last_losses[active] = total_losses
+            self._step_nums[active] += 1
+            if self._verbose:
+                print('step:{:5d}, active configs:{:3d}, min total_loss:{:.4e}, max total_loss:{:.4e}'.format(
+                    i, len(active), min(total_losses), max(total_losses)))
+            active = [k for k, loss in zip(active, total_losses) if loss >= loss_th]
+            i += 1
+
+    def train(self, features, response, max_step_num, loss_th):
+        self._run_steps(self._init_train_ops, features, response, max_step_num, loss_th)
+
+    def update(self, features, response, max_step_num, loss_th):
+        self._run_steps(self._update_train_ops, features, response, max_step_num, loss_th)
+
+    def inference(self, features):
+        """
+        :return: the responses of all the configs, with shape (n, h, w, config_num)
+        """
+        feed_dict = {self._input_holder: features}
+        response = self.session.run(self._output_response, feed_dict=feed_dict)
+        return response
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
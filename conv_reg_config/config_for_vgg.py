@@ -4,12 +4,25 @@ import os.path
 
 class BasicCfg(object):
     PROJECT_ROOT_DIR = os.path.join(os.path.dirname(inspect.getfile(inspect.currentframe())), '..')
+    XLA_JIT = False  # compile the tf graphs with the XLA JIT, see tf_session
 
 
 class TrainDataCfg(object):
     CONVOLUTION_SIZE_TH = 10
+    CONVOLUTION_SIZE_POLICY = 'fixed'  # 'fixed' or 'target', see train_data_provider.choose_convolution_size_th
+    # the sizes the 'target' policy chooses from, few of them so that the targets share the network shapes
+    CONVOLUTION_SIZE_LEVELS = [4, 6, 8, 10, 12, 14]
+    CONVOLUTION_PIXELS_PER_CELL = 4.0  # target pixels per filter cell, before the texture adjustment
+    # mean absolute laplacian of the target gray levels over 255, below and above which one level coarser and
+    # finer is used
+    CONVOLUTION_TEXTURE_RANGE = (0.02, 0.08)
     SEARCH_RATIO_WIDTH = 9
     SEARCH_RATIO_HEIGHT = 5
+    DYNAMIC_SEARCH = False
+    DYNAMIC_SEARCH_RATIOS = [(5, 3), (7, 5), (9, 5)]  # odd ratios, from the smallest window to the largest
+    DYNAMIC_SEARCH_HISTORY_LENGTH = 10
+    DYNAMIC_SEARCH_MARGIN = 2.0
+    DYNAMIC_SEARCH_CONFIDENCE_TH = 0.5
     # SEARCH_PATCH_RATIO = 4
 
     SCALE_TEST_NUM = 1
@@ -23,6 +36,15 @@ class TrainDataCfg(object):
     VGG_MEAN = [103.939, 116.779, 123.68]
     VGG_FEATURE_STD = 100.0
     VGG_FEATURE_MEAN = 0.0
+    VGG_GRAPH_CACHE_SIZE = 8  # networks pooled by all the vgg extractors, see VggExtractor
+    VGG_BACKEND = 'tensorflow'  # 'tensorflow' or 'numpy', see vgg_numpy_extractor
+    VGG_PRECISION = 'float32'  # 'float32', 'float16' or 'int8', see vgg_model.PRECISIONS
+    # int8 activation ranges of the relu outputs, written by vgg_feature_extractor.calibrate_activation_ranges
+    VGG_CALIBRATION_PATH = os.path.join(BasicCfg.PROJECT_ROOT_DIR, 'vgg_model/int8_calibration.npz')
+    VGG_CALIBRATION_PERCENTILE = 99.99
+    SEARCH_THUMBNAIL_SIZE = 32
+    # channels of the last conv layer kept per target, 0 keeps all of them, at least the 64 of the pca otherwise
+    CHANNEL_SELECTION_NUM = 0
 
     SHOW_LABEL_RESPONSE_FID = ''  # 'label_response'
     SHOW_MOTION_MAP_FID = ''  # 'motion_map'
@@ -37,6 +59,7 @@ class FhogCfg(object):
 class FhogCnCfg(object):
     CELL_SIZE = 4
     BIN_NUM = 9
+    CN_CELL_POOLING = False  # average the color names of the pixels of each cell instead of resizing
 
 
 class ConvRegressionCfg(object):
@@ -47,6 +70,15 @@ class ConvRegressionCfg(object):
     LOSS_WEIGHT_A = 0.1
     LOSS_WEIGHT_B = 1.0
     LOSS_THRESHOLD = 0.0
+    SOLVER = 'adam'  # 'adam', 'cg' or 'lbfgs'
+    CG_RESTART_STEP = 20
+    LBFGS_MEMORY = 10
+    MULTIGRID_FACTOR = 2
+    MULTIGRID_COARSE_STEP_RATIO = 0.75
+    INFERENCE_BACKEND = 'tf'  # 'tf' or 'numpy'
+    NUMPY_FFT_COST_FACTOR = 3.0
+    FILTER_STRUCTURE = 'full'  # 'full', 'separable' or 'basis'
+    FILTER_RANK = 2
     VERBOSE = False
     SHOW_RESPONSE_FID = 'output_response'
     SHOW_STEP = 1
@@ -58,12 +90,64 @@ class ConvRegTrackerCfg(object):
     TRAIN_UPDATE_MAX_STEP_NUM = 15
     TRAIN_UPDATE_STEP_NUM = 2
     UPDATE_CONFIDENCE_TH = 0.0
+    UPDATE_POLICY = 'threshold'  # 'threshold' or 'adaptive'
+    UPDATE_INTERVAL = 5
+    UPDATE_DRIFT_RATIO = 0.2  # relative drop of the response peak or PSR
+    UPDATE_STEP_RATIO_RANGE = (0.5, 3.0)
+    UPDATE_PSR_EXCLUDE_RADIUS = 2  # in response cells
+    UPDATE_EMA_RATIO = 0.1
+    MULTIGRID_INIT = False
+    MOTION_GATE_EPS = 0.0  # e.g. 1e-4, 0 evaluates the whole search window
+    FRAME_DEADLINE = 0.0  # seconds per frame, 0 disables the latency budget
+    FEATURE_BACKEND = 'vgg_l4'  # a name of feature_backends.FEATURE_BACKENDS, or 'auto' to choose per target
+    # the backends 'auto' chooses from, from the least accurate to the most accurate. vgg_l4 is the features the
+    # tracker is tuned on, vgg_l5 is left out: it runs all of vgg_l4 and three more layers at the same resolution,
+    # so it only fits the budget when vgg_l4 does
+    FEATURE_BACKEND_CANDIDATES = ['gray', 'rgb', 'fhog', 'fhog_cn', 'vgg_l1', 'vgg_l2', 'vgg_l3', 'vgg_l4']
+    FEATURE_BUDGET_RATIO = 0.5  # of FRAME_DEADLINE, for the feature extraction of all the scales
+    FEATURE_PROFILE_REPEAT = 3
+    LATENCY_EMA_RATIO = 0.2
+    KEYFRAME_MODE = False
+    KEYFRAME_PROPAGATOR = 'flow'  # 'flow' or 'motion'
+    KEYFRAME_MAX_INTERVAL = 5
+    KEYFRAME_CONFIDENCE_TH = 0.5
+    KEYFRAME_DISPLACEMENT_TH = 0.05  # per frame, relative to the object size
+    STATIC_SCENE_TH = 0.0  # mean absolute difference of the search thumbnails in [0, 1], 0 to disable
+    FUSED_PCA_INFERENCE = False  # fold the PCA into the filter when it is cheaper
+    ADAPTIVE_DEPTH = False  # track on conv3_3 and escalate to conv4_3 of the same trunk when unsure
+    SHALLOW_CONFIDENCE_TH = 0.5
 
     TRAIN_DATA_HISTORY_LENGTH = 5
     TRAIN_DATA_GAP = 2
     SHOW_OVERALL_RESPONSE_FID = ''  # 'final response'
 
 
+class MotionModelCfg(object):
+    MODEL = 'static'  # 'static' or 'kalman'
+    KALMAN_PROCESS_NOISE = 0.05  # relative to the object size
+    KALMAN_MEASUREMENT_NOISE = 0.05  # relative to the object size
+    KALMAN_INIT_VELOCITY_STD = 0.5  # relative to the object size
+    MIN_MOTION_SIGMA = 1.0  # in response cells
+    FLOW_MAX_CORNER_NUM = 50
+    FLOW_MIN_POINT_NUM = 8
+    FLOW_MAX_FB_ERROR = 1.0  # pixels
+
+
+class SampleMemoryCfg(object):
+    ENABLE = False
+    BYTE_BUDGET = 8 * 1024 * 1024  # per target
+    CODEC = 'float16'  # 'float16' or 'pq'
+    SAMPLE_NUM = 3  # long-term samples added to each update batch
+    PQ_SUBVECTOR_DIM = 8
+    PQ_CENTROID_NUM = 256
+
+
+class MultiTargetCfg(object):
+    # the frame feature map is used when the search windows cover more than this ratio of the frame
+    FRAME_FEATURE_DENSITY_TH = 1.0
+    FRAME_FEATURE_SCALE_STEP = 2 ** 0.25
+
+
 class TestCfg(object):
     SEQUENCE_DIR = os.path.join(BasicCfg.PROJECT_ROOT_DIR, 'test/data')
     SHOW_TRACK_RESULT_FID = 'track results'
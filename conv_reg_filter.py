@@ -0,0 +1,153 @@
+from __future__ import print_function
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from conv_reg_config import ConvRegressionCfg
+
+
+# 'full':      one free weight per tap and channel, (kh, kw, c, 1)
+# 'separable': rank-r spatial factorization per channel, w[i, j, c] = sum_m col[i, c, m] * row[j, c, m]
+# 'basis':     r separable spatial basis filters shared by all the channels and mixed per channel,
+#              w[i, j, c] = sum_m mix[c, m] * col[i, m] * row[j, m]
+FILTER_STRUCTURES = ['full', 'separable', 'basis']
+
+
+def get_factor_shapes(structure, conv_size, channel_num, rank):
+    kh, kw = conv_size
+    if structure == 'full':
+        return [(kh, kw, channel_num, 1)]
+    if structure == 'separable':
+        return [(kh, 1, channel_num, rank), (1, kw, channel_num * rank, 1)]
+    if structure == 'basis':
+        return [(1, 1, channel_num, rank), (kh, 1, rank, 1), (1, kw, rank, 1)]
+    raise ValueError('Unknown filter structure: {}'.format(structure))
+
+
+def get_factor_std(structure, weight_std, rank):
+    """
+    Standard deviation of the factors so that the composed filter starts with weight_std.
+    """
+    if structure == 'full':
+        return weight_std
+    _factor_num = 2 if structure == 'separable' else 3
+    return (weight_std ** 2 / rank) ** (0.5 / _factor_num)
+
+
+def build_structured_filter(input_tensor, structure, conv_size, channel_num, rank, weight_std):
+    """
+    :return: (factors, weight, output), the factor variables, the composed (kh, kw, c, 1) filter and the VALID
+             response of the input computed with 1-D convolutions
+    """
+    _shapes = get_factor_shapes(structure, conv_size, channel_num, rank)
+    _std = get_factor_std(structure, weight_std, rank)
+    factors = [tf.Variable(tf.random_normal(s, stddev=_std), name='conv_factor_{:d}'.format(i))
+               for i, s in enumerate(_shapes)]
+    kh, kw = conv_size
+    _strides = [1, 1, 1, 1]
+    if structure == 'full':
+        weight = factors[0]
+        output = tf.nn.conv2d(input_tensor, weight, _strides, 'VALID')
+    elif structure == 'separable':
+        col, row = factors
+        _col = tf.reshape(col, (kh, 1, channel_num, rank))
+        _row = tf.reshape(row, (1, kw, channel_num, rank))
+        weight = tf.reduce_sum(_col * _row, axis=3, keepdims=True)
+        # channel c*rank+m of the first depthwise output is channel c filtered by col[:, c, m]
+        _columns = tf.nn.depthwise_conv2d(input_tensor, col, _strides, 'VALID')
+        output = tf.reduce_sum(tf.nn.depthwise_conv2d(_columns, row, _strides, 'VALID'), axis=3, keepdims=True)
+    else:
+        mix, col, row = factors
+        _basis = tf.reshape(col, (kh, 1, rank)) * tf.reshape(row, (1, kw, rank))
+        weight = tf.expand_dims(tf.tensordot(_basis, tf.reshape(mix, (channel_num, rank)), [[2], [1]]), 3)
+        _mixed = tf.nn.conv2d(input_tensor, mix, _strides, 'VALID')
+        _columns = tf.nn.depthwise_conv2d(_mixed, col, _strides, 'VALID')
+        output = tf.reduce_sum(tf.nn.depthwise_conv2d(_columns, row, _strides, 'VALID'), axis=3, keepdims=True)
+    return factors, weight, output
+
+
+def _rank_one(matrix):
+    u, s, vt = np.linalg.svd(matrix, full_matrices=False)
+    return u[:, 0] * np.sqrt(s[0]), vt[0] * np.sqrt(s[0])
+
+
+def factorize_filter(structure, weight, rank):
+    """
+    Factors of the nearest structured filter by truncated SVDs, exact for 'separable' when the rank is at least
+    min(kh, kw).
+
+    :param weight: ndarray, (kh, kw, c, 1)
+    :return: list of ndarrays with the shapes of get_factor_shapes
+    """
+    kh, kw, c = weight.shape[:3]
+    weight = np.reshape(weight, (kh, kw, c))
+    if structure == 'full':
+        return [weight[:, :, :, np.newaxis].astype(np.float32)]
+    if structure == 'separable':
+        col = np.zeros((kh, 1, c, rank), dtype=np.float32)
+        row = np.zeros((1, kw, c * rank, 1), dtype=np.float32)
+        for i in range(c):
+            u, s, vt = np.linalg.svd(weight[:, :, i], full_matrices=False)
+            for m in range(min(rank, len(s))):
+                col[:, 0, i, m] = u[:, m] * np.sqrt(s[m])
+                row[0, :, i * rank + m, 0] = vt[m] * np.sqrt(s[m])
+        return [col, row]
+    mix = np.zeros((1, 1, c, rank), dtype=np.float32)
+    col = np.zeros((kh, 1, rank, 1), dtype=np.float32)
+    row = np.zeros((1, kw, rank, 1), dtype=np.float32)
+    u, s, vt = np.linalg.svd(np.reshape(weight, (kh * kw, c)), full_matrices=False)
+    for m in range(min(rank, len(s))):
+        col[:, 0, m, 0], row[0, :, m, 0] = _rank_one(np.reshape(u[:, m] * s[m], (kh, kw)))
+        mix[0, 0, :, m] = vt[m]
+    return [mix, col, row]
+
+
+def compose_filter(structure, factors):
+    """
+    The (kh, kw, c, 1) filter of the factors, the numpy counterpart of build_structured_filter.
+    """
+    if structure == 'full':
+        return factors[0]
+    if structure == 'separable':
+        col, row = factors
+        kh, _, c, rank = col.shape
+        _row = np.reshape(row, (1, -1, c, rank))
+        return np.sum(col * _row, axis=3, keepdims=True)
+    mix, col, row = factors
+    _basis = col[:, :, :, 0] * row[:, :, :, 0]
+    return np.tensordot(_basis, mix[0, 0], axes=([2], [1]))[:, :, :, np.newaxis]
+
+
+def _benchmark_filter_structures(target_loss=0.05, max_step_num=2000, repeat=50):
+    from conv_reg import ConvRegression
+    from conv_reg_solver import make_synthetic_problem
+
+    rank = ConvRegressionCfg.FILTER_RANK
+    conv_size = (8, 13)
+    features, label = make_synthetic_problem(conv_size, 3)
+
+    _structure = ConvRegressionCfg.FILTER_STRUCTURE
+    try:
+        for structure in FILTER_STRUCTURES:
+            ConvRegressionCfg.FILTER_STRUCTURE = structure
+            regression = ConvRegression(features[:1], conv_size)
+            start = time.time()
+            regression.train(features[:1], label, max_step_num, target_loss)
+            train_time = time.time() - start
+            regression.inference(features)
+            start = time.time()
+            for _ in range(repeat):
+                regression.inference(features)
+            inference_time = (time.time() - start) / repeat
+            parameter_num = sum(int(np.prod(s)) for s in get_factor_shapes(structure, conv_size, features.shape[3], rank))
+            print('{:10s}: parameters:{:7d}, train:{:7.2f}s, steps:{:5d}, loss:{:.4e}, inference:{:7.2f}ms'.format(
+                structure, parameter_num, train_time, regression.get_global_step(),
+                regression.evaluate_loss(features[:1], label), inference_time * 1000))
+            regression.close()
+    finally:
+        ConvRegressionCfg.FILTER_STRUCTURE = _structure
+
+
+if __name__ == '__main__':
+    _benchmark_filter_structures()
@@ -0,0 +1,213 @@
+from __future__ import print_function
+import math
+import time
+
+import numpy as np
+
+from conv_reg_config import ConvRegressionCfg
+
+
+def correlate_direct(features, weight, bias):
+    """
+    VALID correlation of the features with a single output filter, one BLAS call per filter row.
+
+    :param features: ndarray, (n, h, w, c)
+    :param weight: ndarray, (kh, kw, c) or (kh, kw, c, 1)
+    :param bias: float
+    :return: ndarray, (n, h-kh+1, w-kw+1)
+    """
+    weight = np.reshape(weight, weight.shape[:3])
+    n, h, w, c = features.shape
+    kh, kw = weight.shape[:2]
+    rh, rw = h - kh + 1, w - kw + 1
+    features = np.ascontiguousarray(features)
+    sn, sh, sw, sc = features.strides
+    response = np.full((n, rh, rw), bias, dtype=np.float32)
+    for i in range(kh):
+        # (n, rh, rw, kw, c) view of the rows i .. i+rh-1
+        _windows = np.lib.stride_tricks.as_strided(features[:, i:, :, :],
+                                                   shape=(n, rh, rw, kw, c),
+                                                   strides=(sn, sh, sw, sw, sc))
+        response += np.tensordot(_windows, weight[i], axes=([3, 4], [0, 1]))
+    return response
+
+
+def fft_weight(weight, height, width):
+    """
+    Conjugate spectrum of the filter, zero-padded to (height, width) and kept per channel.
+    """
+    weight = np.reshape(weight, weight.shape[:3])
+    _padded = np.zeros((height, width, weight.shape[2]), dtype=np.float32)
+    _padded[:weight.shape[0], :weight.shape[1], :] = weight
+    return np.conj(np.fft.rfft2(_padded, axes=(0, 1)))
+
+
+def correlate_fft(features, weight_spectrum, kernel_size, bias):
+    """
+    VALID correlation computed as a circular one in the frequency domain, summed across channels before the
+    inverse transform so that only one inverse FFT is needed per sample.
+
+    :param features: ndarray, (n, h, w, c)
+    :param weight_spectrum: the output of fft_weight for (h, w)
+    :param kernel_size: (kh, kw)
+    :param bias: float
+    :return: ndarray, (n, h-kh+1, w-kw+1)
+    """
+    n, h, w, c = features.shape
+    rh, rw = h - kernel_size[0] + 1, w - kernel_size[1] + 1
+    _spectrum = np.fft.rfft2(features, axes=(1, 2))
+    _spectrum = np.einsum('nyxc,yxc->nyx', _spectrum, weight_spectrum)
+    response = np.fft.irfft2(_spectrum, s=(h, w), axes=(1, 2))[:, :rh, :rw]
+    return np.asarray(response + bias, dtype=np.float32)
+
+
+def fuse_projection(weight, bias, mean, eigen_vecs):
+    """
+    Composes the PCA projection (x - mean) . eigen_vecs^T with the regression filter. The regression is VALID,
+    so every filter tap sees a projected cell and the composition is exact.
+
+    :param weight: ndarray, (kh, kw, c, 1), the filter in the reduced space
+    :param mean: ndarray, (1, C)
+    :param eigen_vecs: ndarray, (c, C)
+    :return: (weight, bias), the filter (kh, kw, C) and the bias to apply on the raw features
+    """
+    weight = np.reshape(weight, weight.shape[:3])
+    fused_weight = np.tensordot(weight, eigen_vecs, axes=([2], [0])).astype(np.float32)
+    fused_bias = bias - np.sum(fused_weight * np.reshape(mean, (1, 1, -1)))
+    return fused_weight, float(fused_bias)
+
+
+def prefer_fused(feature_shape, kernel_size, reduced_channel_num, window_size=None):
+    """
+    Rough operation count of the direct correlation with and without folding the projection into the filter.
+
+    :param feature_shape: the shape of the raw features, (n, h, w, C)
+    :param window_size: (rh, rw), the response cells to evaluate, the whole response map if None
+    """
+    h, w, c = feature_shape[-3:]
+    kh, kw = kernel_size
+    rh, rw = window_size or (h - kh + 1, w - kw + 1)
+    unfused_cost = h * w * c * reduced_channel_num + rh * rw * kh * kw * reduced_channel_num
+    fused_cost = rh * rw * kh * kw * c
+    return fused_cost < unfused_cost
+
+
+def prefer_fft(feature_shape, kernel_size):
+    """
+    Rough operation count of the two methods, FFT costs are scaled by NUMPY_FFT_COST_FACTOR.
+    """
+    h, w, c = feature_shape[-3:]
+    kh, kw = kernel_size
+    direct_cost = (h - kh + 1) * (w - kw + 1) * kh * kw * c
+    fft_cost = ConvRegressionCfg.NUMPY_FFT_COST_FACTOR * c * h * w * math.log(h * w, 2)
+    return fft_cost < direct_cost
+
+
+class NumpyInference(object):
+    """
+    Computes the response of a ConvRegression with NumPy, from the current weights and bias of the regression.
+
+    The weights are fetched from the session only after they have been changed by training.
+    """
+
+    def __init__(self, regression):
+        self._regression = regression
+        self._weights_version = -1
+        self._weight = None
+        self._bias = None
+        self._spectrum_cache = dict()
+        self._fused_pca = None
+        self._fused_weight = None
+        self._fused_bias = None
+        self._fused_spectrum_cache = dict()
+
+    def _refresh_weights(self):
+        version = self._regression.get_weights_version()
+        if version != self._weights_version:
+            self._weight, self._bias = self._regression.get_weights()
+            self._weights_version = version
+            self._spectrum_cache = dict()
+            self._fused_pca = None
+
+    def inference(self, features, method=None):
+        """
+        :param features: ndarray, (n, h, w, c)
+        :param method: 'direct', 'fft' or None to choose by size
+        :return: ndarray, (n, h-kh+1, w-kw+1, 1) like ConvRegression.inference
+        """
+        self._refresh_weights()
+        kernel_size = self._weight.shape[:2]
+        if method is None:
+            method = 'fft' if prefer_fft(features.shape, kernel_size) else 'direct'
+        if method == 'fft':
+            _size = features.shape[1:3]
+            if _size not in self._spectrum_cache:
+                self._spectrum_cache[_size] = fft_weight(self._weight, _size[0], _size[1])
+            response = correlate_fft(features, self._spectrum_cache[_size], kernel_size, self._bias)
+        else:
+            response = correlate_direct(features, self._weight, self._bias)
+        return response[:, :, :, np.newaxis]
+
+    def inference_fused(self, raw_features, pca, window=None):
+        """
+        Response of the regression on the features reduced by pca, computed from the raw features with the
+        projection folded into the filter, so that the reduced features are never computed.
+
+        :param raw_features: ndarray, (n, h, w, C), the features before the projection
+        :param pca: the FeatureReduction of the extractor
+        :param window: (y0, y1, x0, x1), only these response cells are evaluated, the others are left at zero
+        :return: ndarray, (n, h-kh+1, w-kw+1, 1) like ConvRegression.inference
+        """
+        self._refresh_weights()
+        if self._fused_pca is not pca:
+            self._fused_weight, self._fused_bias = fuse_projection(self._weight, self._bias, pca.mean, pca.eigen_vecs)
+            self._fused_pca = pca
+            self._fused_spectrum_cache = dict()
+        kh, kw = self._weight.shape[:2]
+        n, h, w = raw_features.shape[:3]
+        y0, y1, x0, x1 = window or (0, h - kh + 1, 0, w - kw + 1)
+        response = np.zeros((n, h - kh + 1, w - kw + 1, 1), dtype=np.float32)
+        if y1 <= y0 or x1 <= x0:
+            return response
+        _features = raw_features[:, y0:y1+kh-1, x0:x1+kw-1, :]
+        if prefer_fft(_features.shape, (kh, kw)):
+            _size = _features.shape[1:3]
+            if _size not in self._fused_spectrum_cache:
+                self._fused_spectrum_cache[_size] = fft_weight(self._fused_weight, _size[0], _size[1])
+            _response = correlate_fft(_features, self._fused_spectrum_cache[_size], (kh, kw), self._fused_bias)
+        else:
+            _response = correlate_direct(_features, self._fused_weight, self._fused_bias)
+        response[:, y0:y1, x0:x1, 0] = _response
+        return response
+
+
+def _benchmark_inference(repeat=50):
+    from conv_reg import ConvRegression
+
+    rng = np.random.RandomState(0)
+    for conv_size, channel_num in [((8, 13), 64), ((10, 10), 64), ((6, 16), 31), ((14, 7), 512)]:
+        feature_shape = (3, conv_size[0] * 5, conv_size[1] * 9, channel_num)
+        features = np.maximum(rng.normal(0.0, 100.0, feature_shape), 0.0).astype(np.float32)
+        regression = ConvRegression(features[:1], conv_size)
+        engine = NumpyInference(regression)
+
+        tf_response = regression.inference(features)
+        line = 'conv:{:>8s} c:{:3d} |'.format('{}x{}'.format(*conv_size), channel_num)
+        start = time.time()
+        for _ in range(repeat):
+            regression.inference(features)
+        line += ' tf:{:7.2f}ms |'.format((time.time() - start) / repeat * 1000)
+        for method in ['direct', 'fft']:
+            response = engine.inference(features, method)
+            start = time.time()
+            for _ in range(repeat):
+                engine.inference(features, method)
+            error = np.max(np.abs(response - tf_response)) / np.max(np.abs(tf_response))
+            line += ' {:s}:{:7.2f}ms (err {:.1e}) |'.format(method, (time.time() - start) / repeat * 1000, error)
+        line += ' auto: {:s}'.format('fft' if prefer_fft(feature_shape, conv_size) else 'direct')
+        print(line)
+        regression.close()
+
+
+if __name__ == '__main__':
+    _benchmark_inference()
@@ -0,0 +1,236 @@
+from __future__ import print_function
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from conv_reg_config import ConvRegressionCfg
+
+
+def conv_hessian_diagonal(input_tensor, weight, bias, scale_map, regularization_coef):
+    """
+    Diagonal of the hessian of the weighted regression loss, with the threshold mask held fixed.
+
+    :param input_tensor: the input features, (n, h, w, c)
+    :param weight: the convolution filter, (kh, kw, c, 1)
+    :param bias: the scalar bias
+    :param scale_map: the per-pixel factor applied to the difference map inside the loss
+    :param regularization_coef: coefficient of the l2 regularization
+    :return: list of tensors with the shapes of [weight, bias]
+    """
+    _sample_num = tf.cast(tf.shape(input_tensor)[0], tf.float32)
+    _square_scale = tf.stop_gradient(tf.square(scale_map))
+    _weight_diag = tf.nn.conv2d_backprop_filter(tf.square(input_tensor), tf.shape(weight), _square_scale,
+                                                [1, 1, 1, 1], 'VALID')
+    _weight_diag = 2.0 / _sample_num * _weight_diag + regularization_coef
+    _bias_diag = 2.0 / _sample_num * tf.reduce_sum(_square_scale) + regularization_coef
+    return [_weight_diag, tf.reshape(_bias_diag, tf.shape(bias))]
+
+
+class RegressionSolver(object):
+
+    def __init__(self, session, variables, total_loss, global_step):
+        self._session = session
+        self._variables = variables
+        self._total_loss = total_loss
+        self._shapes = [v.shape.as_list() for v in variables]
+        self._sizes = [int(np.prod(s)) for s in self._shapes]
+        self._grads = tf.gradients(total_loss, variables)
+        self._value_holders = [tf.placeholder(tf.float32, s) for s in self._shapes]
+        self._assign_op = tf.group(*[tf.assign(v, h) for v, h in zip(variables, self._value_holders)])
+        self._step_op = tf.assign_add(global_step, 1)
+
+    def _flatten(self, arrays):
+        return np.concatenate([np.reshape(a, -1) for a in arrays]).astype(np.float64)
+
+    def _unflatten(self, vector):
+        arrays = []
+        offset = 0
+        for shape, size in zip(self._shapes, self._sizes):
+            arrays.append(np.reshape(vector[offset:offset+size], shape).astype(np.float32))
+            offset += size
+        return arrays
+
+    def _get_values(self):
+        return self._flatten(self._session.run(self._variables))
+
+    def _set_values(self, vector):
+        self._session.run(self._assign_op, feed_dict=dict(zip(self._value_holders, self._unflatten(vector))))
+
+    def minimize(self, feed_dict, max_step_num, loss_th):
+        pass
+
+
+class ConjugateGradientSolver(RegressionSolver):
+    """
+    Preconditioned CG on the normal equations of the weighted loss.
+
+    The loss is quadratic once the threshold mask is fixed, so CG is run on that quadratic and the mask is
+    re-evaluated at every restart.
+    """
+
+    def __init__(self, session, variables, total_loss, global_step, preconditioner=None):
+        super(ConjugateGradientSolver, self).__init__(session, variables, total_loss, global_step)
+        self._restart_step = ConvRegressionCfg.CG_RESTART_STEP
+        self._direction_holders = [tf.placeholder(tf.float32, s) for s in self._shapes]
+        _grad_dot = tf.add_n([tf.reduce_sum(g * d) for g, d in zip(self._grads, self._direction_holders)])
+        self._hessian_product = tf.gradients(_grad_dot, variables)
+        self._preconditioner = preconditioner
+
+    def minimize(self, feed_dict, max_step_num, loss_th):
+        i = 0
+        while i < max_step_num:
+            fetches = [self._total_loss, self._grads]
+            if self._preconditioner:
+                fetches.append(self._preconditioner)
+            results = self._session.run(fetches, feed_dict=feed_dict)
+            loss, grad = results[0], self._flatten(results[1])
+            if loss < loss_th:
+                break
+            inv_diag = 1.0 / self._flatten(results[2]) if self._preconditioner else np.ones_like(grad)
+
+            theta = self._get_values()
+            delta = np.zeros_like(theta)
+            residual = -grad
+            z = inv_diag * residual
+            direction = z.copy()
+            rz = np.dot(residual, z)
+            est_loss = loss
+            for _ in range(min(self._restart_step, max_step_num - i)):
+                _feed = dict(feed_dict)
+                _feed.update(zip(self._direction_holders, self._unflatten(direction)))
+                hessian_direction, _ = self._session.run([self._hessian_product, self._step_op], feed_dict=_feed)
+                hessian_direction = self._flatten(hessian_direction)
+                i += 1
+                curvature = np.dot(direction, hessian_direction)
+                if curvature <= 0:
+                    break
+                alpha = rz / curvature
+                delta += alpha * direction
+                residual -= alpha * hessian_direction
+                # exact loss of the quadratic model at theta + delta
+                est_loss = loss + 0.5 * np.dot(grad, delta) - 0.5 * np.dot(delta, residual)
+                if est_loss < loss_th:
+                    break
+                z = inv_diag * residual
+                rz_new = np.dot(residual, z)
+                direction = z + rz_new / rz * direction
+                rz = rz_new
+            self._set_values(theta + delta)
+            if est_loss < loss_th:
+                break
+
+
+class LbfgsSolver(RegressionSolver):
+
+    def __init__(self, session, variables, total_loss, global_step, preconditioner=None):
+        super(LbfgsSolver, self).__init__(session, variables, total_loss, global_step)
+        self._memory_size = ConvRegressionCfg.LBFGS_MEMORY
+        self._armijo_coef = 1e-4
+        self._max_backtrack_num = 20
+
+    def _evaluate(self, feed_dict, theta):
+        self._set_values(theta)
+        loss, grad, _ = self._session.run([self._total_loss, self._grads, self._step_op], feed_dict=feed_dict)
+        return float(loss), self._flatten(grad)
+
+    def minimize(self, feed_dict, max_step_num, loss_th):
+        theta = self._get_values()
+        loss, grad = self._evaluate(feed_dict, theta)
+        i = 1
+        s_list, y_list = [], []
+        while i < max_step_num and loss >= loss_th:
+            # two-loop recursion
+            q = grad.copy()
+            alphas = []
+            for s, y in reversed(list(zip(s_list, y_list))):
+                alpha = np.dot(s, q) / np.dot(y, s)
+                q -= alpha * y
+                alphas.append(alpha)
+            if s_list:
+                q *= np.dot(s_list[-1], y_list[-1]) / np.dot(y_list[-1], y_list[-1])
+                step = 1.0
+            else:
+                step = 1.0 / max(np.linalg.norm(grad), 1e-12)
+            for (s, y), alpha in zip(zip(s_list, y_list), reversed(alphas)):
+                beta = np.dot(y, q) / np.dot(y, s)
+                q += (alpha - beta) * s
+            direction = -q
+
+            slope = np.dot(grad, direction)
+            if slope >= 0:
+                if not s_list:
+                    break
+                s_list, y_list = [], []
+                continue
+            for _ in range(self._max_backtrack_num):
+                new_theta = theta + step * direction
+                new_loss, new_grad = self._evaluate(feed_dict, new_theta)
+                i += 1
+                if new_loss <= loss + self._armijo_coef * step * slope or i >= max_step_num:
+                    break
+                step *= 0.5
+            if new_loss > loss:
+                self._set_values(theta)
+                break
+            s, y = new_theta - theta, new_grad - grad
+            if np.dot(s, y) > 1e-12:
+                s_list.append(s)
+                y_list.append(y)
+                if len(s_list) > self._memory_size:
+                    s_list.pop(0)
+                    y_list.pop(0)
+            theta, loss, grad = new_theta, new_loss, new_grad
+
+
+SOLVERS = {
+    'cg': ConjugateGradientSolver,
+    'lbfgs': LbfgsSolver,
+}
+
+
+def make_synthetic_problem(conv_size, sample_num, channel_num=64, seed=0):
+    """
+    Random relu-like features of a search window 5 x 9 filters large, and the gaussian label of a target at its
+    center, for the benchmarks.
+
+    :return: (features, label), (sample_num, h, w, channel_num) and (1, h - kh + 1, w - kw + 1, 1) float32
+    """
+    feature_shape = (sample_num, conv_size[0] * 5, conv_size[1] * 9, channel_num)
+    response_shape = (feature_shape[1] - conv_size[0] + 1, feature_shape[2] - conv_size[1] + 1)
+    rng = np.random.RandomState(0)
+    features = np.maximum(rng.normal(0.0, 100.0, feature_shape), 0.0).astype(np.float32)
+    yv, xv = np.meshgrid(np.arange(response_shape[0]), np.arange(response_shape[1]), indexing='ij')
+    sigma_y, sigma_x = conv_size[0] * 0.1, conv_size[1] * 0.1
+    label = np.exp(-((yv - response_shape[0] // 2)**2 / 2 / sigma_y**2 + (xv - response_shape[1] // 2)**2 / 2 / sigma_x**2))
+    label = label[np.newaxis, :, :, np.newaxis].astype(np.float32)
+    return features, label
+
+
+def _benchmark_solvers(target_loss=0.05, max_step_num=4000, repeat=3):
+    from conv_reg import ConvRegression
+
+    conv_size = (8, 13)
+    features, label = make_synthetic_problem(conv_size, 1)
+
+    _solver = ConvRegressionCfg.SOLVER
+    try:
+        for name in ['adam', 'cg', 'lbfgs']:
+            ConvRegressionCfg.SOLVER = name
+            elapsed, losses, steps = [], [], []
+            for _ in range(repeat):
+                regression = ConvRegression(features, conv_size)
+                start = time.time()
+                regression.train(features, label, max_step_num, target_loss)
+                elapsed.append(time.time() - start)
+                losses.append(regression.evaluate_loss(features, label))
+                steps.append(regression.get_global_step())
+                regression.close()
+            print('{:6s}: {:8.3f}s, steps:{:6.0f}, final loss:{:.4e}'.format(name, np.mean(elapsed),
+                                                                           np.mean(steps), np.mean(losses)))
+    finally:
+        ConvRegressionCfg.SOLVER = _solver
+
+
+if __name__ == '__main__':
+    _benchmark_solvers()
@@ -0,0 +1,90 @@
+from __future__ import print_function
+import importlib
+import time
+
+from conv_reg_config import ConvRegTrackerCfg, TrainDataCfg
+from train_data_provider import TrainDataProvider
+
+
+# name -> (module, class), the modules are only imported when the backend is used, so that a missing native
+# build only rules out the backends which need it. TensorFlow is not optional, tracker imports conv_reg and
+# vgg_feature_extractor at the top
+FEATURE_BACKENDS = {
+    'gray': ('feature_extractor', 'GrayExtractor'),
+    'rgb': ('feature_extractor', 'RgbExtractor'),
+    'fhog': ('feature_extractor', 'FhogExtractor'),
+    'fhog_cn': ('feature_extractor', 'FhogCnExtractor'),
+    'vgg_l1': ('vgg_feature_extractor', 'VggL1Extractor'),
+    'vgg_l2': ('vgg_feature_extractor', 'VggL2Extractor'),
+    'vgg_l3': ('vgg_feature_extractor', 'VggL3Extractor'),
+    'vgg_l4': ('vgg_feature_extractor', 'VggL4Extractor'),
+    'vgg_l5': ('vgg_feature_extractor', 'VggL5Extractor'),
+}
+
+# the vgg backends run by vgg_numpy_extractor with TrainDataCfg.VGG_BACKEND = 'numpy'
+_NUMPY_VGG_BACKENDS = {
+    'vgg_l1': 'VggL1NumpyExtractor',
+    'vgg_l2': 'VggL2NumpyExtractor',
+    'vgg_l3': 'VggL3NumpyExtractor',
+    'vgg_l4': 'VggL4NumpyExtractor',
+    'vgg_l5': 'VggL5NumpyExtractor',
+}
+
+
+def get_extractor_class(name):
+    if name in _NUMPY_VGG_BACKENDS and TrainDataCfg.VGG_BACKEND == 'numpy':
+        return getattr(importlib.import_module('vgg_numpy_extractor'), _NUMPY_VGG_BACKENDS[name])
+    module_name, class_name = FEATURE_BACKENDS[name]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def profile_backend(extractor_class, image, init_rect, repeat=None, multi_level_search=False,
+                    convolution_size_th=None):
+    """
+    :return: (provider, seconds), a data provider of the target with the extractor and the time it takes to
+             extract the search features of all the scales of one frame, after the networks are built
+    """
+    repeat = repeat or ConvRegTrackerCfg.FEATURE_PROFILE_REPEAT
+    provider = TrainDataProvider(extractor_class, init_rect, multi_level_search=multi_level_search,
+                                 convolution_size_th=convolution_size_th)
+    # fits the pca on the same window as the tracker init, and builds the networks of both batch sizes
+    provider.get_search_feature(image, init_rect)
+    provider.get_scaled_search_feature(image, init_rect)
+    start = time.time()
+    for _ in range(repeat):
+        provider.get_scaled_search_feature(image, init_rect)
+    return provider, (time.time() - start) / repeat
+
+
+def select_backend(image, init_rect, frame_deadline, candidates=None, multi_level_search=False,
+                   convolution_size_th=None):
+    """
+    The most accurate backend whose feature extraction fits FEATURE_BUDGET_RATIO of the frame deadline on this
+    target, the rest of the frame is left to the regression and the update. The cheapest one is used when none
+    fits, and the backends which cannot be loaded are skipped.
+
+    :param candidates: backend names from the least accurate to the most accurate, FEATURE_BACKEND_CANDIDATES
+                       for None
+    :return: (name, provider)
+    """
+    candidates = candidates or ConvRegTrackerCfg.FEATURE_BACKEND_CANDIDATES
+    _budget = frame_deadline * ConvRegTrackerCfg.FEATURE_BUDGET_RATIO
+    selected = None
+    for name in reversed(candidates):
+        try:
+            extractor_class = get_extractor_class(name)
+            provider, elapsed = profile_backend(extractor_class, image, init_rect,
+                                                multi_level_search=multi_level_search,
+                                                convolution_size_th=convolution_size_th)
+        except ImportError as e:
+            print('\tfeature backend {:s} skipped: {}'.format(name, e))
+            continue
+        print('\tfeature backend {:s}: {:.2f}ms'.format(name, elapsed * 1000))
+        # the rejected backends release their sessions
+        if selected is not None:
+            selected[1].close()
+        selected = (name, provider)
+        if elapsed <= _budget:
+            break
+    assert selected is not None, 'no feature backend can be loaded'
+    return selected
@@ -1,7 +1,5 @@
 
 import cv2
-# import fhog_feature
-# import cn_feature
 import numpy as np
 import conv_reg_config
 
@@ -9,21 +7,62 @@ import conv_reg_config
 class FeatureExtractor(object):
 
     def __init__(self):
-        self._resolution = 1.0
+        self._resolution = 1
         self._channel_num = 1
+        # (batch size, height, width) -> (batch size, height, width, 3) uint8
+        self._input_buffers = {}
+        # (batch size, feature shape, dtype) -> the output of extract_multiple_features
+        self._output_buffers = {}
 
     def _extract_feature(self, image):
         pass
 
+    def get_input_buffer(self, batch_size, height, width):
+        """
+        A persistent input batch of the given size, the callers write the images into its slots and pass it to
+        extract_multiple_features so that nothing is allocated per frame.
+        """
+        _key = (batch_size, height, width)
+        if _key not in self._input_buffers:
+            self._input_buffers[_key] = np.empty((batch_size, height, width, 3), dtype=np.uint8)
+        return self._input_buffers[_key]
+
+    def _get_output_buffer(self, batch_size, shape, dtype):
+        _key = (batch_size, shape, np.dtype(dtype))
+        if _key not in self._output_buffers:
+            self._output_buffers[_key] = np.empty((batch_size,) + shape, dtype=dtype)
+        return self._output_buffers[_key]
+
     def extract_multiple_features(self, input_images):
-        features = []
-        for image in input_images:
+        """
+        The features of each image are written into a reused output array of the batch shape, only valid until the
+        next call with the same shape.
+
+        :param input_images: list of images of the same size, or an ndarray from get_input_buffer
+        """
+        assert len(input_images) > 0
+        output_features = None
+        for i, image in enumerate(input_images):
             feature = self._extract_feature(image)
-            features.append(feature[np.newaxis, :, :, :])
-        assert len(features) > 0
+            if output_features is None:
+                output_features = self._get_output_buffer(len(input_images), feature.shape, feature.dtype)
+            output_features[i] = feature
+        return output_features
+
+    def close(self):
+        """
+        Releases the sessions of the extractor, it is not used any more.
+        """
+        pass
+
+    def extract_raw_features(self, input_images):
+        """
+        Features before any reduction fitted to the target, see reduce_features.
+        """
+        return self.extract_multiple_features(input_images)
 
-        conca_features = np.concatenate(features, axis=0)
-        return conca_features
+    def reduce_features(self, raw_features):
+        return raw_features
 
     def get_resolution(self):
         return self._resolution
@@ -35,8 +74,8 @@ class FeatureExtractor(object):
 class GrayExtractor(FeatureExtractor):
 
     def _extract_feature(self, input_image):
-        gray = cv2.cvtColor(input_image, cv2.COLOR_RGB2GRAY)
-        return gray
+        gray = cv2.cvtColor(input_image, cv2.COLOR_BGR2GRAY)
+        return gray[:, :, np.newaxis]
 
 
 class RgbExtractor(FeatureExtractor):
@@ -49,41 +88,70 @@ class RgbExtractor(FeatureExtractor):
         return input_image
 
 
-# class FhogExtractor(FeatureExtractor):
-#
-#     def __init__(self):
-#         super(FhogExtractor, self).__init__()
-#         self.cell_size = conv_reg_config.FhogCfg.CELL_SIZE
-#         self.bin_num = conv_reg_config.FhogCfg.BIN_NUM
-#         self._resolution = self.cell_size
-#         self._channel_num = 3*self.bin_num + 4
-#
-#     def _extract_feature(self, input_image):
-#         assert input_image.shape[2] == 3
-#         im = cv2.cvtColor(input_image, cv2.COLOR_BGR2GRAY)
-#         im = np.asarray(im, dtype=np.float32)
-#         return fhog_feature.extract(im, bin_size=self.cell_size, n_orients=self.bin_num)
-
-#
-# class FhogCnExtractor(FeatureExtractor):
-#
-#     def __init__(self):
-#         super(FhogCnExtractor, self).__init__()
-#         self.cell_size = conv_reg_config.FhogCnCfg.CELL_SIZE
-#         self.bin_num = conv_reg_config.FhogCnCfg.BIN_NUM
-#         self._resolution = self.cell_size
-#         self._channel_num = 3*self.bin_num + 4 + 10
-#
-#     def _extract_feature(self, input_image):
-#         assert input_image.shape[2] == 3
-#         im = cv2.cvtColor(input_image, cv2.COLOR_BGR2GRAY)
-#         im = np.asarray(im, dtype=np.float32)
-#         fhog = fhog_feature.extract(im, bin_size=self.cell_size, n_orients=self.bin_num)
-#
-#         rescaled_im = cv2.resize(input_image, (fhog.shape[1], fhog.shape[0]))
-#         cn = cn_feature.extract(rescaled_im)
-#
-#         res = np.concatenate((fhog, cn), axis=2)
-#         return res
+class FhogExtractor(FeatureExtractor):
+    """
+    FHOG features of fhog_feature. The images of a batch are extracted one after the other: the native extraction
+    holds the GIL, so threads would not run it in parallel.
+    """
 
+    def __init__(self):
+        super(FhogExtractor, self).__init__()
+        import fhog_feature
+        self._fhog_feature = fhog_feature
+        self.cell_size = conv_reg_config.FhogCfg.CELL_SIZE
+        self.bin_num = conv_reg_config.FhogCfg.BIN_NUM
+        self._resolution = self.cell_size
+        self._channel_num = 3*self.bin_num + 4
+
+    def _extract_fhog(self, input_image):
+        assert input_image.shape[2] == 3
+        im = cv2.cvtColor(input_image, cv2.COLOR_BGR2GRAY)
+        im = np.asarray(im, dtype=np.float32)
+        return self._fhog_feature.extract(im, bin_size=self.cell_size, n_orients=self.bin_num)
+
+    def _extract_feature(self, input_image):
+        return self._extract_fhog(input_image)
 
+
+class FhogCnExtractor(FhogExtractor):
+    """
+    FHOG features followed by the 10 color names of the FHOG cells. The color names of the whole batch are looked
+    up at once, either on the images resized to the cells or, with FhogCnCfg.CN_CELL_POOLING, averaged over the
+    pixels of each cell.
+    """
+
+    def __init__(self):
+        super(FhogCnExtractor, self).__init__()
+        import cn_feature
+        self._cn_feature = cn_feature
+        self.cell_size = conv_reg_config.FhogCnCfg.CELL_SIZE
+        self.bin_num = conv_reg_config.FhogCnCfg.BIN_NUM
+        self._resolution = self.cell_size
+        self._channel_num = 3*self.bin_num + 4 + 10
+        self._cn_cell_pooling = conv_reg_config.FhogCnCfg.CN_CELL_POOLING
+
+    def extract_multiple_features(self, input_images):
+        """
+        The FHOG and the color names are written into the two channel ranges of one reused output array.
+        """
+        assert len(input_images) > 0
+        _fhog_dim = 3*self.bin_num + 4
+        output_features = None
+        for i, image in enumerate(input_images):
+            fhog = self._extract_fhog(image)
+            if output_features is None:
+                output_features = self._get_output_buffer(len(input_images), fhog.shape[:2] + (self._channel_num,),
+                                                          np.float32)
+            output_features[i, :, :, :_fhog_dim] = fhog
+        _h, _w = output_features.shape[1:3]
+        if self._cn_cell_pooling:
+            # the cells are pooled from the top left corner, as the native fhog lays them out
+            _image_h, _image_w = input_images[0].shape[:2]
+            assert (_h, _w) == (_image_h // self.cell_size, _image_w // self.cell_size), \
+                'the fhog grid {} does not match the color name cells'.format((_h, _w))
+            _images = [image[:_h*self.cell_size, :_w*self.cell_size] for image in input_images]
+            output_features[:, :, :, _fhog_dim:] = self._cn_feature.extract_batch(_images, self.cell_size)
+        else:
+            output_features[:, :, :, _fhog_dim:] = self._cn_feature.extract_batch(
+                [cv2.resize(image, (_w, _h)) for image in input_images])
+        return output_features
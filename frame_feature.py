@@ -0,0 +1,73 @@
+
+import math
+
+import numpy as np
+import cv2
+
+from conv_reg_config import MultiTargetCfg
+
+
+def roi_align(feature_map, rect, output_h, output_w, scale_x, scale_y, resolution):
+    """
+    Bilinear sampling of a window of the frame feature map on an output_h x output_w grid, the same grid the
+    features of the window would have if it were cropped, resized and passed through the extractor on its own.
+    The cells outside the frame take the border values, like clip_image does for the crops.
+
+    :param feature_map: ndarray, (h, w, c), computed on the frame resized by (scale_x, scale_y)
+    :param rect: the window in the original frame
+    :param resolution: the stride of the extractor
+    :return: ndarray, (output_h, output_w, c)
+    """
+    # centers of the output cells in the original frame, then in the cells of the feature map
+    _xs = rect.x + (np.arange(output_w) + 0.5) * rect.w / float(output_w) - 0.5
+    _ys = rect.y + (np.arange(output_h) + 0.5) * rect.h / float(output_h) - 0.5
+    _xs = np.clip((_xs + 0.5) * scale_x / resolution - 0.5, 0, feature_map.shape[1] - 1)
+    _ys = np.clip((_ys + 0.5) * scale_y / resolution - 0.5, 0, feature_map.shape[0] - 1)
+
+    _x0 = np.floor(_xs).astype(np.int32)
+    _y0 = np.floor(_ys).astype(np.int32)
+    _x1 = np.minimum(_x0 + 1, feature_map.shape[1] - 1)
+    _y1 = np.minimum(_y0 + 1, feature_map.shape[0] - 1)
+    _wx = (_xs - _x0)[np.newaxis, :, np.newaxis].astype(np.float32)
+    _wy = (_ys - _y0)[:, np.newaxis, np.newaxis].astype(np.float32)
+
+    _top = (1 - _wx) * feature_map[np.ix_(_y0, _x0)] + _wx * feature_map[np.ix_(_y0, _x1)]
+    _bottom = (1 - _wx) * feature_map[np.ix_(_y1, _x0)] + _wx * feature_map[np.ix_(_y1, _x1)]
+    return (1 - _wy) * _top + _wy * _bottom
+
+
+class FrameFeatureMap(object):
+    """
+    Features of the last conv layer computed once over the whole frame, before any per-target reduction.
+
+    The frame scale is rounded to a power of FRAME_FEATURE_SCALE_STEP so that only a few network sizes are built.
+    """
+
+    def __init__(self, extractor):
+        self._extractor = extractor
+        self._scale_step = MultiTargetCfg.FRAME_FEATURE_SCALE_STEP
+        self._scale_x = None
+        self._scale_y = None
+        self.feature_map = None
+
+    def compute(self, image, scale):
+        _resolution = self._extractor.get_resolution()
+        _scale = self._scale_step ** round(math.log(scale, self._scale_step))
+        _w = max(1, int(round(image.shape[1] * _scale / _resolution))) * _resolution
+        _h = max(1, int(round(image.shape[0] * _scale / _resolution))) * _resolution
+        # the frame is resized to a multiple of the resolution, so the two axes have slightly different scales
+        self._scale_x = _w / float(image.shape[1])
+        self._scale_y = _h / float(image.shape[0])
+        self.feature_map = self._extractor.extract_raw_features([cv2.resize(image, (_w, _h))])[0]
+
+    def close(self):
+        self._extractor.close()
+
+    def sample(self, rects, output_h, output_w):
+        """
+        :return: ndarray, (len(rects), output_h, output_w, c), the raw features of each window
+        """
+        _resolution = self._extractor.get_resolution()
+        features = [roi_align(self.feature_map, rect, output_h, output_w, self._scale_x, self._scale_y, _resolution)
+                    for rect in rects]
+        return np.stack(features, axis=0)
@@ -0,0 +1,95 @@
+
+from conv_reg_config import ConvRegTrackerCfg
+
+
+DEFER_UPDATE = 'defer_update'
+DROP_SCALES = 'drop_scales'
+SHRINK_SEARCH = 'shrink_search'
+
+
+class FramePlan(object):
+
+    def __init__(self, scale_test_num, search_level, update_step_num, degradations):
+        self.scale_test_num = scale_test_num
+        self.search_level = search_level
+        self.update_step_num = update_step_num
+        self.degradations = degradations
+
+
+class LatencyBudget(object):
+    """
+    Plans each frame so that its predicted cost fits the deadline.
+
+    Stage costs are measured while tracking and kept as moving averages of unit costs: the localization cost
+    per searched pixel (feature extraction and regression of all the scales) and the update cost per step.
+    When the frame does not fit, the degradations are applied in this order: defer the update steps, drop
+    the scale candidates, then shrink the search window level by level. Deferred steps are run on the next
+    frames which have time left, they only leave the budget once record_update reports that they ran.
+    """
+
+    def __init__(self, deadline):
+        self._deadline = deadline
+        self._ema_ratio = ConvRegTrackerCfg.LATENCY_EMA_RATIO
+        self._localization_unit_cost = None
+        self._update_unit_cost = None
+        self._deferred_step_num = 0
+        # the deferred steps of the last plan, which record_update defers again when they did not run
+        self._planned_deferred_step_num = 0
+        self._max_deferred_step_num = ConvRegTrackerCfg.TRAIN_UPDATE_MAX_STEP_NUM
+
+    def _update_average(self, average, value):
+        if average is None:
+            return value
+        return (1 - self._ema_ratio) * average + self._ema_ratio * value
+
+    def record_localization(self, elapsed, searched_pixel_num):
+        self._localization_unit_cost = self._update_average(self._localization_unit_cost,
+                                                            elapsed / float(searched_pixel_num))
+
+    def record_update(self, elapsed, step_num):
+        """
+        Called after every planned frame, with the update steps which actually ran, 0 when the update is skipped.
+        """
+        if step_num > 0:
+            self._update_unit_cost = self._update_average(self._update_unit_cost, elapsed / float(step_num))
+        # the deferred steps are the first ones to run, the steps of the frame the update policy skipped are dropped
+        _unrun_step_num = max(0, self._planned_deferred_step_num - step_num)
+        self._deferred_step_num = min(self._deferred_step_num + _unrun_step_num, self._max_deferred_step_num)
+        self._planned_deferred_step_num = 0
+
+    def plan(self, scale_test_num, search_level, search_pixel_nums, update_step_num):
+        """
+        :param scale_test_num: the number of scales tested on each side of the current one
+        :param search_level: the current search level of the data provider
+        :param search_pixel_nums: the input pixel number of one search window, for each search level
+        :param update_step_num: the update steps wanted for this frame
+        :return: FramePlan
+        """
+        degradations = []
+        update_step_num += self._deferred_step_num
+        if self._localization_unit_cost is None:
+            self._planned_deferred_step_num, self._deferred_step_num = self._deferred_step_num, 0
+            return FramePlan(scale_test_num, search_level, update_step_num, degradations)
+
+        def _localization_cost():
+            return self._localization_unit_cost * (2 * scale_test_num + 1) * search_pixel_nums[search_level]
+
+        _update_unit_cost = self._update_unit_cost or 0.0
+        _left = self._deadline - _localization_cost()
+        if update_step_num > 0 and _update_unit_cost > 0 and update_step_num * _update_unit_cost > _left:
+            _step_num = max(0, int(_left / _update_unit_cost))
+            degradations.append(DEFER_UPDATE)
+            self._planned_deferred_step_num = min(self._deferred_step_num, _step_num)
+            self._deferred_step_num = min(update_step_num - _step_num, self._max_deferred_step_num)
+            update_step_num = _step_num
+        else:
+            self._planned_deferred_step_num, self._deferred_step_num = self._deferred_step_num, 0
+
+        if _localization_cost() > self._deadline and scale_test_num > 0:
+            scale_test_num = 0
+            degradations.append(DROP_SCALES)
+        while _localization_cost() > self._deadline and search_level > 0:
+            search_level -= 1
+            if SHRINK_SEARCH not in degradations:
+                degradations.append(SHRINK_SEARCH)
+        return FramePlan(scale_test_num, search_level, update_step_num, degradations)
@@ -0,0 +1,143 @@
+
+import math
+
+import numpy as np
+import cv2
+
+from conv_reg_config import MotionModelCfg
+from simgeo import Rect
+
+
+class MotionModel(object):
+    """
+    Predicts where the object is in the next frame, before the search window is cropped.
+    """
+
+    def reset(self, object_rect):
+        pass
+
+    def predict(self):
+        """
+        :return: (cx, cy, std_x, std_y), the predicted center and its standard deviation in pixels.
+                 std_x and std_y are None if the model has no estimate of its uncertainty.
+        """
+        pass
+
+    def correct(self, object_rect):
+        pass
+
+
+class StaticMotionModel(MotionModel):
+    """
+    The object is expected where it was in the last frame, which is the original behaviour of the tracker.
+    """
+
+    def __init__(self):
+        self._center = None
+
+    def reset(self, object_rect):
+        self._center = object_rect.get_center()
+
+    def predict(self):
+        return self._center[0], self._center[1], None, None
+
+    def correct(self, object_rect):
+        self._center = object_rect.get_center()
+
+
+class KalmanMotionModel(MotionModel):
+    """
+    Constant velocity Kalman filter on the object center, state: (cx, cy, vx, vy).
+
+    The noises are given relative to the object size, so that the filter behaves the same for small and
+    large objects.
+    """
+
+    def __init__(self):
+        self._process_noise = MotionModelCfg.KALMAN_PROCESS_NOISE
+        self._measurement_noise = MotionModelCfg.KALMAN_MEASUREMENT_NOISE
+        self._init_velocity_std = MotionModelCfg.KALMAN_INIT_VELOCITY_STD
+        self._transition = np.array([[1, 0, 1, 0],
+                                     [0, 1, 0, 1],
+                                     [0, 0, 1, 0],
+                                     [0, 0, 0, 1]], dtype=np.float64)
+        # white acceleration noise over one frame
+        self._noise_gain = np.array([[0.5, 0],
+                                     [0, 0.5],
+                                     [1, 0],
+                                     [0, 1]], dtype=np.float64)
+        self._state = None
+        self._covariance = None
+        self._object_size = None
+
+    def reset(self, object_rect):
+        cx, cy = object_rect.get_center()
+        self._object_size = math.sqrt(object_rect.w * object_rect.h)
+        _position_var = (self._measurement_noise * self._object_size) ** 2
+        _velocity_var = (self._init_velocity_std * self._object_size) ** 2
+        self._state = np.array([cx, cy, 0.0, 0.0])
+        self._covariance = np.diag([_position_var, _position_var, _velocity_var, _velocity_var])
+
+    def _get_measurement_covariance(self):
+        return np.eye(2) * (self._measurement_noise * self._object_size) ** 2
+
+    def predict(self):
+        _process_var = (self._process_noise * self._object_size) ** 2
+        self._state = self._transition.dot(self._state)
+        self._covariance = self._transition.dot(self._covariance).dot(self._transition.T) + \
+            _process_var * self._noise_gain.dot(self._noise_gain.T)
+        _innovation_cov = self._covariance[:2, :2] + self._get_measurement_covariance()
+        return self._state[0], self._state[1], math.sqrt(_innovation_cov[0, 0]), math.sqrt(_innovation_cov[1, 1])
+
+    def correct(self, object_rect):
+        _measurement = np.array(object_rect.get_center())
+        _innovation_cov = self._covariance[:2, :2] + self._get_measurement_covariance()
+        _gain = self._covariance[:, :2].dot(np.linalg.inv(_innovation_cov))
+        self._state = self._state + _gain.dot(_measurement - self._state[:2])
+        self._covariance = self._covariance - _gain.dot(self._covariance[:2, :])
+        self._object_size = math.sqrt(object_rect.w * object_rect.h)
+
+
+MOTION_MODELS = {
+    'static': StaticMotionModel,
+    'kalman': KalmanMotionModel,
+}
+
+
+class FlowPropagator(object):
+    """
+    Moves a box by the median sparse optical flow of the corners found inside it.
+
+    The points are checked forward and backward, and the propagation fails if too few of them survive.
+    """
+
+    def __init__(self):
+        self._max_corner_num = MotionModelCfg.FLOW_MAX_CORNER_NUM
+        self._min_point_num = MotionModelCfg.FLOW_MIN_POINT_NUM
+        self._max_fb_error = MotionModelCfg.FLOW_MAX_FB_ERROR
+
+    def propagate(self, last_gray, gray, object_rect):
+        """
+        :param last_gray: ndarray, the gray image where object_rect is known
+        :param gray: ndarray, the gray image to propagate object_rect to
+        :return: the propagated Rect, or None if the flow is not reliable
+        """
+        _image_rect = Rect(0, 0, gray.shape[1], gray.shape[0])
+        _rect = _image_rect.get_intersect_rect(object_rect)
+        if _rect.w <= 0 or _rect.h <= 0:
+            return None
+        _mask = np.zeros(last_gray.shape, dtype=np.uint8)
+        _mask[int(_rect.y):int(_rect.y+_rect.h), int(_rect.x):int(_rect.x+_rect.w)] = 255
+        points = cv2.goodFeaturesToTrack(last_gray, self._max_corner_num, 0.01, 3, mask=_mask)
+        if points is None or len(points) < self._min_point_num:
+            return None
+
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(last_gray, gray, points, None)
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, last_gray, next_points, None)
+        _fb_error = np.linalg.norm((points - back_points).reshape(-1, 2), axis=1)
+        _valid = (status.reshape(-1) == 1) & (back_status.reshape(-1) == 1) & (_fb_error < self._max_fb_error)
+        if np.count_nonzero(_valid) < self._min_point_num:
+            return None
+
+        dx, dy = np.median((next_points - points).reshape(-1, 2)[_valid], axis=0)
+        return Rect(round(object_rect.x + dx), round(object_rect.y + dy), object_rect.w, object_rect.h)
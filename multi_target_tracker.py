@@ -0,0 +1,80 @@
+
+from collections import OrderedDict
+
+import numpy as np
+
+from conv_reg_config import MultiTargetCfg
+from frame_feature import FrameFeatureMap
+from tracker import ConvRegTracker
+
+
+class MultiTargetTracker(object):
+    """
+    Tracks several targets in the same frames with one ConvRegTracker each.
+
+    When the search windows of all the targets cover more than FRAME_FEATURE_DENSITY_TH times the frame area,
+    the raw features are computed once over the whole frame at the median input scale of the targets, and each
+    target samples its search features from that map and reduces them with its own PCA. The cost of the frame
+    then no longer grows with the number of targets.
+
+    Each target keeps the id add_target gave it until it is removed, the ids of the removed targets are not reused.
+    """
+
+    def __init__(self):
+        # target id -> ConvRegTracker, in the order the targets were added
+        self.trackers = OrderedDict()
+        self._next_target_id = 0
+        self._density_th = MultiTargetCfg.FRAME_FEATURE_DENSITY_TH
+        self._frame_feature_map = None
+        # whether the last frame was tracked with the frame feature map
+        self.last_frame_feature = False
+
+    def add_target(self, image, init_rect):
+        """
+        :return: the id of the new target
+        """
+        trk = ConvRegTracker()
+        trk.init(image, init_rect)
+        target_id = self._next_target_id
+        self._next_target_id += 1
+        self.trackers[target_id] = trk
+        return target_id
+
+    def remove_target(self, target_id):
+        self.trackers.pop(target_id).close()
+
+    def close(self):
+        for trk in self.trackers.values():
+            trk.close()
+        self.trackers.clear()
+        if self._frame_feature_map is not None:
+            self._frame_feature_map.close()
+            self._frame_feature_map = None
+
+    def _get_search_density(self, image):
+        _search_area = sum(trk.data_provider.get_search_area(trk.get_last_rect()) for trk in self.trackers.values())
+        return _search_area / float(image.shape[0] * image.shape[1])
+
+    def track(self, image):
+        """
+        :return: OrderedDict, target id -> the predicted rect
+        """
+        self.last_frame_feature = bool(self.trackers) and self._get_search_density(image) > self._density_th
+        if self.last_frame_feature:
+            if self._frame_feature_map is None:
+                # a separate extractor, the ones of the targets hold their own PCA
+                _feature_extractor = next(iter(self.trackers.values())).feature_extractor
+                self._frame_feature_map = FrameFeatureMap(_feature_extractor())
+            _scale = np.median([trk.data_provider.get_input_scale(trk.get_last_rect())
+                                for trk in self.trackers.values()])
+            self._frame_feature_map.compute(image, _scale)
+
+        pred_rects = OrderedDict()
+        for target_id, trk in self.trackers.items():
+            if self.last_frame_feature:
+                trk.data_provider.frame_feature_map = self._frame_feature_map
+            try:
+                pred_rects[target_id] = trk.track(image)
+            finally:
+                trk.data_provider.frame_feature_map = None
+        return pred_rects
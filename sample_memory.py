@@ -0,0 +1,134 @@
+
+import heapq
+
+import numpy as np
+import cv2
+
+from conv_reg_config import SampleMemoryCfg
+
+
+class Float16Codec(object):
+
+    def fit(self, feature):
+        pass
+
+    def encode(self, feature):
+        return feature.astype(np.float16)
+
+    def decode(self, code):
+        return code.astype(np.float32)
+
+    def get_nbytes(self):
+        return 0
+
+
+class ProductQuantizationCodec(object):
+    """
+    Splits the channels into groups of PQ_SUBVECTOR_DIM and stores one uint8 centroid index per group and
+    per cell. The codebooks are trained once with k-means on the cells of the first feature map.
+    """
+
+    def __init__(self):
+        self._subvector_dim = SampleMemoryCfg.PQ_SUBVECTOR_DIM
+        self._centroid_num = SampleMemoryCfg.PQ_CENTROID_NUM
+        assert self._centroid_num <= 256
+        self._channel_num = None
+        self._codebooks = None
+
+    def _split(self, feature):
+        # (n, h, w, c) -> (subspace_num, n*h*w, subvector_dim), the channels are zero-padded to a multiple
+        _cells = feature.reshape(-1, self._channel_num).astype(np.float32)
+        _pad = -self._channel_num % self._subvector_dim
+        if _pad:
+            _cells = np.pad(_cells, ((0, 0), (0, _pad)), 'constant')
+        return _cells.reshape(_cells.shape[0], -1, self._subvector_dim).transpose(1, 0, 2)
+
+    def fit(self, feature):
+        self._channel_num = feature.shape[-1]
+        _criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+        self._codebooks = []
+        for _subvectors in self._split(feature):
+            _k = min(self._centroid_num, _subvectors.shape[0])
+            _, _, centers = cv2.kmeans(np.ascontiguousarray(_subvectors), _k, None, _criteria, 1,
+                                       cv2.KMEANS_PP_CENTERS)
+            self._codebooks.append(centers)
+
+    def encode(self, feature):
+        codes = []
+        for _subvectors, _codebook in zip(self._split(feature), self._codebooks):
+            _distances = (np.sum(_subvectors ** 2, axis=1)[:, np.newaxis] - 2 * _subvectors.dot(_codebook.T) +
+                          np.sum(_codebook ** 2, axis=1)[np.newaxis, :])
+            codes.append(np.argmin(_distances, axis=1).astype(np.uint8))
+        return np.stack(codes, axis=1).reshape(feature.shape[:3] + (-1,))
+
+    def decode(self, code):
+        _codes = code.reshape(-1, code.shape[-1])
+        _cells = np.concatenate([_codebook[_codes[:, i]] for i, _codebook in enumerate(self._codebooks)], axis=1)
+        return _cells[:, :self._channel_num].reshape(code.shape[:3] + (self._channel_num,))
+
+    def get_nbytes(self):
+        return sum(c.nbytes for c in self._codebooks) if self._codebooks else 0
+
+
+SAMPLE_CODECS = {
+    'float16': Float16Codec,
+    'pq': ProductQuantizationCodec,
+}
+
+
+class SampleMemory(object):
+    """
+    Long-term train samples kept within a fixed byte budget.
+
+    The samples are kept by weighted reservoir sampling (A-Res): each one gets the key u^(1/confidence) and the
+    samples with the smallest keys are dropped while the memory is over budget, so the kept set is a sample of
+    the whole stream weighted by the confidence and the memory stays flat however long the stream is.
+    """
+
+    def __init__(self, byte_budget=None, codec=None):
+        self._byte_budget = byte_budget or SampleMemoryCfg.BYTE_BUDGET
+        self._codec = SAMPLE_CODECS[codec or SampleMemoryCfg.CODEC]()
+        self._rng = np.random.RandomState(0)
+        self._fitted = False
+        # heap of (key, id, code, label)
+        self._heap = []
+        self._sample_id = 0
+        self._nbytes = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def get_nbytes(self):
+        return self._nbytes + self._codec.get_nbytes()
+
+    def add(self, feature, label, confidence):
+        """
+        :param feature: ndarray, (1, h, w, c)
+        :param label: ndarray, (1, rh, rw, 1)
+        """
+        if confidence <= 0:
+            return
+        if not self._fitted:
+            self._codec.fit(feature)
+            self._fitted = True
+        key = self._rng.uniform() ** (1.0 / confidence)
+        code = self._codec.encode(feature)
+        label = label.astype(np.float16)
+        heapq.heappush(self._heap, (key, self._sample_id, code, label))
+        self._sample_id += 1
+        self._nbytes += code.nbytes + label.nbytes
+        while self.get_nbytes() > self._byte_budget and self._heap:
+            _, _, _code, _label = heapq.heappop(self._heap)
+            self._nbytes -= _code.nbytes + _label.nbytes
+
+    def get_samples(self, sample_num):
+        """
+        :return: (features, labels), at most sample_num decoded samples drawn without replacement
+        """
+        sample_num = min(sample_num, len(self._heap))
+        features, labels = [], []
+        for i in self._rng.choice(len(self._heap), sample_num, replace=False):
+            _, _, code, label = self._heap[i]
+            features.append(self._codec.decode(code))
+            labels.append(label.astype(np.float32))
+        return features, labels
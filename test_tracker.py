@@ -1,6 +1,7 @@
 import os
 import json
 import math
+import time
 
 import cv2
 import numpy as np
@@ -157,8 +158,195 @@ def _test_statistic_motion():
     plt.waitforbuttonpress()
 
 
+def _test_regression_sweep(frame_num=30):
+    # every config is trained and updated on the ground truth path, so they all see the same samples
+    from conv_reg import ConvRegressionSweep, make_sweep_configs
+    from train_data_provider import TrainDataProvider
+    from conv_reg_config import ConvRegTrackerCfg
+
+    configs = make_sweep_configs(REGULARIZATION_COEF=[1e2, 1e3, 1e4],
+                                 LOSS_WEIGHT_B=[0.0, 1.0, 3.0],
+                                 LOSS_THRESHOLD=[0.0, 0.03])
+    seq = load_seq_infos(1)[0]
+    img_root = os.path.join(TestCfg.SEQUENCE_DIR, '../', seq.path)
+    init_rect = Rect(*seq.gtRect[0])
+    image = cv2.imread(os.path.join(img_root, seq.imgFormat.format(seq.startFrame)))
+
+    trk = tracker.ConvRegTracker()
+    provider = TrainDataProvider(trk.feature_extractor, init_rect)
+    search_rect, _, search_feature = provider.get_search_feature(image, init_rect)
+    obj_yi, obj_xi = provider.get_object_index_by_rect(search_rect, init_rect)
+    label = provider.get_label_response(obj_yi, obj_xi)[np.newaxis, :, :, np.newaxis]
+    sweep = ConvRegressionSweep(search_feature[np.newaxis], (provider.convolution_h, provider.convolution_w), configs)
+    sweep.train(search_feature[np.newaxis], label,
+                ConvRegTrackerCfg.TRAIN_INIT_MAX_STEP_NUM, ConvRegTrackerCfg.TRAIN_LOSS_TH)
+    init_steps = sweep.get_step_nums()
+
+    errors = np.zeros(len(configs))
+    last_rect = init_rect
+    frame_num = min(frame_num, len(seq.gtRect))
+    for fid in range(1, frame_num):
+        image = cv2.imread(os.path.join(img_root, seq.imgFormat.format(seq.startFrame + fid)))
+        gt_rect = Rect(*seq.gtRect[fid])
+        search_rect, _, search_feature = provider.get_search_feature(image, last_rect)
+        responses = sweep.inference(search_feature[np.newaxis])[0]
+        gt_cx, gt_cy = gt_rect.get_center()
+        for k in range(len(configs)):
+            pred_yi, pred_xi = np.unravel_index(np.argmax(responses[:, :, k]), responses.shape[:2])
+            pred_cx, pred_cy = provider.get_object_rect_by_index(search_rect, pred_yi, pred_xi).get_center()
+            errors[k] += math.sqrt((pred_cx - gt_cx)**2 + (pred_cy - gt_cy)**2)
+        obj_yi, obj_xi = provider.get_object_index_by_rect(search_rect, gt_rect)
+        label = provider.get_label_response(obj_yi, obj_xi)[np.newaxis, :, :, np.newaxis]
+        sweep.update(search_feature[np.newaxis], label,
+                     ConvRegTrackerCfg.TRAIN_UPDATE_STEP_NUM, ConvRegTrackerCfg.TRAIN_LOSS_TH)
+        last_rect = gt_rect
+    errors /= max(1, frame_num - 1)
+
+    for k in np.argsort(errors):
+        print('center error:{:8.3f}, init steps:{:5d}, config: {}'.format(errors[k], init_steps[k], configs[k]))
+    sweep.close()
+
+
+def _load_seq_images(seq, frame_num):
+    img_root = os.path.join(TestCfg.SEQUENCE_DIR, '../', seq.path)
+    frame_num = min(frame_num, len(seq.gtRect))
+    return [cv2.imread(os.path.join(img_root, seq.imgFormat.format(seq.startFrame + fid)))
+            for fid in range(frame_num)]
+
+
+def _run_tracking(trk, images, gt_rects):
+    """
+    Tracks the frames after the first one, the tracker is initialised on the first one.
+
+    :return: (center error sum, overlap sum, frame num, seconds)
+    """
+    error, overlap = 0.0, 0.0
+    start = time.time()
+    for fid in range(1, len(images)):
+        pred_rect = trk.track(images[fid])
+        gt_rect = Rect(*gt_rects[fid])
+        error += math.sqrt((pred_rect.get_center()[0] - gt_rect.get_center()[0])**2 +
+                           (pred_rect.get_center()[1] - gt_rect.get_center()[1])**2)
+        overlap += pred_rect.get_intersect_ratio(gt_rect)
+    return error, overlap, len(images) - 1, time.time() - start
+
+
+def _test_filter_structures(frame_num=100):
+    # tracking accuracy against speed of every filter structure, on the first sequence
+    from conv_reg_config import ConvRegressionCfg
+    from conv_reg_filter import FILTER_STRUCTURES
+
+    seq = load_seq_infos(1)[0]
+    images = _load_seq_images(seq, frame_num)
+    _structure = ConvRegressionCfg.FILTER_STRUCTURE
+    try:
+        for structure in FILTER_STRUCTURES:
+            ConvRegressionCfg.FILTER_STRUCTURE = structure
+            trk = tracker.ConvRegTracker()
+            trk.init(images[0], Rect(*seq.gtRect[0]))
+            error, overlap, count, elapsed = _run_tracking(trk, images, seq.gtRect)
+            print('{:10s}: center error:{:8.3f}, overlap:{:6.3f}, fps:{:6.2f}'.format(
+                structure, error / max(1, count), overlap / max(1, count), count / elapsed))
+            trk.conv_regression.close()
+    finally:
+        ConvRegressionCfg.FILTER_STRUCTURE = _structure
+
+
+def _test_keyframe_fallback():
+    # a failed flow propagation must not advance the kalman state, track() then predicts it exactly once
+    from motion_model import KalmanMotionModel
+
+    class _FailingPropagator(object):
+        def propagate(self, last_gray, gray, object_rect):
+            return None
+
+    trk = tracker.ConvRegTracker()
+    trk.motion_model = KalmanMotionModel()
+    init_rect = Rect(50, 40, 20, 30)
+    trk.motion_model.reset(init_rect)
+    trk.motion_model.predict()
+    trk.motion_model.correct(Rect(53, 41, 20, 30))
+    trk._last_obj_rect = Rect(53, 41, 20, 30)
+    trk._keyframe_propagator = 'flow'
+    trk._flow_propagator = _FailingPropagator()
+    _state = trk.motion_model._state.copy()
+    _covariance = trk.motion_model._covariance.copy()
+    gray = np.zeros((120, 160), dtype=np.uint8)
+    assert trk._propagate(gray, gray) is None
+    assert np.array_equal(trk.motion_model._state, _state)
+    assert np.array_equal(trk.motion_model._covariance, _covariance)
+
+    # the fallback keyframe then advances the state by one step only
+    _expected = KalmanMotionModel()
+    _expected.reset(init_rect)
+    _expected.predict()
+    _expected.correct(Rect(53, 41, 20, 30))
+    _expected.predict()
+    trk.motion_model.predict()
+    assert np.allclose(trk.motion_model._state, _expected._state)
+    assert np.allclose(trk.motion_model._covariance, _expected._covariance)
+    print('keyframe fallback: the kalman state is advanced once')
+
+
+def _calibrate_int8(seq_num=3, frame_num=100, frame_gap=10):
+    # the int8 activation ranges from the ground truth search windows of the first sequences
+    from conv_reg_config import TrainDataCfg
+    from train_data_provider import TrainDataProvider
+    import vgg_feature_extractor
+
+    trk = tracker.ConvRegTracker()
+    ranges = {}
+    for seq in load_seq_infos(seq_num):
+        images = _load_seq_images(seq, frame_num)
+        provider = TrainDataProvider(trk.feature_extractor, Rect(*seq.gtRect[0]))
+        batch = [provider.get_search_input(images[fid], Rect(*seq.gtRect[fid]))[2]
+                 for fid in range(0, len(images), frame_gap)]
+        for k, v in provider.extractor.calibrate_activation_ranges([batch]).items():
+            ranges[k] = max(ranges.get(k, 0.0), v)
+    vgg_feature_extractor.save_activation_ranges(ranges)
+    print('{:d} activation ranges saved to {:s}'.format(len(ranges), TrainDataCfg.VGG_CALIBRATION_PATH))
+
+
+def _test_precision(seq_num=3, frame_num=100):
+    # feature error and tracking accuracy of every precision against float32, run _calibrate_int8 first
+    from conv_reg_config import TrainDataCfg
+    from vgg_model import PRECISIONS
+
+    seqs = load_seq_infos(seq_num)
+    _precision = TrainDataCfg.VGG_PRECISION
+    try:
+        baseline_features = {}
+        for precision in PRECISIONS:
+            TrainDataCfg.VGG_PRECISION = precision
+            feature_error, error, overlap, elapsed, count = 0.0, 0.0, 0.0, 0.0, 0
+            for seq in seqs:
+                images = _load_seq_images(seq, frame_num)
+                trk = tracker.ConvRegTracker()
+                trk.init(images[0], Rect(*seq.gtRect[0]))
+                # the raw features of the first search window, the pca of each run is different
+                _, _, _input = trk.data_provider.get_search_input(images[0], Rect(*seq.gtRect[0]))
+                _features = trk.data_provider.extractor.extract_raw_features([_input])
+                if precision == 'float32':
+                    baseline_features[seq.name] = _features
+                _baseline = baseline_features[seq.name]
+                feature_error += np.linalg.norm(_features - _baseline) / np.linalg.norm(_baseline)
+                _error, _overlap, _count, _elapsed = _run_tracking(trk, images, seq.gtRect)
+                error, overlap, count, elapsed = error + _error, overlap + _overlap, count + _count, elapsed + _elapsed
+                trk.conv_regression.close()
+            print('{:8s}: relative feature error:{:.4e}, center error:{:8.3f}, overlap:{:6.3f}, fps:{:6.2f}'.format(
+                precision, feature_error / len(seqs), error / max(1, count), overlap / max(1, count),
+                count / elapsed))
+    finally:
+        TrainDataCfg.VGG_PRECISION = _precision
+
+
 if __name__ == '__main__':
     _test_tracker()
     # _test_init_size()
     # _test_traindata_provider()
     # _test_statistic_motion()
+    # _test_regression_sweep()
+    # _test_filter_structures()
+    # _test_keyframe_fallback()
+    # _calibrate_int8()
+    # _test_precision()
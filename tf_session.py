@@ -0,0 +1,102 @@
+from __future__ import print_function
+import contextlib
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from conv_reg_config import BasicCfg
+
+
+# the stateless forward ops marked for XLA, the variables, their updates and the gradients stay with TF
+_JIT_OPS = {'Conv2D', 'DepthwiseConv2dNative', 'BiasAdd', 'Add', 'AddV2', 'Sub', 'Mul', 'Relu', 'MaxPool',
+            'Cast', 'FakeQuantWithMinMaxArgs', 'Sum', 'Reshape', 'ExpandDims'}
+
+
+@contextlib.contextmanager
+def _no_scope():
+    yield
+
+
+def jit_scope(xla_jit=None):
+    """
+    Context in which the forward ops built are marked for the XLA JIT, when xla_jit is set (BasicCfg.XLA_JIT for
+    None).
+
+    The ops are marked explicitly because the global jit level of the session config only clusters GPU ops in TF1,
+    unless the process is started with TF_XLA_FLAGS=--tf_xla_cpu_global_jit. A cluster is compiled for each input
+    shape it meets and kept by the session, so the compile time is paid once per shape: once per pooled
+    VggExtractor network, and once per search window size for ConvRegression. The motion-gated windows of
+    inference_window change size from frame to frame, so they are better left without it.
+    """
+    if xla_jit is None:
+        xla_jit = BasicCfg.XLA_JIT
+    if not xla_jit:
+        return _no_scope()
+    from tensorflow.contrib.compiler import jit
+    return jit.experimental_jit_scope(compile_ops=lambda node_def: node_def.op in _JIT_OPS)
+
+
+def create_session(graph):
+    """
+    The session of every graph of the tracker.
+    """
+    return tf.Session(graph=graph)
+
+
+def _time_calls(func, repeat):
+    start = time.time()
+    func()
+    first_time = time.time() - start
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return first_time, (time.time() - start) / repeat
+
+
+def _benchmark_xla(repeat=20, batch_size=3):
+    # first call (build and compile) and steady state of each network depth, without and with XLA
+    import vgg_feature_extractor
+    from conv_reg import ConvRegression
+
+    _xla_jit = BasicCfg.XLA_JIT
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 256, (80, 144, 3)).astype(np.uint8) for _ in range(batch_size)]
+    try:
+        for extractor_class in [vgg_feature_extractor.VggL1Extractor, vgg_feature_extractor.VggL2Extractor,
+                                vgg_feature_extractor.VggL3Extractor, vgg_feature_extractor.VggL4Extractor,
+                                vgg_feature_extractor.VggL5Extractor]:
+            line = '{:6s} |'.format(extractor_class._name)
+            steady_times = []
+            for xla_jit in [False, True]:
+                BasicCfg.XLA_JIT = xla_jit
+                # the first call builds the network, not a pooled one
+                vgg_feature_extractor.VggExtractor.clear_network_pool()
+                extractor = extractor_class()
+                first_time, steady_time = _time_calls(lambda: extractor.extract_multiple_features(images), repeat)
+                steady_times.append(steady_time)
+                line += ' {:s}: first {:6.2f}s, {:8.2f}ms |'.format('xla' if xla_jit else 'tf', first_time,
+                                                                    steady_time * 1000)
+                if extractor_class is vgg_feature_extractor.VggL4Extractor:
+                    features = extractor.extract_multiple_features(images)
+                extractor.close()
+            print(line + ' speedup {:.2f}x'.format(steady_times[0] / steady_times[1]))
+
+        # the regression on the VggL4 features
+        line = '{:6s} |'.format('ConvReg')
+        steady_times = []
+        for xla_jit in [False, True]:
+            BasicCfg.XLA_JIT = xla_jit
+            regression = ConvRegression(features[:1], (features.shape[1] // 5, features.shape[2] // 9))
+            first_time, steady_time = _time_calls(lambda: regression.inference(features), repeat)
+            steady_times.append(steady_time)
+            line += ' {:s}: first {:6.2f}s, {:8.2f}ms |'.format('xla' if xla_jit else 'tf', first_time,
+                                                                steady_time * 1000)
+            regression.close()
+        print(line + ' speedup {:.2f}x'.format(steady_times[0] / steady_times[1]))
+    finally:
+        BasicCfg.XLA_JIT = _xla_jit
+
+
+if __name__ == '__main__':
+    _benchmark_xla()
@@ -1,15 +1,25 @@
 
+import math
+import time
 
 import numpy as np
+import cv2
 
 
-from train_data_provider import TrainData, TrainDataProvider
-from conv_reg_config import ConvRegTrackerCfg
+from train_data_provider import TrainData, TrainDataProvider, choose_convolution_size_th
+from conv_reg_config import ConvRegTrackerCfg, MotionModelCfg, SampleMemoryCfg, TrainDataCfg
 from conv_reg import ConvRegression
+from motion_model import MOTION_MODELS, FlowPropagator
+from latency_budget import LatencyBudget
+from update_policy import UPDATE_POLICIES
+from conv_reg_numpy import prefer_fused
+from sample_memory import SampleMemory
+from simgeo import Rect
 import display
 # import feature_extractor
 # import cnn_feature_extractor
 import vgg_feature_extractor
+import feature_backends
 
 
 class TrackInfo(object):
@@ -20,12 +30,71 @@ class TrackInfo(object):
         self.obj_rect = obj_rect
 
 
+def merge_train_pairs(train_features, train_labels):
+    """
+    Concatenate train pairs along the batch axis. Pairs from search windows of different sizes are
+    center-cropped to the smallest window, the features and the labels with the same offsets.
+    """
+    _min_h = min(f.shape[1] for f in train_features)
+    _min_w = min(f.shape[2] for f in train_features)
+    _label_h = min(l.shape[1] for l in train_labels)
+    _label_w = min(l.shape[2] for l in train_labels)
+    _cropped_features = []
+    _cropped_labels = []
+    for feature, label in zip(train_features, train_labels):
+        _y0 = (feature.shape[1] - _min_h) // 2
+        _x0 = (feature.shape[2] - _min_w) // 2
+        _cropped_features.append(feature[:, _y0:_y0+_min_h, _x0:_x0+_min_w, :])
+        _cropped_labels.append(label[:, _y0:_y0+_label_h, _x0:_x0+_label_w, :])
+    merged_features = np.concatenate(_cropped_features, axis=0)
+    merged_labels = np.concatenate(_cropped_labels, axis=0)
+    return merged_features, merged_labels
+
+
+class _TrainFeatureRing(object):
+    """
+    Preallocated slots the features of the train history are copied into, the features of the extractors are
+    views of output buffers reused on the next frame. The slot of a frame is written again slot_num frames later.
+    """
+
+    def __init__(self, slot_num):
+        self._slots = [None] * slot_num
+
+    def store(self, frame_index, train_pair):
+        """
+        :return: the train pair with its feature in the slot of the frame
+        """
+        if train_pair is None:
+            return None
+        feature = train_pair[0]
+        _index = frame_index % len(self._slots)
+        _slot = self._slots[_index]
+        if _slot is None or _slot.shape != feature.shape or _slot.dtype != feature.dtype:
+            # only when the search window changes size
+            _slot = self._slots[_index] = np.empty_like(feature)
+        np.copyto(_slot, feature)
+        return (_slot,) + tuple(train_pair[1:])
+
+
 class ConvRegTracker(object):
 
     def __init__(self):
         self.data_provider = None
         self.conv_regression = None
-        self.feature_extractor = vgg_feature_extractor.VggL4Extractor
+        self._adaptive_depth = ConvRegTrackerCfg.ADAPTIVE_DEPTH
+        self._shallow_confidence_th = ConvRegTrackerCfg.SHALLOW_CONFIDENCE_TH
+        self._feature_backend = ConvRegTrackerCfg.FEATURE_BACKEND
+        if self._adaptive_depth:
+            self.feature_extractor = vgg_feature_extractor.AdaptiveDepthExtractor
+        elif self._feature_backend != 'auto':
+            self.feature_extractor = feature_backends.get_extractor_class(self._feature_backend)
+        else:
+            # chosen for the target at init
+            self.feature_extractor = None
+        # the regression on the shallow features in the adaptive depth mode
+        self._shallow_regression = None
+        # the depth the last frame was localized with
+        self.last_depth = 'deep'
         self._train_init_max_step_num = ConvRegTrackerCfg.TRAIN_INIT_MAX_STEP_NUM
         self._train_update_max_step_num = ConvRegTrackerCfg.TRAIN_UPDATE_MAX_STEP_NUM
         self._train_loss_th = ConvRegTrackerCfg.TRAIN_LOSS_TH
@@ -34,36 +103,126 @@ class ConvRegTracker(object):
         self._train_update_step = ConvRegTrackerCfg.TRAIN_UPDATE_STEP_NUM
         self._train_data_history_length = ConvRegTrackerCfg.TRAIN_DATA_HISTORY_LENGTH
         self._train_data_gap = ConvRegTrackerCfg.TRAIN_DATA_GAP
+        # the pairs of the history are dropped history_length * gap + 1 frames later, one more slot keeps the
+        # dropped one until the sample memory has taken it
+        _slot_num = self._train_data_history_length * self._train_data_gap + 2
+        self._train_feature_ring = _TrainFeatureRing(_slot_num)
+        self._shallow_train_feature_ring = _TrainFeatureRing(_slot_num)
+        self._multigrid_init = ConvRegTrackerCfg.MULTIGRID_INIT
+        self._motion_gate_eps = ConvRegTrackerCfg.MOTION_GATE_EPS
+        self._motion_model_name = MotionModelCfg.MODEL
+        self.motion_model = None
+        self._frame_deadline = ConvRegTrackerCfg.FRAME_DEADLINE
+        self.latency_budget = None
+        # the degradations applied to the last frame to meet the deadline
+        self.last_degradations = []
+        self._keyframe_mode = ConvRegTrackerCfg.KEYFRAME_MODE
+        self._keyframe_propagator = ConvRegTrackerCfg.KEYFRAME_PROPAGATOR
+        self._keyframe_max_interval = ConvRegTrackerCfg.KEYFRAME_MAX_INTERVAL
+        self._keyframe_confidence_th = ConvRegTrackerCfg.KEYFRAME_CONFIDENCE_TH
+        self._keyframe_displacement_th = ConvRegTrackerCfg.KEYFRAME_DISPLACEMENT_TH
+        self._flow_propagator = FlowPropagator()
+        self._keyframe_interval = 1
+        self._frames_since_keyframe = 0
+        self._last_gray = None
+        self._static_scene_th = ConvRegTrackerCfg.STATIC_SCENE_TH
+        self.update_policy = UPDATE_POLICIES[ConvRegTrackerCfg.UPDATE_POLICY]()
+        self._fused_pca_inference = ConvRegTrackerCfg.FUSED_PCA_INFERENCE
+        self._channel_selection_num = TrainDataCfg.CHANNEL_SELECTION_NUM
+        self._sample_memory_enable = SampleMemoryCfg.ENABLE
+        self._sample_memory_sample_num = SampleMemoryCfg.SAMPLE_NUM
+        # the samples leaving the recent history are kept here
+        self.sample_memory = None
+        # thumbnail of the search window around the last tracked object, from the last fully tracked frame
+        self._reference_thumbnail = None
         self._last_obj_rect = None
 
         self._frame_no = None
         self._train_pair_history = list()
+        self._shallow_train_pair_history = list()
 
-    def init(self, image, init_rect):
+    def close(self):
+        """
+        Releases the sessions of the regressions and the extractor of the target, init starts a new one.
+        """
         if self.conv_regression is not None:
             self.conv_regression.close()
             self.conv_regression = None
+        if self._shallow_regression is not None:
+            self._shallow_regression.close()
+            self._shallow_regression = None
+        if self.data_provider is not None:
+            self.data_provider.close()
+            self.data_provider = None
+
+    def init(self, image, init_rect):
+        self.close()
 
         self._frame_no = 0
         self._train_pair_history = list()
-
-        self.data_provider = TrainDataProvider(self.feature_extractor, init_rect)
+        self._shallow_train_pair_history = list()
+
+        _convolution_size_th = None
+        if TrainDataCfg.CONVOLUTION_SIZE_POLICY == 'target':
+            _convolution_size_th = choose_convolution_size_th(image, init_rect)
+        # the latency budget may shrink the search window, so it needs all the search levels
+        if self._feature_backend == 'auto' and not self._adaptive_depth:
+            self.data_provider = self._select_feature_backend(image, init_rect, _convolution_size_th)
+            self.feature_extractor = self.data_provider.extractor_class
+        else:
+            self.data_provider = TrainDataProvider(self.feature_extractor, init_rect,
+                                                   multi_level_search=self._frame_deadline > 0,
+                                                   convolution_size_th=_convolution_size_th)
+        self.latency_budget = LatencyBudget(self._frame_deadline) if self._frame_deadline > 0 else None
+        self.last_degradations = []
+        if self._channel_selection_num > 0:
+            self.data_provider.select_channels(image, init_rect, self._channel_selection_num)
         search_rect, search_bgr, search_feature = self.data_provider.get_search_feature(image,
                                                                                         init_rect)
+        if self._adaptive_depth:
+            shallow_feature = self.data_provider.extractor.get_last_shallow_features()[0]
 
         obj_yi, obj_xi = self.data_provider.get_object_index_by_rect(search_rect, init_rect)
         label_respponse = self.data_provider.get_label_response(obj_yi, obj_xi)
+        if len(self.data_provider.search_ratios) > 1:
+            self.data_provider.precompile_search_levels(2 * self.data_provider.scale_test_num + 1)
 
         conv_size = (self.data_provider.convolution_h, self.data_provider.convolution_w)
         self.conv_regression = ConvRegression(search_feature[np.newaxis, :, :, :], conv_size)
-        self.conv_regression.train(search_feature[np.newaxis, :, :, :],
-                                   label_respponse[np.newaxis, :, :, np.newaxis],
-                                   self._train_init_max_step_num,
-                                   self._train_loss_th)
+        if self._multigrid_init:
+            self.conv_regression.train_coarse_to_fine(search_feature[np.newaxis, :, :, :],
+                                                      label_respponse[np.newaxis, :, :, np.newaxis],
+                                                      self._train_init_max_step_num,
+                                                      self._train_loss_th)
+        else:
+            self.conv_regression.train(search_feature[np.newaxis, :, :, :],
+                                       label_respponse[np.newaxis, :, :, np.newaxis],
+                                       self._train_init_max_step_num,
+                                       self._train_loss_th)
+        if self._adaptive_depth:
+            self._shallow_regression = ConvRegression(shallow_feature[np.newaxis, :, :, :], conv_size)
+            self._shallow_regression.train(shallow_feature[np.newaxis, :, :, :],
+                                           label_respponse[np.newaxis, :, :, np.newaxis],
+                                           self._train_init_max_step_num,
+                                           self._train_loss_th)
+            self._shallow_train_pair_history.append((shallow_feature[np.newaxis, :, :, :],
+                                                     label_respponse[np.newaxis, :, :, np.newaxis],
+                                                     1.0))
 
         self._last_obj_rect = init_rect
-
-        self._train_pair_history.append((search_feature[np.newaxis,:,:,:],
+        self.motion_model = MOTION_MODELS[self._motion_model_name]()
+        self.motion_model.reset(init_rect)
+        self.update_policy.reset()
+        self.sample_memory = SampleMemory() if self._sample_memory_enable else None
+        self._keyframe_interval = 1
+        self._frames_since_keyframe = 0
+        if self._keyframe_mode:
+            self._last_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if self._static_scene_th > 0:
+            self._reference_thumbnail = self.data_provider.get_search_thumbnail(image, init_rect)
+
+        # the features may be a view of a reused output buffer of the extractor
+        self._train_pair_history.append((search_feature[np.newaxis,:,:,:].copy(),
                                          label_respponse[np.newaxis,:,:,np.newaxis],
                                          1.0))
         # patch_rect = init_rect.get_copy().scale_from_center(self.data_provider.search_patch_ratio,
@@ -96,22 +255,95 @@ class ConvRegTracker(object):
 
     def track(self, image):
         self._frame_no += 1
-        last_rect = self._last_obj_rect
+        if self._keyframe_mode:
+            _last_gray, self._last_gray = self._last_gray, cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            if self._frames_since_keyframe + 1 < self._keyframe_interval:
+                pred_obj_rect = self._propagate(_last_gray, self._last_gray)
+                if pred_obj_rect is not None:
+                    self._frames_since_keyframe += 1
+                    self.last_degradations = []
+                    return pred_obj_rect
+            self._frames_since_keyframe = 0
 
+        last_rect = self._last_obj_rect
+        if self._static_scene_th > 0 and self._is_static(image, last_rect):
+            # nothing changed around the object, the last prediction still holds and the model is not updated
+            self._append_train_pair(None)
+            self.motion_model.predict()
+            self.motion_model.correct(last_rect)
+            self.last_degradations = []
+            return last_rect
+
+        # the search window is centered on the position predicted by the motion model
+        pred_cx, pred_cy, pred_std_x, pred_std_y = self.motion_model.predict()
+        center_rect = Rect(round(pred_cx - (last_rect.w - 1) / 2.0), round(pred_cy - (last_rect.h - 1) / 2.0),
+                           last_rect.w, last_rect.h)
+
+        search_level = self.data_provider.search_level
+        scale_test_num = self.data_provider.scale_test_num
+        update_step_num = self._train_update_step
+        if self.latency_budget:
+            plan = self.latency_budget.plan(scale_test_num, search_level,
+                                            self.data_provider.get_search_pixel_nums(), update_step_num)
+            self.data_provider.set_search_level(plan.search_level)
+            scale_test_num, update_step_num = plan.scale_test_num, plan.update_step_num
+            self.last_degradations = plan.degradations
+        _localization_start = time.time()
+
+        if self._adaptive_depth:
+            self.data_provider.extractor.set_depth('shallow')
+        # the raw features are fetched when the pca may be folded into the regression filter
+        _extractor = self.data_provider.extractor
+        _pca = getattr(_extractor, 'pca', None) if self._fused_pca_inference else None
         search_rect_list, search_bgr_list, search_features, scaled_object_rects = \
-            self.data_provider.get_scaled_search_feature(image, last_rect)
-
-        obj_yi, obj_xi = self.data_provider.get_object_index_by_rect(search_rect_list[0], last_rect)
-        motion_respponse = self.data_provider.get_motion_response(obj_yi, obj_xi)
-
-        pred_response = self.conv_regression.inference(search_features)[:, :, :, 0]
+            self.data_provider.get_scaled_search_feature(image, center_rect, scale_test_num, raw=_pca is not None)
+        raw_features = None
+        if _pca is not None:
+            raw_features, search_features = search_features, None
+
+        obj_yi, obj_xi = self.data_provider.get_object_index_by_rect(search_rect_list[0], center_rect)
+        motion_sigma_y, motion_sigma_x = self.data_provider.get_motion_sigma(search_rect_list[0],
+                                                                             pred_std_y, pred_std_x)
+        motion_respponse = self.data_provider.get_motion_response(obj_yi, obj_xi, motion_sigma_y, motion_sigma_x)
+
+        if self._motion_gate_eps > 0:
+            # the motion response is below eps outside of the window, so the regression is skipped there
+            motion_window = self.data_provider.get_motion_window(obj_yi, obj_xi, self._motion_gate_eps,
+                                                                 motion_sigma_y, motion_sigma_x)
+        else:
+            motion_window = (0, motion_respponse.shape[0], 0, motion_respponse.shape[1])
+        _window_size = (motion_window[1] - motion_window[0], motion_window[3] - motion_window[2])
+        if raw_features is not None and prefer_fused(raw_features.shape, self.conv_regression.get_conv_size(),
+                                                     _extractor.get_channel_num(), _window_size):
+            pred_response = self.conv_regression.inference_fused(raw_features, _pca, motion_window)[:, :, :, 0]
+        else:
+            if raw_features is not None:
+                search_features = _extractor.reduce_features(raw_features)
+            _regression = self._shallow_regression if self._adaptive_depth else self.conv_regression
+            pred_response = self._infer(_regression, search_features, motion_window)
         overall_response = motion_respponse[np.newaxis, :, :] * pred_response
 
+        shallow_features = None
+        self.last_depth = 'deep'
+        if self._adaptive_depth:
+            shallow_features = search_features
+            self.last_depth = 'shallow'
+            if np.max(overall_response) < self._shallow_confidence_th:
+                # the deep features of the same windows are computed from the trunk output already there
+                search_features = _extractor.extend_last_features()
+                pred_response = self._infer(self.conv_regression, search_features, motion_window)
+                overall_response = motion_respponse[np.newaxis, :, :] * pred_response
+                self.last_depth = 'deep'
+
         tmp = np.unravel_index([np.argmax(overall_response), ], overall_response.shape)
         pred_scale_index, pred_index_y, pred_index_x = tmp[0][0], tmp[1][0], tmp[2][0]
 
         pred_search_rect = search_rect_list[pred_scale_index]
         pred_obj_rect = self.data_provider.get_object_rect_by_index(pred_search_rect, pred_index_y, pred_index_x)
+        if self.latency_budget:
+            _searched_pixel_num = len(search_rect_list) * self.data_provider.get_search_pixel_nums()[
+                self.data_provider.search_level]
+            self.latency_budget.record_localization(time.time() - _localization_start, _searched_pixel_num)
 
         if self._show_final_response_fid:
             display.show_map(overall_response[pred_scale_index], self._show_final_response_fid, 'Final prediction map')
@@ -120,43 +352,162 @@ class ConvRegTracker(object):
         label_response = self.data_provider.get_label_response(pred_index_y, pred_index_x)
 
         pred_confidence = min(1.0, overall_response[pred_scale_index, pred_index_y, pred_index_x])
-        self._train_pair_history.append((search_features[pred_scale_index,:,:,:][np.newaxis,:,:,:],
-                                         label_response[np.newaxis,:,:,np.newaxis],
-                                         pred_confidence))
+        _label = label_response[np.newaxis,:,:,np.newaxis]
+        if search_features is None:
+            # only the scale kept for the training is projected
+            pred_feature = _extractor.reduce_features(raw_features[pred_scale_index:pred_scale_index+1])
+        else:
+            pred_feature = search_features[pred_scale_index,:,:,:][np.newaxis,:,:,:]
+        if self.last_depth == 'shallow':
+            # the deep model only learns from the frames where the deep features are computed
+            self._append_train_pair(None, (pred_feature, _label, pred_confidence))
+        elif shallow_features is not None:
+            self._append_train_pair((pred_feature, _label, pred_confidence),
+                                    (shallow_features[pred_scale_index:pred_scale_index+1], _label, pred_confidence))
+        else:
+            self._append_train_pair((pred_feature, _label, pred_confidence))
+        if self._keyframe_mode:
+            self._update_keyframe_interval(last_rect, pred_obj_rect, pred_confidence)
+        # a search window shrunk for the deadline only holds for this frame
+        self.data_provider.set_search_level(search_level)
+        self.data_provider.update_search_level(pred_index_y - obj_yi, pred_index_x - obj_xi, pred_confidence)
 
         # print('\tpred_confidence: {:6.3f}'.format(pred_confidence))
-        if pred_confidence >= self._update_confidence_th:
-            merged_features, merged_labels = self._get_history_train_data()
-            self.conv_regression.update(merged_features,
-                                        merged_labels,
-                                        self._train_update_step,
-                                        self._train_loss_th)
+        _y0, _y1, _x0, _x1 = motion_window
+        update_step_num = self.update_policy.get_update_step_num(pred_response[pred_scale_index, _y0:_y1, _x0:_x1],
+                                                                 pred_confidence, update_step_num)
+        _update_start = time.time()
+        if update_step_num > 0:
+            if self.last_depth == 'deep':
+                merged_features, merged_labels = self._get_history_train_data()
+                self.conv_regression.update(merged_features,
+                                            merged_labels,
+                                            update_step_num,
+                                            self._train_loss_th)
+            if self._adaptive_depth:
+                merged_features, merged_labels = self._get_history_train_data(self._shallow_train_pair_history)
+                self._shallow_regression.update(merged_features,
+                                                merged_labels,
+                                                update_step_num,
+                                                self._train_loss_th)
+        if self.latency_budget:
+            # the planned steps the update policy skipped are kept deferred
+            self.latency_budget.record_update(time.time() - _update_start, update_step_num)
 
         self._last_obj_rect = pred_obj_rect
+        self.motion_model.correct(pred_obj_rect)
+        if self._static_scene_th > 0:
+            self._reference_thumbnail = self.data_provider.get_search_thumbnail(image, pred_obj_rect)
         assert pred_obj_rect.w >= 5 and pred_obj_rect.h >= 5
+        return pred_obj_rect
+
+    def _select_feature_backend(self, image, init_rect, convolution_size_th=None):
+        """
+        :return: the data provider of the backend chosen for the target
+        """
+        if self._frame_deadline > 0:
+            _name, provider = feature_backends.select_backend(image, init_rect, self._frame_deadline,
+                                                              multi_level_search=True,
+                                                              convolution_size_th=convolution_size_th)
+        else:
+            # without a deadline the most accurate backend is used
+            _name = ConvRegTrackerCfg.FEATURE_BACKEND_CANDIDATES[-1]
+            provider = TrainDataProvider(feature_backends.get_extractor_class(_name), init_rect,
+                                         convolution_size_th=convolution_size_th)
+        print('\tfeature backend: {:s}'.format(_name))
+        return provider
+
+    def _infer(self, regression, search_features, motion_window):
+        if self._motion_gate_eps > 0:
+            # the motion response is below eps outside of the window, so the regression is skipped there
+            return regression.inference_window(search_features, motion_window)[:, :, :, 0]
+        return regression.inference(search_features)[:, :, :, 0]
+
+    def _is_static(self, image, object_rect):
+        # the reference is kept while the scene is static, so that slow changes are not missed
+        if self._reference_thumbnail is None:
+            return False
+        _thumbnail = self.data_provider.get_search_thumbnail(image, object_rect)
+        return np.mean(np.abs(_thumbnail - self._reference_thumbnail)) < self._static_scene_th
+
+    def get_last_rect(self):
+        return self._last_obj_rect
+
+    def _propagate(self, last_gray, gray):
+        """
+        Cheap localization between keyframes, no feature is extracted and the model is not updated.
+
+        :return: the propagated object rect, or None if a keyframe is needed
+        """
+        last_rect = self._last_obj_rect
+        if self._keyframe_propagator == 'flow':
+            pred_obj_rect = self._flow_propagator.propagate(last_gray, gray, last_rect)
+            if pred_obj_rect is None:
+                # the motion model is left untouched, track() predicts it once for the keyframe
+                return None
+            self.motion_model.predict()
+        else:
+            pred_cx, pred_cy, _, _ = self.motion_model.predict()
+            pred_obj_rect = Rect(round(pred_cx - (last_rect.w - 1) / 2.0), round(pred_cy - (last_rect.h - 1) / 2.0),
+                                 last_rect.w, last_rect.h)
+        self._append_train_pair(None)
+        self._last_obj_rect = pred_obj_rect
+        self.motion_model.correct(pred_obj_rect)
+        return pred_obj_rect
 
+    def _update_keyframe_interval(self, last_rect, pred_obj_rect, pred_confidence):
+        # grow the interval by one while the target is easy, fall back to tracking every frame otherwise
+        _object_size = math.sqrt(pred_obj_rect.w * pred_obj_rect.h)
+        _dx = pred_obj_rect.get_center()[0] - last_rect.get_center()[0]
+        _dy = pred_obj_rect.get_center()[1] - last_rect.get_center()[1]
+        _displacement = math.sqrt(_dx * _dx + _dy * _dy) / _object_size
+        if pred_confidence >= self._keyframe_confidence_th and _displacement < self._keyframe_displacement_th:
+            self._keyframe_interval = min(self._keyframe_max_interval, self._keyframe_interval + 1)
+        else:
+            self._keyframe_interval = 1
+
+    def _append_train_pair(self, train_pair, shallow_train_pair=None):
+        """
+        :param train_pair: (feature, label, confidence), or None for the frames without any train data
+        :param shallow_train_pair: the same for the shallow model of the adaptive depth mode
+        """
+        _frame_index = len(self._train_pair_history)
+        self._train_pair_history.append(self._train_feature_ring.store(_frame_index, train_pair))
         # remove the very old train data pair to save memory
         _remove_idx = len(self._train_pair_history) - 2 - self._train_data_history_length * self._train_data_gap
         if _remove_idx >= 0:
+            if self.sample_memory is not None and self._train_pair_history[_remove_idx] is not None:
+                self.sample_memory.add(*self._train_pair_history[_remove_idx])
             self._train_pair_history[_remove_idx] = None
-        return pred_obj_rect
-
-    def _get_history_train_data(self):
-        assert len(self._train_pair_history) == self._frame_no + 1
+        if self._adaptive_depth:
+            self._shallow_train_pair_history.append(
+                self._shallow_train_feature_ring.store(_frame_index, shallow_train_pair))
+            if _remove_idx >= 0:
+                self._shallow_train_pair_history[_remove_idx] = None
+
+    def _get_history_train_data(self, history=None):
+        if history is None:
+            history = self._train_pair_history
+        assert len(history) == self._frame_no + 1
         train_features = []
         train_labels = []
         for i in range(self._train_data_history_length):
-            idx = len(self._train_pair_history)-1 - i * self._train_data_gap
+            idx = len(history)-1 - i * self._train_data_gap
             if idx < 0:
                 break
-            # if self._train_pair_history[idx][2] < self._update_confidence_th:
+            # frames between keyframes have no train data
+            if history[idx] is None:
+                continue
+            # if history[idx][2] < self._update_confidence_th:
             #     break
-            train_features.append(self._train_pair_history[idx][0])
-            train_labels.append(self._train_pair_history[idx][1])
-
-        merged_features = np.concatenate(train_features, axis=0)
-        merged_labels = np.concatenate(train_labels, axis=0)
-        return merged_features, merged_labels
+            train_features.append(history[idx][0])
+            train_labels.append(history[idx][1])
+
+        if self.sample_memory is not None and history is self._train_pair_history:
+            _features, _labels = self.sample_memory.get_samples(self._sample_memory_sample_num)
+            train_features.extend(_features)
+            train_labels.extend(_labels)
+        return merge_train_pairs(train_features, train_labels)
 
 
         # patch_rect = last_rect.get_copy().scale_from_center(self.data_provider.search_patch_ratio,
@@ -1,10 +1,11 @@
 import math
+from collections import deque
 
 import numpy as np
 import cv2
 
 # import feature_extractor
-from conv_reg_config import TrainDataCfg
+from conv_reg_config import TrainDataCfg, MotionModelCfg
 from simgeo import Rect
 import display
 
@@ -46,6 +47,24 @@ def clip_image(image,rect):
     return image[ya,xa]
 
 
+def choose_convolution_size_th(image, object_rect):
+    """
+    The filter size of a target: about one cell per CONVOLUTION_PIXELS_PER_CELL pixels of the target, one level
+    coarser for flat targets and one level finer for textured ones, within CONVOLUTION_SIZE_LEVELS.
+    """
+    _levels = TrainDataCfg.CONVOLUTION_SIZE_LEVELS
+    _cells = math.sqrt(object_rect.w * object_rect.h) / TrainDataCfg.CONVOLUTION_PIXELS_PER_CELL
+    level = int(np.argmin([abs(_cells - l) for l in _levels]))
+    _gray = cv2.cvtColor(clip_image(image, object_rect), cv2.COLOR_BGR2GRAY)
+    _texture = np.mean(np.abs(cv2.Laplacian(_gray, cv2.CV_32F))) / 255.0
+    _flat_th, _textured_th = TrainDataCfg.CONVOLUTION_TEXTURE_RANGE
+    if _texture < _flat_th:
+        level -= 1
+    elif _texture > _textured_th:
+        level += 1
+    return _levels[min(max(level, 0), len(_levels) - 1)]
+
+
 class TrainData(object):
 
     def __init__(self, patch, patch_rect, gt_rect, feature, response):
@@ -58,41 +77,49 @@ class TrainData(object):
 
 class TrainDataProvider(object):
 
-    def __init__(self, extractor, object_rect):
+    def __init__(self, extractor, object_rect, multi_level_search=False, convolution_size_th=None):
+        """
+        :param convolution_size_th: about the square root of the filter cell number, CONVOLUTION_SIZE_TH for None
+        """
         # search_size: h, w        object_size: h, w
         object_size_h, object_size_w = object_rect.h, object_rect.w
+        self.convolution_size_th = convolution_size_th or TrainDataCfg.CONVOLUTION_SIZE_TH
         self.extractor_class = extractor
         self.extractor = self.extractor_class()
 
         _extractor_resolution = self.extractor.get_resolution()
         _object_aspect = object_size_h / float(object_size_w)
 
-        self.convolution_w = round(math.sqrt(TrainDataCfg.CONVOLUTION_SIZE_TH**2 / float(_object_aspect)))
+        self.convolution_w = round(math.sqrt(self.convolution_size_th**2 / float(_object_aspect)))
         self.convolution_h = round(_object_aspect*self.convolution_w)
 
-        # self.feature_size_w = round(search_size_w / float(object_size_w) * self.convolution_w)
-        # self.feature_size_h = round(search_size_h / float(object_size_h) * self.convolution_h)
-        self.feature_size_w = self.convolution_w * TrainDataCfg.SEARCH_RATIO_WIDTH
-        self.feature_size_h = self.convolution_h * TrainDataCfg.SEARCH_RATIO_HEIGHT
-
         self.input_object_w = self.convolution_w * _extractor_resolution
         self.input_object_h = self.convolution_h * _extractor_resolution
 
-        self.input_search_w = self.feature_size_w * _extractor_resolution
-        self.input_search_h = self.feature_size_h * _extractor_resolution
-
-        self.response_size_w = self.feature_size_w - self.convolution_w + 1
-        self.response_size_h = self.feature_size_h - self.convolution_h + 1
-        assert self.response_size_h %2 == 1 and self.response_size_w %2 == 1
+        # search ratios (width, height) ordered from the smallest window to the largest one
+        self.dynamic_search = TrainDataCfg.DYNAMIC_SEARCH
+        if self.dynamic_search or multi_level_search:
+            self.search_ratios = list(TrainDataCfg.DYNAMIC_SEARCH_RATIOS)
+        else:
+            self.search_ratios = [(TrainDataCfg.SEARCH_RATIO_WIDTH, TrainDataCfg.SEARCH_RATIO_HEIGHT)]
+        self._dynamic_search_margin = TrainDataCfg.DYNAMIC_SEARCH_MARGIN
+        self._dynamic_search_confidence_th = TrainDataCfg.DYNAMIC_SEARCH_CONFIDENCE_TH
+        self._displacement_history = deque(maxlen=TrainDataCfg.DYNAMIC_SEARCH_HISTORY_LENGTH)
+        self.search_level = None
+        self.set_search_level(len(self.search_ratios) - 1)
 
         self.response_sigma_x = self.convolution_w * TrainDataCfg.RESPONSE_GAUSSIAN_SIGMA_RATIO
         self.response_sigma_y = self.convolution_h * TrainDataCfg.RESPONSE_GAUSSIAN_SIGMA_RATIO
 
-        self.motion_sigma = TrainDataCfg.CONVOLUTION_SIZE_TH * TrainDataCfg.MOTION_GAUSSIAN_SIGMA_RATIO
+        self.motion_sigma = self.convolution_size_th * TrainDataCfg.MOTION_GAUSSIAN_SIGMA_RATIO
+        self.min_motion_sigma = MotionModelCfg.MIN_MOTION_SIGMA
 
         self.scale_test_num = TrainDataCfg.SCALE_TEST_NUM
         assert self.scale_test_num >= 0
         self.scale_ratio = TrainDataCfg.SCALE_RATIO
+        self.search_thumbnail_size = TrainDataCfg.SEARCH_THUMBNAIL_SIZE
+        # when set, the search features are sampled from this FrameFeatureMap instead of being extracted
+        self.frame_feature_map = None
 
         self._show_label_response_fid = TrainDataCfg.SHOW_LABEL_RESPONSE_FID
         self._show_motion_map_fid = TrainDataCfg.SHOW_MOTION_MAP_FID
@@ -125,26 +152,140 @@ class TrainDataProvider(object):
         # self._show_label_response_fid = TrainDataCfg.SHOW_LABEL_RESPONSE_FID
         # self._show_motion_map_fid = TrainDataCfg.SHOW_MOTION_MAP_FID
 
-    def get_search_feature(self, image, object_rect):
+    def close(self):
+        """
+        Releases the extractor, the provider is not used any more.
+        """
+        self.extractor.close()
+
+    def set_search_level(self, level):
+        assert 0 <= level < len(self.search_ratios)
+        self.search_level = level
+        _ratio_w, _ratio_h = self.search_ratios[level]
+        _extractor_resolution = self.extractor.get_resolution()
+
+        # self.feature_size_w = round(search_size_w / float(object_size_w) * self.convolution_w)
+        # self.feature_size_h = round(search_size_h / float(object_size_h) * self.convolution_h)
+        self.feature_size_w = self.convolution_w * _ratio_w
+        self.feature_size_h = self.convolution_h * _ratio_h
+
+        self.input_search_w = self.feature_size_w * _extractor_resolution
+        self.input_search_h = self.feature_size_h * _extractor_resolution
+
+        self.response_size_w = self.feature_size_w - self.convolution_w + 1
+        self.response_size_h = self.feature_size_h - self.convolution_h + 1
+        assert self.response_size_h %2 == 1 and self.response_size_w %2 == 1
+
+    def _get_search_reach(self, level):
+        # the largest displacement, in response cells, that the search window of the level can cover
+        _ratio_w, _ratio_h = self.search_ratios[level]
+        return self.convolution_w * (_ratio_w - 1) / 2.0, self.convolution_h * (_ratio_h - 1) / 2.0
+
+    def get_search_pixel_nums(self):
+        _resolution = self.extractor.get_resolution()
+        return [self.convolution_w * _ratio_w * self.convolution_h * _ratio_h * _resolution * _resolution
+                for _ratio_w, _ratio_h in self.search_ratios]
+
+    def precompile_search_levels(self, batch_size):
+        """
+        Run the extractor once on every search window size, so that no network is built while tracking.
+        """
+        _level = self.search_level
+        for level in range(len(self.search_ratios)):
+            if level != _level:
+                self.set_search_level(level)
+                _dummy = np.zeros((self.input_search_h, self.input_search_w, 3), dtype=np.uint8)
+                self.extractor.extract_multiple_features([_dummy] * batch_size)
+        self.set_search_level(_level)
+
+    def update_search_level(self, displacement_y, displacement_x, confidence):
+        """
+        Shrink or grow the search window by one level, from the recent displacements and the confidence.
+
+        :param displacement_y: displacement of the object in the last frame, in response cells
+        :param displacement_x: displacement of the object in the last frame, in response cells
+        :param confidence: confidence of the last prediction
+        :return: True if the search level is changed
+        """
+        if not self.dynamic_search:
+            return False
+        self._displacement_history.append((abs(displacement_y), abs(displacement_x)))
+        _max_dy = self._dynamic_search_margin * max(d[0] for d in self._displacement_history)
+        _max_dx = self._dynamic_search_margin * max(d[1] for d in self._displacement_history)
+
+        _reach_x, _reach_y = self._get_search_reach(self.search_level)
+        if self.search_level + 1 < len(self.search_ratios) and \
+                (confidence < self._dynamic_search_confidence_th or _max_dy > _reach_y or _max_dx > _reach_x):
+            self.set_search_level(self.search_level + 1)
+            return True
+
+        if self.search_level > 0 and confidence >= self._dynamic_search_confidence_th and \
+                len(self._displacement_history) == self._displacement_history.maxlen:
+            _reach_x, _reach_y = self._get_search_reach(self.search_level - 1)
+            if _max_dy <= _reach_y and _max_dx <= _reach_x:
+                self.set_search_level(self.search_level - 1)
+                return True
+        return False
+
+    def get_search_input(self, image, object_rect):
+        """
+        :return: (search_rect, search_bgr, search_input), the search window of the object and its extractor input
+        """
         _search_ratio_w = self.feature_size_w / float(self.convolution_w)
         _search_ratio_h = self.feature_size_h / float(self.convolution_h)
         _search_rect = object_rect.get_copy().scale_from_center(_search_ratio_w,
                                                                 _search_ratio_h)
         _search_bgr = clip_image(image, _search_rect)
-        _search_input = cv2.resize(_search_bgr, (self.input_search_w, self.input_search_h))
+        return _search_rect, _search_bgr, cv2.resize(_search_bgr, (self.input_search_w, self.input_search_h))
+
+    def get_search_feature(self, image, object_rect):
+        _search_rect, _search_bgr, _search_input = self.get_search_input(image, object_rect)
 
         if self._show_search_bgr_fid:
             display.show_image(_search_bgr, self._show_search_bgr_fid, 'Train & search patch')
         _search_feature = self.extractor.extract_multiple_features([_search_input,])
         return _search_rect, _search_bgr, _search_feature[0]
 
-    def get_scaled_search_feature(self, image, object_rect):
+    def select_channels(self, image, object_rect, channel_num):
+        """
+        Let the extractor keep the channels which best separate the object from the rest of its search window.
+        """
+        _, _, _search_input = self.get_search_input(image, object_rect)
+        _raw_feature = self.extractor.extract_raw_features([_search_input])[0]
+        # the object is at the center of its search window
+        _mask = np.zeros(_raw_feature.shape[:2], dtype=bool)
+        _y0 = (_raw_feature.shape[0] - self.convolution_h) // 2
+        _x0 = (_raw_feature.shape[1] - self.convolution_w) // 2
+        _mask[_y0:_y0+self.convolution_h, _x0:_x0+self.convolution_w] = True
+        self.extractor.select_channels(_raw_feature, _mask, channel_num)
+
+    def get_search_thumbnail(self, image, object_rect):
+        """
+        Low resolution gray image of the search window, cheap enough to compare consecutive frames.
+
+        :return: ndarray, (size, size) float32 in [0, 1]
+        """
+        _search_ratio_w = self.feature_size_w / float(self.convolution_w)
+        _search_ratio_h = self.feature_size_h / float(self.convolution_h)
+        _search_rect = object_rect.get_copy().scale_from_center(_search_ratio_w,
+                                                                _search_ratio_h)
+        _search_bgr = clip_image(image, _search_rect)
+        _thumbnail = cv2.resize(_search_bgr, (self.search_thumbnail_size, self.search_thumbnail_size),
+                                interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(_thumbnail, cv2.COLOR_BGR2GRAY).astype(np.float32) / 255.0
+
+    def get_scaled_search_feature(self, image, object_rect, scale_test_num=None, raw=False):
+        """
+        :param raw: return the features before the reduction of the extractor, see reduce_features
+        """
+        if scale_test_num is None:
+            scale_test_num = self.scale_test_num
         _scale_step_w = max(1, round(object_rect.w * self.scale_ratio))
         _scale_step_h = max(1, round(object_rect.h * self.scale_ratio))
         scaled_object_rects = []
-        for i in range(2 * self.scale_test_num + 1):
-            w = object_rect.w + _scale_step_w * (i - self.scale_test_num)
-            h = object_rect.h + _scale_step_h * (i - self.scale_test_num)
+        for i in range(2 * scale_test_num + 1):
+            w = object_rect.w + _scale_step_w * (i - scale_test_num)
+            h = object_rect.h + _scale_step_h * (i - scale_test_num)
             if w < 5 or h < 5:
                 print('Warning: w < 5 or h < 5')
                 continue
@@ -159,22 +300,46 @@ class TrainDataProvider(object):
 
         _search_rect_list = []
         _search_bgr_list = []
-        _search_input_list = []
-        for _scaled_rect in scaled_object_rects:
+        if self.frame_feature_map is None:
+            # the windows are resized straight into the persistent input batch of the extractor
+            _search_inputs = self.extractor.get_input_buffer(len(scaled_object_rects),
+                                                             self.input_search_h, self.input_search_w)
+        for i, _scaled_rect in enumerate(scaled_object_rects):
             _search_rect = _scaled_rect.get_copy().scale_from_center(_search_ratio_w,
                                                                      _search_ratio_h)
             _search_bgr = clip_image(image, _search_rect)
-            _search_input = cv2.resize(_search_bgr, (self.input_search_w, self.input_search_h))
-
             _search_rect_list.append(_search_rect)
             _search_bgr_list.append(_search_bgr)
-            _search_input_list.append(_search_input)
+            if self.frame_feature_map is None:
+                cv2.resize(_search_bgr, (self.input_search_w, self.input_search_h), dst=_search_inputs[i])
         if self._show_search_bgr_fid:
             display.show_image(_search_bgr_list[0], self._show_search_bgr_fid, 'Train & search patch')
 
-        _search_features = self.extractor.extract_multiple_features(_search_input_list)
+        if self.frame_feature_map is not None:
+            _search_features = self.frame_feature_map.sample(_search_rect_list, self.feature_size_h, self.feature_size_w)
+            # the frame map has all the channels of the last layer
+            _selected_channels = getattr(self.extractor, 'selected_channels', None)
+            if _selected_channels is not None:
+                _search_features = _search_features[:, :, :, _selected_channels]
+            if not raw:
+                _search_features = self.extractor.reduce_features(_search_features)
+        elif raw:
+            _search_features = self.extractor.extract_raw_features(_search_inputs)
+        else:
+            _search_features = self.extractor.extract_multiple_features(_search_inputs)
         return _search_rect_list, _search_bgr_list, _search_features, scaled_object_rects
 
+    def get_input_scale(self, object_rect):
+        """
+        :return: the scale the search window of object_rect is resized with before the extraction
+        """
+        return math.sqrt(self.input_object_w / float(object_rect.w) * self.input_object_h / float(object_rect.h))
+
+    def get_search_area(self, object_rect):
+        _search_ratio_w = self.feature_size_w / float(self.convolution_w)
+        _search_ratio_h = self.feature_size_h / float(self.convolution_h)
+        return object_rect.w * _search_ratio_w * object_rect.h * _search_ratio_h
+
     def get_object_index_by_rect(self, search_rect, object_rect):
         dx = object_rect.get_center()[0] - search_rect.get_center()[0]
         dy = object_rect.get_center()[1] - search_rect.get_center()[1]
@@ -202,21 +367,52 @@ class TrainDataProvider(object):
             display.show_map(response, self._show_label_response_fid, 'Regression targets')
         return response
 
-    def get_motion_response(self, obj_index_y, obj_index_x):
+    def get_motion_sigma(self, search_rect, std_y, std_x):
+        """
+        Convert the uncertainty of a motion model from pixels to response cells.
+
+        :return: (sigma_y, sigma_x), the default motion sigma is used if the std is None
+        """
+        if std_y is None or std_x is None:
+            return self.motion_sigma, self.motion_sigma
+        _x_resolution = search_rect.w / float(self.feature_size_w)
+        _y_resolution = search_rect.h / float(self.feature_size_h)
+        return max(self.min_motion_sigma, std_y / _y_resolution), max(self.min_motion_sigma, std_x / _x_resolution)
+
+    def get_motion_response(self, obj_index_y, obj_index_x, sigma_y=None, sigma_x=None):
         assert 0 <= obj_index_x < self.response_size_w and 0 <= obj_index_y < self.response_size_h
+        sigma_y = self.motion_sigma if sigma_y is None else sigma_y
+        sigma_x = self.motion_sigma if sigma_x is None else sigma_x
         _x_index = np.arange(0, self.response_size_w)
         _y_index = np.arange(0, self.response_size_h)
         yv, xv = np.meshgrid(_y_index, _x_index, indexing='ij')
         yv -= obj_index_y
         xv -= obj_index_x
-        _y1 = yv * yv / 2 / self.motion_sigma / self.motion_sigma
-        _x1 = xv * xv / 2 / self.motion_sigma / self.motion_sigma
+        _y1 = yv * yv / 2 / sigma_y / sigma_y
+        _x1 = xv * xv / 2 / sigma_x / sigma_x
         response = np.exp(-(_y1 + _x1))
         # response[response < 1e-5] = 0.0
         if self._show_motion_map_fid:
             display.show_map(response, self._show_motion_map_fid, 'Motion map')
         return response
 
+    def get_motion_window(self, obj_index_y, obj_index_x, eps, sigma_y=None, sigma_x=None):
+        """
+        The response window outside of which the motion response is below eps.
+
+        :return: (y0, y1, x0, x1), the window is [y0, y1) x [x0, x1)
+        """
+        assert 0 < eps < 1
+        sigma_y = self.motion_sigma if sigma_y is None else sigma_y
+        sigma_x = self.motion_sigma if sigma_x is None else sigma_x
+        _radius_y = sigma_y * math.sqrt(2 * math.log(1.0 / eps))
+        _radius_x = sigma_x * math.sqrt(2 * math.log(1.0 / eps))
+        y0 = max(0, int(math.ceil(obj_index_y - _radius_y)))
+        y1 = min(self.response_size_h, int(math.floor(obj_index_y + _radius_y)) + 1)
+        x0 = max(0, int(math.ceil(obj_index_x - _radius_x)))
+        x1 = min(self.response_size_w, int(math.floor(obj_index_x + _radius_x)) + 1)
+        return y0, y1, x0, x1
+
     def get_object_rect_by_index(self, search_rect, obj_index_y, obj_index_x):
         _yi, _xi = obj_index_y, obj_index_x
 
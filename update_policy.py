@@ -0,0 +1,105 @@
+
+import numpy as np
+
+from conv_reg_config import ConvRegTrackerCfg
+
+
+def peak_to_sidelobe_ratio(response, exclude_radius):
+    """
+    :param response: ndarray, (h, w)
+    :param exclude_radius: the cells within this distance of the peak are not part of the sidelobe
+    :return: (peak, psr)
+    """
+    peak_y, peak_x = np.unravel_index(np.argmax(response), response.shape)
+    peak = response[peak_y, peak_x]
+    _mask = np.ones(response.shape, dtype=bool)
+    _mask[max(0, peak_y - exclude_radius):peak_y + exclude_radius + 1,
+          max(0, peak_x - exclude_radius):peak_x + exclude_radius + 1] = False
+    sidelobe = response[_mask]
+    if sidelobe.size < 2:
+        return peak, 0.0
+    return peak, (peak - np.mean(sidelobe)) / max(np.std(sidelobe), 1e-6)
+
+
+class UpdatePolicy(object):
+    """
+    Decides after each tracked frame how many steps the regression is updated with.
+    """
+
+    def reset(self):
+        pass
+
+    def get_update_step_num(self, response, confidence, step_num):
+        """
+        :param response: ndarray, (h, w), the regression response of the predicted scale
+        :param confidence: the value of the final response at the prediction
+        :param step_num: the update steps available for this frame
+        :return: the update steps to run, 0 to skip the update
+        """
+        pass
+
+
+class ThresholdUpdatePolicy(UpdatePolicy):
+    """
+    Updates with all the available steps whenever the confidence reaches UPDATE_CONFIDENCE_TH, which is the
+    original behaviour of the tracker.
+    """
+
+    def __init__(self):
+        self._confidence_th = ConvRegTrackerCfg.UPDATE_CONFIDENCE_TH
+
+    def get_update_step_num(self, response, confidence, step_num):
+        return step_num if confidence >= self._confidence_th else 0
+
+
+class AdaptiveUpdatePolicy(UpdatePolicy):
+    """
+    Updates every UPDATE_INTERVAL frames, or earlier when the peak or the PSR of the response drops by more
+    than UPDATE_DRIFT_RATIO below their moving averages.
+
+    The steps are scaled by the relative drop over UPDATE_DRIFT_RATIO, clipped to UPDATE_STEP_RATIO_RANGE,
+    so that a drifting model is updated harder than a periodic refresh. Frames below UPDATE_CONFIDENCE_TH are
+    never learnt from.
+    """
+
+    def __init__(self):
+        self._confidence_th = ConvRegTrackerCfg.UPDATE_CONFIDENCE_TH
+        self._interval = ConvRegTrackerCfg.UPDATE_INTERVAL
+        self._drift_ratio = ConvRegTrackerCfg.UPDATE_DRIFT_RATIO
+        self._min_step_ratio, self._max_step_ratio = ConvRegTrackerCfg.UPDATE_STEP_RATIO_RANGE
+        self._exclude_radius = ConvRegTrackerCfg.UPDATE_PSR_EXCLUDE_RADIUS
+        self._ema_ratio = ConvRegTrackerCfg.UPDATE_EMA_RATIO
+        self._max_step_num = ConvRegTrackerCfg.TRAIN_UPDATE_MAX_STEP_NUM
+        self._average_peak = None
+        self._average_psr = None
+        self._frames_since_update = 0
+
+    def reset(self):
+        self._average_peak = None
+        self._average_psr = None
+        self._frames_since_update = 0
+
+    def get_update_step_num(self, response, confidence, step_num):
+        peak, psr = peak_to_sidelobe_ratio(response, self._exclude_radius)
+        self._frames_since_update += 1
+        if self._average_peak is None:
+            self._average_peak, self._average_psr = peak, psr
+        deviation = max(0.0,
+                        1.0 - peak / max(self._average_peak, 1e-6),
+                        1.0 - psr / max(self._average_psr, 1e-6))
+        self._average_peak = (1 - self._ema_ratio) * self._average_peak + self._ema_ratio * peak
+        self._average_psr = (1 - self._ema_ratio) * self._average_psr + self._ema_ratio * psr
+
+        if confidence < self._confidence_th or step_num <= 0:
+            return 0
+        if deviation < self._drift_ratio and self._frames_since_update < self._interval:
+            return 0
+        _ratio = min(self._max_step_ratio, max(self._min_step_ratio, deviation / self._drift_ratio))
+        self._frames_since_update = 0
+        return min(self._max_step_num, max(1, int(round(step_num * _ratio))))
+
+
+UPDATE_POLICIES = {
+    'threshold': ThresholdUpdatePolicy,
+    'adaptive': AdaptiveUpdatePolicy,
+}
@@ -1,16 +1,57 @@
+import os
+from collections import OrderedDict
+
 import numpy as np
-import cv2
 import tensorflow as tf
 
 from feature_extractor import FeatureExtractor
 import display
-from conv_reg_config import TrainDataCfg
+import tf_session
+import vgg_model
+from vgg_model import FeatureReduction
+from conv_reg_config import BasicCfg, TrainDataCfg
 
 VGG_MODEL_PATH = TrainDataCfg.VGG_MODEL_PATH
 VGG_MEAN = TrainDataCfg.VGG_MEAN
 
 
+class _PooledNetwork(object):
+    """
+    A network of the VggExtractor pool, its session is closed once it has left the pool and no extractor uses it.
+    """
+
+    def __init__(self, network):
+        # (graph, session, input, output, layer outputs, pca mean, pca vector, output after pca)
+        self.network = network
+        self.user_num = 0
+        self.pooled = True
+
+    def release(self):
+        self.user_num -= 1
+        self._close_if_unused()
+
+    def evict(self):
+        self.pooled = False
+        self._close_if_unused()
+
+    def _close_if_unused(self):
+        if not self.pooled and self.user_num <= 0:
+            self.network[1].close()
+
+
 class VggExtractor(FeatureExtractor):
+    """
+    The networks are pooled by all the extractors of the process, keyed by the network and the input size, so
+    that the targets with the same search window size share one graph. The pca of each extractor is fed to the
+    shared graph on every run instead of being assigned to it.
+    """
+    _name = 'Vgg'
+    # the layers of the network, see vgg_model
+    _layers = []
+    # (name, precision, selected channels, xla, activation ranges, input height, input width) -> _PooledNetwork,
+    # the least recently used one leaves the pool when it is full
+    _network_pool = OrderedDict()
+
     def __init__(self):
         super(VggExtractor, self).__init__()
         self._feature_width = 0
@@ -26,29 +67,226 @@ class VggExtractor(FeatureExtractor):
         self._session = None
         self._input_holder = None
         self._output_feature = None
+        # the output of every layer, the last one is self._output_feature
+        self._layer_outputs = None
         self._output_feature_after_pca = None
+        self._pca_mean = None
+        self._pca_vector = None
+        self._network_pool_size = TrainDataCfg.VGG_GRAPH_CACHE_SIZE
+        # the _PooledNetwork the attributes above come from
+        self._pooled_network = None
 
         self._use_pca = True
         self.pca = None
+        # see vgg_model.PRECISIONS
+        self.precision = TrainDataCfg.VGG_PRECISION
+        # weights key of a conv layer -> the int8 range of its relu output, the activations are not quantized
+        # without them
+        self.activation_ranges = None
+        self._layer_weights = None
+        # output channels of the last conv layer kept by select_channels, None for all of them
+        self.selected_channels = None
         self._load_data()
 
+    def _get_layer_weights(self):
+        return vgg_model.select_last_channels(self._layers, self._layer_weights, self.selected_channels)
+
     def _build_network(self, input_height, input_width):
-        pass
+        assert not input_height % self._resolution and not input_width % self._resolution
+        self._graph = tf.Graph()
+        self._feature_height = input_height
+        self._feature_width = input_width
+        print('Starting building the network for h={:d} w={:d}'.format(input_height, input_width))
+        assert self.precision in vgg_model.PRECISIONS
+        _float16 = self.precision == 'float16'
+        with self._graph.as_default(), tf_session.jit_scope():
+            _input_shape = (None, input_height, input_width, 3)
+            self._input_holder = tf.placeholder(tf.float32, shape=_input_shape)
+            _mean = tf.Variable(VGG_MEAN, trainable=False)
+            _output = self._input_holder - _mean
+            if _float16:
+                _output = tf.cast(_output, tf.float16)
+            self._layer_outputs = []
+            for layer, layer_weight in zip(self._layers, self._get_layer_weights()):
+                if layer_weight is None:
+                    _output = tf.nn.max_pool(_output, (1, 2, 2, 1), (1, 2, 2, 1), padding='SAME')
+                else:
+                    _w, _b = self._get_weight_tensors(*layer_weight)
+                    _output = tf.nn.relu(tf.nn.conv2d(_output, _w, (1, 1, 1, 1), padding='SAME') + _b)
+                    if self.precision == 'int8' and self.activation_ranges:
+                        _output = tf.fake_quant_with_min_max_args(_output, min=0.0,
+                                                                  max=self.activation_ranges[layer[0]])
+                self._layer_outputs.append(_output)
+
+            if _float16:
+                # the features leave the network as float32, the intermediate outputs can be fed either way
+                _output = tf.cast(_output, tf.float32)
+                self._layer_outputs[-1] = _output
+            self._output_feature = _output
+            self._session = tf_session.create_session(self._graph)
+            self._session.run(tf.global_variables_initializer())
+
+    def _get_weight_tensors(self, weights, biases):
+        if self.precision == 'float16':
+            return tf.Variable(weights.astype(np.float16)), tf.Variable(biases.astype(np.float16))
+        if self.precision == 'int8':
+            # only the int8 weights and their per-channel scales are kept in the graph, the conv itself runs in
+            # float32 since the TF cpu kernels have no int8 conv2d
+            _quantized, _scales = vgg_model.quantize_weights(weights)
+            return tf.cast(tf.constant(_quantized), tf.float32) * _scales, tf.Variable(biases)
+        return tf.Variable(weights), tf.Variable(biases)
+
+    def set_precision(self, precision):
+        """
+        The networks are built again with the new precision, the pca is kept.
+        """
+        assert precision in vgg_model.PRECISIONS
+        self.precision = precision
+        self._clear_networks()
+
+    def calibrate_activation_ranges(self, input_batches):
+        """
+        Ranges of the relu outputs of the float32 network for the int8 precision.
+
+        :param input_batches: list of lists of input images, the images of a batch have the same size
+        :return: dict, weights key of each conv layer -> the largest VGG_CALIBRATION_PERCENTILE percentile of its
+                 output over the batches
+        """
+        _precision = self.precision
+        self.set_precision('float32')
+        ranges = {}
+        try:
+            for input_images in input_batches:
+                input_height, input_width = input_images[0].shape[:2]
+                if input_height != self._feature_height or input_width != self._feature_width:
+                    self._activate_network(input_height, input_width)
+                _outputs = self._session.run(self._layer_outputs,
+                                             feed_dict={self._input_holder: np.stack(input_images, axis=0)})
+                for layer, _output in zip(self._layers, _outputs):
+                    if layer != vgg_model.POOL:
+                        _range = vgg_model.get_activation_range(_output, TrainDataCfg.VGG_CALIBRATION_PERCENTILE)
+                        ranges[layer[0]] = max(ranges.get(layer[0], 0.0), _range)
+        finally:
+            self.set_precision(_precision)
+        return ranges
+
+    def _clear_networks(self):
+        # the networks of the new weights have other pool keys, the old ones stay pooled for the other extractors
+        self._release_network()
+
+    def select_channels(self, raw_features, target_mask, channel_num):
+        """
+        Keeps the channel_num channels of the last conv layer which best separate the target from the background,
+        the other ones are not computed any more. The pca is computed again on the next extraction.
+
+        :param raw_features: ndarray, (h, w, c), the features of a search window from extract_raw_features
+        :param target_mask: ndarray of bool, (h, w), the cells of the target
+        :param channel_num: at least the pca size, when the features are reduced
+        """
+        assert not self._use_pca or channel_num >= self._channel_num, \
+            'cannot keep {:d} channels, the pca reduces to {:d}'.format(channel_num, self._channel_num)
+        _scores = vgg_model.score_channels(raw_features, target_mask)
+        _channels = np.sort(np.argsort(_scores)[::-1][:channel_num])
+        if self.selected_channels is not None:
+            _channels = self.selected_channels[_channels]
+        self.selected_channels = _channels
+        self.pca = None
+        self._feature_offset = None
+        self._feature_scale = None
+        self._clear_networks()
 
     def _build_pca_network(self):
-        with self._graph.as_default():
+        with self._graph.as_default(), tf_session.jit_scope():
             _output_channel = self._output_feature.shape.dims[-1]
-            self._pca_mean = tf.Variable(tf.zeros([1, 1, 1, _output_channel]), trainable=False)
-            self._pca_vector = tf.Variable(tf.zeros([1, 1, _output_channel, self._channel_num]),
-                                           trainable=False,
-                                           expected_shape=[1, 1, _output_channel, self._channel_num])
+            self._pca_mean = tf.placeholder(tf.float32, [1, 1, 1, _output_channel])
+            self._pca_vector = tf.placeholder(tf.float32, [1, 1, _output_channel, self._channel_num])
             _sub_mean = self._output_feature - self._pca_mean
             self._output_feature_after_pca = tf.nn.conv2d(_sub_mean, self._pca_vector, [1, 1, 1, 1], padding='SAME')
-            _pca_initializer = tf.variables_initializer([self._pca_mean, self._pca_vector])
-            self._session.run(_pca_initializer)
+
+    def _get_pca_feed(self):
+        return {self._pca_mean: self.pca.mean.reshape((1, 1, 1, -1)),
+                self._pca_vector: self.pca.eigen_vecs.T.reshape((1, 1, -1, self._channel_num))}
+
+    def _get_network_key(self, input_height, input_width):
+        # everything the built graph depends on
+        _channels = None if self.selected_channels is None else tuple(self.selected_channels)
+        _ranges = None
+        if self.precision == 'int8' and self.activation_ranges:
+            _ranges = tuple(sorted(self.activation_ranges.items()))
+        return self._name, self.precision, _channels, BasicCfg.XLA_JIT, _ranges, input_height, input_width
+
+    def _release_network(self):
+        if self._pooled_network is not None:
+            self._pooled_network.release()
+            self._pooled_network = None
+        self._feature_height, self._feature_width = 0, 0
+
+    def _activate_network(self, input_height, input_width):
+        _key = self._get_network_key(input_height, input_width)
+        _pool = VggExtractor._network_pool
+        self._release_network()
+        if _key in _pool:
+            _pooled = _pool.pop(_key)
+            (self._graph, self._session, self._input_holder, self._output_feature, self._layer_outputs,
+             self._pca_mean, self._pca_vector, self._output_feature_after_pca) = _pooled.network
+            self._feature_height, self._feature_width = input_height, input_width
+        else:
+            while _pool and len(_pool) >= self._network_pool_size:
+                _pool.popitem(last=False)[1].evict()
+            self._build_network(input_height, input_width)
+            self._build_pca_network()
+            _pooled = _PooledNetwork((self._graph, self._session, self._input_holder, self._output_feature,
+                                      self._layer_outputs, self._pca_mean, self._pca_vector,
+                                      self._output_feature_after_pca))
+        _pooled.user_num += 1
+        self._pooled_network = _pooled
+        _pool[_key] = _pooled
+
+    @staticmethod
+    def clear_network_pool():
+        """
+        Empties the pool, the networks no extractor uses are closed.
+        """
+        _pool = VggExtractor._network_pool
+        while _pool:
+            _pool.popitem(last=False)[1].evict()
+
+    def close(self):
+        self._release_network()
+        super(VggExtractor, self).close()
 
     def _load_data(self):
-        pass
+        self._layer_weights = vgg_model.load_layer_weights(self._layers, VGG_MODEL_PATH)
+        print('{:s} parameters loaded successfully!'.format(self._name))
+        if self.precision == 'int8' and os.path.exists(TrainDataCfg.VGG_CALIBRATION_PATH):
+            self.activation_ranges = load_activation_ranges(TrainDataCfg.VGG_CALIBRATION_PATH)
+
+    def extract_raw_features(self, input_images):
+        input_height, input_width = input_images[0].shape[:2]
+        if input_height != self._feature_height or input_width != self._feature_width:
+            self._activate_network(input_height, input_width)
+        return self._session.run(self._output_feature, feed_dict={self._input_holder: np.asarray(input_images)})
+
+    def reduce_features(self, raw_features):
+        if not self._use_pca:
+            return raw_features
+        return self.pca.project(raw_features).astype(np.float32)
+
+    def extract_layer_features(self, input_images, layer_num):
+        """
+        Raw features after the first layer_num layers, the following layers are not run.
+        """
+        input_height, input_width = input_images[0].shape[:2]
+        if input_height != self._feature_height or input_width != self._feature_width:
+            self._activate_network(input_height, input_width)
+        return self._session.run(self._layer_outputs[layer_num - 1],
+                                 feed_dict={self._input_holder: np.asarray(input_images)})
+
+    def extend_layer_features(self, layer_features, layer_num):
+        """
+        Raw features of the last layer, computed from the output of extract_layer_features on the last input size.
+        """
+        return self._session.run(self._output_feature, feed_dict={self._layer_outputs[layer_num - 1]: layer_features})
 
     def extract_multiple_features(self, input_images):
         # assert len(input_images) > 0
@@ -70,16 +308,10 @@ class VggExtractor(FeatureExtractor):
         input_height = input_images[0].shape[0]
 
         if input_height != self._feature_height or input_width != self._feature_width:
-            self._build_network(input_height, input_width)
-            self._build_pca_network()
-            self.pca = None
-            self._feature_offset = None
-            self._feature_scale = None
-
-        _merge_list = []
-        for image in input_images:
-            _merge_list.append(image[np.newaxis, :, :, :])
-        merged = np.concatenate(_merge_list, axis=0)
+            self._activate_network(input_height, input_width)
+
+        # an input buffer of get_input_buffer is fed as it is
+        merged = np.asarray(input_images)
         if not self._use_pca:
             output_features = self._session.run(self._output_feature, feed_dict={self._input_holder: merged})
         else:
@@ -88,13 +320,13 @@ class VggExtractor(FeatureExtractor):
                 # _temp_save_path = './tmp/conv_feature.npy'
                 # np.save(_temp_save_path, _org_features)
                 self.pca = FeatureReduction(_org_features[0], self._channel_num)
-                self._session.run(self._pca_mean.assign(self.pca.mean.reshape((1, 1, 1, -1))))
-                self._session.run(self._pca_vector.assign(self.pca.eigen_vecs.T.reshape((1, 1, -1, self._channel_num))))
-                output_features = self._session.run(self._output_feature_after_pca,
-                                                    feed_dict={self._output_feature: _org_features})
+                _feed = self._get_pca_feed()
+                _feed[self._output_feature] = _org_features
+                output_features = self._session.run(self._output_feature_after_pca, feed_dict=_feed)
             else:
-                output_features = self._session.run(self._output_feature_after_pca,
-                                                    feed_dict={self._input_holder: merged})
+                _feed = self._get_pca_feed()
+                _feed[self._input_holder] = merged
+                output_features = self._session.run(self._output_feature_after_pca, feed_dict=_feed)
         # if self._use_pca:
         #     assert self._channel_num < output_features.shape[3]
         #     if not self.pca:
@@ -124,49 +356,13 @@ class VggExtractor(FeatureExtractor):
 
 
 class VggL1Extractor(VggExtractor):
+    _name = 'VggL1'
+    _layers = vgg_model.VGG_L1_LAYERS
+
     def __init__(self):
         super(VggL1Extractor, self).__init__()
         self._use_pca = False
 
-    def _build_network(self, input_height, input_width):
-
-        assert not input_height % self._resolution and not input_width % self._resolution
-        if self._session:
-            self._session.close()
-        self._graph = tf.Graph()
-        self._feature_height = input_height
-        self._feature_width = input_width
-        print('Starting building the network for h={:d} w={:d}'.format(input_height, input_width))
-        with self._graph.as_default():
-            _input_shape = (None, input_height, input_width, 3)
-            self._input_holder = tf.placeholder(tf.float32, shape=_input_shape)
-            _mean = tf.Variable(VGG_MEAN, trainable=False)
-            _sub_mean = self._input_holder - _mean
-
-            _conv_11_w = tf.Variable(self._conv_data_11_weights)
-            _conv_11_b = tf.Variable(self._conv_data_11_bias)
-            _conv_11_output = tf.nn.conv2d(_sub_mean, _conv_11_w, [1, 1, 1, 1], padding='SAME') + _conv_11_b
-            _conv_11_act = tf.nn.relu(_conv_11_output)
-            _max_pool_11_output = tf.nn.max_pool(_conv_11_act, (1, 2, 2, 1), (1, 2, 2, 1), padding='SAME')
-
-            _conv_12_w = tf.Variable(self._conv_data_12_weights)
-            _conv_12_b = tf.Variable(self._conv_data_12_bias)
-            _conv_12_output = tf.nn.conv2d(_max_pool_11_output, _conv_12_w, [1, 1, 1, 1], padding='SAME') + _conv_12_b
-            _conv_12_act = tf.nn.relu(_conv_12_output)
-            _max_pool_12_output = tf.nn.max_pool(_conv_12_act, (1, 2, 2, 1), (1, 2, 2, 1), padding='SAME')
-
-            self._output_feature = _max_pool_12_output
-            self._session = tf.Session(graph=self._graph)
-            self._session.run(tf.global_variables_initializer())
-
-    def _load_data(self):
-        with np.load(VGG_MODEL_PATH) as npz_file:
-            self._conv_data_11_weights = npz_file['conv1_1/weights']
-            self._conv_data_11_bias = npz_file['conv1_1/biases']
-            self._conv_data_12_weights = npz_file['conv1_2/weights']
-            self._conv_data_12_bias = npz_file['conv1_2/biases']
-        print('VggL1 parameters loaded successfully!')
-
     # def extract_feature(self, input_image):
     #     input_width = input_image.shape[1]
     #     input_height = input_image.shape[0]
@@ -179,384 +375,86 @@ class VggL1Extractor(VggExtractor):
     #     return output_feature[0,:,:,:]
 
 
-class FeatureReduction(object):
-    def __init__(self, image_feature, max_components):
-        assert image_feature.ndim == 3
-        feature = np.reshape(image_feature, (-1, image_feature.shape[2]))
-        _mean = np.mean(feature, axis=0, keepdims=True)
-        self.mean, self.eigen_vecs = cv2.PCACompute(feature, _mean, maxComponents=max_components)
-        print('\tPCA computed!')
-
-    def project(self, images_features):
-        assert images_features.ndim == 4
-        data = np.reshape(images_features, (-1, images_features.shape[3]))
-        coeffs = cv2.PCAProject(data, self.mean, self.eigen_vecs)
-        re_shape = list(images_features.shape)
-        re_shape[3] = len(self.eigen_vecs)
-        re_features = np.reshape(coeffs, re_shape)
-        return re_features
-
-
 class VggL2Extractor(VggExtractor):
-    def __init__(self):
-        super(VggL2Extractor, self).__init__()
+    _name = 'VggL2'
+    _layers = vgg_model.VGG_L2_LAYERS
 
-    def _build_network(self, input_height, input_width):
 
-        assert not input_height % self._resolution and not input_width % self._resolution
-        if self._session:
-            self._session.close()
-        self._graph = tf.Graph()
-        self._feature_height = input_height
-        self._feature_width = input_width
-        print('Starting building the network for h={:d} w={:d}'.format(input_height, input_width))
-        with self._graph.as_default():
-            _input_shape = (None, input_height, input_width, 3)
-            self._input_holder = tf.placeholder(tf.float32, shape=_input_shape)
-            _mean = tf.Variable(VGG_MEAN, trainable=False)
-            _sub_mean = self._input_holder - _mean
-
-            _conv_11_w = tf.Variable(self._conv_data_11_weights)
-            _conv_11_b = tf.Variable(self._conv_data_11_bias)
-            _conv_11_output = tf.nn.conv2d(_sub_mean, _conv_11_w, [1, 1, 1, 1], padding='SAME') + _conv_11_b
-            _conv_11_act = tf.nn.relu(_conv_11_output)
-
-            _conv_12_w = tf.Variable(self._conv_data_12_weights)
-            _conv_12_b = tf.Variable(self._conv_data_12_bias)
-            _conv_12_output = tf.nn.conv2d(_conv_11_act, _conv_12_w, [1, 1, 1, 1], padding='SAME') + _conv_12_b
-            _conv_12_act = tf.nn.relu(_conv_12_output)
-            _max_pool_12_output = tf.nn.max_pool(_conv_12_act, (1, 2, 2, 1), (1, 2, 2, 1), padding='SAME')
-
-            _conv_21_w = tf.Variable(self._conv_data_21_weights)
-            _conv_21_b = tf.Variable(self._conv_data_21_bias)
-            _conv_21_output = tf.nn.conv2d(_max_pool_12_output, _conv_21_w, (1, 1, 1, 1), padding='SAME') + _conv_21_b
-            _conv_21_act = tf.nn.relu(_conv_21_output)
-
-            _conv_22_w = tf.Variable(self._conv_data_22_weights)
-            _conv_22_b = tf.Variable(self._conv_data_22_bias)
-            _conv_22_output = tf.nn.conv2d(_conv_21_act, _conv_22_w, (1, 1, 1, 1), padding='SAME') + _conv_22_b
-            _conv_22_act = tf.nn.relu(_conv_22_output)
-            _max_pool_22_output = tf.nn.max_pool(_conv_22_act, (1, 2, 2, 1), (1, 2, 2, 1,), padding='SAME')
-
-            self._output_feature = _max_pool_22_output
-            self._session = tf.Session(graph=self._graph)
-            self._session.run(tf.global_variables_initializer())
+class VggL3Extractor(VggExtractor):
+    _name = 'VggL3'
+    _layers = vgg_model.VGG_L3_LAYERS
 
-    def _load_data(self):
-        with np.load(VGG_MODEL_PATH) as npz_file:
-            self._conv_data_11_weights = npz_file['conv1_1/weights']
-            self._conv_data_11_bias = npz_file['conv1_1/biases']
-            self._conv_data_12_weights = npz_file['conv1_2/weights']
-            self._conv_data_12_bias = npz_file['conv1_2/biases']
-            self._conv_data_21_weights = npz_file['conv2_1/weights']
-            self._conv_data_21_bias = npz_file['conv2_1/biases']
-            self._conv_data_22_weights = npz_file['conv2_2/weights']
-            self._conv_data_22_bias = npz_file['conv2_2/biases']
-        print('VggL2 parameters loaded successfully!')
 
+class VggL4Extractor(VggExtractor):
+    _name = 'VggL4'
+    _layers = vgg_model.VGG_L4_LAYERS
 
-class VggL3Extractor(VggExtractor):
-    def __init__(self):
-        super(VggL3Extractor, self).__init__()
 
-    def _build_network(self, input_height, input_width):
-        assert not input_height % self._resolution and not input_width % self._resolution
-        if self._session:
-            self._session.close()
-        self._graph = tf.Graph()
-        self._feature_height = input_height
-        self._feature_width = input_width
-        print('Starting building the network for h={:d} w={:d}'.format(input_height, input_width))
-        with self._graph.as_default():
-            _input_shape = (None, input_height, input_width, 3)
-            self._input_holder = tf.placeholder(tf.float32, shape=_input_shape)
-            _mean = tf.Variable(VGG_MEAN, trainable=False)
-            _sub_mean = self._input_holder - _mean
-
-            _conv_11_w = tf.Variable(self._conv_data_11_weights)
-            _conv_11_b = tf.Variable(self._conv_data_11_bias)
-            _conv_11_output = tf.nn.conv2d(_sub_mean, _conv_11_w, [1, 1, 1, 1], padding='SAME') + _conv_11_b
-            _conv_11_act = tf.nn.relu(_conv_11_output)
-
-            _conv_12_w = tf.Variable(self._conv_data_12_weights)
-            _conv_12_b = tf.Variable(self._conv_data_12_bias)
-            _conv_12_output = tf.nn.conv2d(_conv_11_act, _conv_12_w, [1, 1, 1, 1], padding='SAME') + _conv_12_b
-            _conv_12_act = tf.nn.relu(_conv_12_output)
-            _max_pool_12_output = tf.nn.max_pool(_conv_12_act, (1, 2, 2, 1), (1, 2, 2, 1), padding='SAME')
-
-            _conv_21_w = tf.Variable(self._conv_data_21_weights)
-            _conv_21_b = tf.Variable(self._conv_data_21_bias)
-            _conv_21_output = tf.nn.conv2d(_max_pool_12_output, _conv_21_w, (1, 1, 1, 1), padding='SAME') + _conv_21_b
-            _conv_21_act = tf.nn.relu(_conv_21_output)
-
-            _conv_22_w = tf.Variable(self._conv_data_22_weights)
-            _conv_22_b = tf.Variable(self._conv_data_22_bias)
-            _conv_22_output = tf.nn.conv2d(_conv_21_act, _conv_22_w, (1, 1, 1, 1), padding='SAME') + _conv_22_b
-            _conv_22_act = tf.nn.relu(_conv_22_output)
-            _max_pool_22_output = tf.nn.max_pool(_conv_22_act, (1, 2, 2, 1), (1, 2, 2, 1,), padding='SAME')
-
-            _conv_31_w = tf.Variable(self._conv_data_31_weights)
-            _conv_31_b = tf.Variable(self._conv_data_31_bias)
-            _conv_31_output = tf.nn.conv2d(_max_pool_22_output, _conv_31_w, (1, 1, 1, 1), padding='SAME') + \
-                              _conv_31_b
-            _conv_31_act = tf.nn.relu(_conv_31_output)
-
-            _conv_32_w = tf.Variable(self._conv_data_32_weights)
-            _conv_32_b = tf.Variable(self._conv_data_31_bias)
-            _conv_32_output = tf.nn.conv2d(_conv_31_act, _conv_32_w, (1, 1, 1, 1), padding='SAME') + _conv_32_b
-            _conv_32_act = tf.nn.relu(_conv_32_output)
-
-            _conv_33_w = tf.Variable(self._conv_data_33_weights)
-            _conv_33_b = tf.Variable(self._conv_data_33_bias)
-            _conv_33_output = tf.nn.conv2d(_conv_32_act, _conv_33_w, (1, 1, 1, 1), padding='SAME') + _conv_33_b
-            _conv_33_act = tf.nn.relu(_conv_33_output)
-
-            self._output_feature = _conv_33_act
-            self._session = tf.Session(graph=self._graph)
-            self._session.run(tf.global_variables_initializer())
+class VggL5Extractor(VggExtractor):
+    _name = 'VggL5'
+    _layers = vgg_model.VGG_L5_LAYERS
 
-    def _load_data(self):
-        with np.load(VGG_MODEL_PATH) as npz_file:
-            self._conv_data_11_weights = npz_file['conv1_1/weights']
-            self._conv_data_11_bias = npz_file['conv1_1/biases']
-            self._conv_data_12_weights = npz_file['conv1_2/weights']
-            self._conv_data_12_bias = npz_file['conv1_2/biases']
-            self._conv_data_21_weights = npz_file['conv2_1/weights']
-            self._conv_data_21_bias = npz_file['conv2_1/biases']
-            self._conv_data_22_weights = npz_file['conv2_2/weights']
-            self._conv_data_22_bias = npz_file['conv2_2/biases']
-            self._conv_data_31_weights = npz_file['conv3_1/weights']
-            self._conv_data_31_bias = npz_file['conv3_1/biases']
-            self._conv_data_32_weights = npz_file['conv3_2/weights']
-            self._conv_data_32_bias = npz_file['conv3_2/biases']
-            self._conv_data_33_weights = npz_file['conv3_3/weights']
-            self._conv_data_33_bias = npz_file['conv3_3/biases']
-        print('VggL3 parameters loaded successfully!')
 
+class AdaptiveDepthExtractor(FeatureExtractor):
+    """
+    One VggL4 trunk giving conv3_3 features at the 'shallow' depth and conv4_3 features at the 'deep' one, run by
+    TF or NumPy as TrainDataCfg.VGG_BACKEND says.
 
-class VggL4Extractor(VggExtractor):
+    The conv3_3 output of the last extraction is kept, so that the deep features of the same windows are computed
+    from it by extend_last_features without running the trunk again. Each depth has its own pca.
+    """
+    _shallow_layer_num = len(vgg_model.VGG_L3_LAYERS)
 
     def __init__(self):
-        super(VggL4Extractor, self).__init__()
+        super(AdaptiveDepthExtractor, self).__init__()
+        if TrainDataCfg.VGG_BACKEND == 'numpy':
+            from vgg_numpy_extractor import VggL4NumpyExtractor
+            self._trunk = VggL4NumpyExtractor()
+        else:
+            self._trunk = VggL4Extractor()
+        self._resolution = self._trunk.get_resolution()
+        self._channel_num = self._trunk.get_channel_num()
+        self.depth = 'deep'
+        self._pcas = {'shallow': None, 'deep': None}
+        self._last_shallow_features = None
+
+    def set_depth(self, depth):
+        assert depth in self._pcas
+        self.depth = depth
+
+    def _reduce(self, depth, raw_features):
+        if self._pcas[depth] is None:
+            self._pcas[depth] = FeatureReduction(raw_features[0], self._channel_num)
+        return self._pcas[depth].project(raw_features).astype(np.float32)
 
-    def _build_network(self, input_height, input_width):
-        assert not input_height % self._resolution and not input_width % self._resolution
-        if self._session:
-            self._session.close()
-        self._graph = tf.Graph()
-        self._feature_height = input_height
-        self._feature_width = input_width
-        print('Starting building the network for h={:d} w={:d}'.format(input_height, input_width))
-        with self._graph.as_default():
-            _input_shape = (None, input_height, input_width, 3)
-            self._input_holder = tf.placeholder(tf.float32, shape=_input_shape)
-            _mean = tf.Variable(VGG_MEAN, trainable=False)
-            _sub_mean = self._input_holder - _mean
-
-            _conv_11_w = tf.Variable(self._conv_data_11_weights)
-            _conv_11_b = tf.Variable(self._conv_data_11_bias)
-            _conv_11_output = tf.nn.conv2d(_sub_mean, _conv_11_w, [1, 1, 1, 1], padding='SAME') + _conv_11_b
-            _conv_11_act = tf.nn.relu(_conv_11_output)
-
-            _conv_12_w = tf.Variable(self._conv_data_12_weights)
-            _conv_12_b = tf.Variable(self._conv_data_12_bias)
-            _conv_12_output = tf.nn.conv2d(_conv_11_act, _conv_12_w, [1, 1, 1, 1], padding='SAME') + _conv_12_b
-            _conv_12_act = tf.nn.relu(_conv_12_output)
-            _max_pool_12_output = tf.nn.max_pool(_conv_12_act, (1, 2, 2, 1), (1, 2, 2, 1), padding='SAME')
-
-            _conv_21_w = tf.Variable(self._conv_data_21_weights)
-            _conv_21_b = tf.Variable(self._conv_data_21_bias)
-            _conv_21_output = tf.nn.conv2d(_max_pool_12_output, _conv_21_w, (1, 1, 1, 1), padding='SAME') + _conv_21_b
-            _conv_21_act = tf.nn.relu(_conv_21_output)
-
-            _conv_22_w = tf.Variable(self._conv_data_22_weights)
-            _conv_22_b = tf.Variable(self._conv_data_22_bias)
-            _conv_22_output = tf.nn.conv2d(_conv_21_act, _conv_22_w, (1, 1, 1, 1), padding='SAME') + _conv_22_b
-            _conv_22_act = tf.nn.relu(_conv_22_output)
-            _max_pool_22_output = tf.nn.max_pool(_conv_22_act, (1, 2, 2, 1), (1, 2, 2, 1,), padding='SAME')
-
-            _conv_31_w = tf.Variable(self._conv_data_31_weights)
-            _conv_31_b = tf.Variable(self._conv_data_31_bias)
-            _conv_31_output = tf.nn.conv2d(_max_pool_22_output, _conv_31_w, (1, 1, 1, 1), padding='SAME') + \
-                              _conv_31_b
-            _conv_31_act = tf.nn.relu(_conv_31_output)
-
-            _conv_32_w = tf.Variable(self._conv_data_32_weights)
-            _conv_32_b = tf.Variable(self._conv_data_31_bias)
-            _conv_32_output = tf.nn.conv2d(_conv_31_act, _conv_32_w, (1, 1, 1, 1), padding='SAME') + _conv_32_b
-            _conv_32_act = tf.nn.relu(_conv_32_output)
-
-            _conv_33_w = tf.Variable(self._conv_data_33_weights)
-            _conv_33_b = tf.Variable(self._conv_data_33_bias)
-            _conv_33_output = tf.nn.conv2d(_conv_32_act, _conv_33_w, (1, 1, 1, 1), padding='SAME') + _conv_33_b
-            _conv_33_act = tf.nn.relu(_conv_33_output)
-
-            _conv_41_w = tf.Variable(self._conv_data_41_weights)
-            _conv_41_b = tf.Variable(self._conv_data_41_bias)
-            _conv_41_output = tf.nn.conv2d(_conv_33_act, _conv_41_w, (1, 1, 1, 1), padding='SAME') + \
-                              _conv_41_b
-            _conv_41_act = tf.nn.relu(_conv_41_output)
-
-            _conv_42_w = tf.Variable(self._conv_data_42_weights)
-            _conv_42_b = tf.Variable(self._conv_data_42_bias)
-            _conv_42_output = tf.nn.conv2d(_conv_41_act, _conv_42_w, (1,1,1,1), padding='SAME') + _conv_42_b
-            _conv_42_act = tf.nn.relu(_conv_42_output)
-
-            _conv_43_w = tf.Variable(self._conv_data_43_weights)
-            _conv_43_b = tf.Variable(self._conv_data_43_bias)
-            _conv_43_output = tf.nn.conv2d(_conv_42_act, _conv_43_w, (1,1,1,1), padding='SAME') + _conv_43_b
-            _conv_43_act = tf.nn.relu(_conv_43_output)
-
-            self._output_feature = _conv_43_act
-            self._session = tf.Session(graph=self._graph)
-            self._session.run(tf.global_variables_initializer())
+    def extract_multiple_features(self, input_images):
+        self._last_shallow_features = self._trunk.extract_layer_features(input_images, self._shallow_layer_num)
+        if self.depth == 'shallow':
+            return self._reduce('shallow', self._last_shallow_features)
+        return self.extend_last_features()
 
-    def _load_data(self):
-        with np.load(VGG_MODEL_PATH) as npz_file:
-            self._conv_data_11_weights = npz_file['conv1_1/weights']
-            self._conv_data_11_bias = npz_file['conv1_1/biases']
-            self._conv_data_12_weights = npz_file['conv1_2/weights']
-            self._conv_data_12_bias = npz_file['conv1_2/biases']
-            self._conv_data_21_weights = npz_file['conv2_1/weights']
-            self._conv_data_21_bias = npz_file['conv2_1/biases']
-            self._conv_data_22_weights = npz_file['conv2_2/weights']
-            self._conv_data_22_bias = npz_file['conv2_2/biases']
-            self._conv_data_31_weights = npz_file['conv3_1/weights']
-            self._conv_data_31_bias = npz_file['conv3_1/biases']
-            self._conv_data_32_weights = npz_file['conv3_2/weights']
-            self._conv_data_32_bias = npz_file['conv3_2/biases']
-            self._conv_data_33_weights = npz_file['conv3_3/weights']
-            self._conv_data_33_bias = npz_file['conv3_3/biases']
-            self._conv_data_41_weights = npz_file['conv4_1/weights']
-            self._conv_data_41_bias = npz_file['conv4_1/biases']
-            self._conv_data_42_weights = npz_file['conv4_2/weights']
-            self._conv_data_42_bias = npz_file['conv4_2/biases']
-            self._conv_data_43_weights = npz_file['conv4_3/weights']
-            self._conv_data_43_bias = npz_file['conv4_3/biases']
-        print('VggL4 parameters loaded successfully!')
+    def extend_last_features(self):
+        """
+        :return: the deep features of the windows of the last extraction
+        """
+        _raw_features = self._trunk.extend_layer_features(self._last_shallow_features, self._shallow_layer_num)
+        return self._reduce('deep', _raw_features)
 
+    def get_last_shallow_features(self):
+        return self._reduce('shallow', self._last_shallow_features)
 
-class VggL5Extractor(VggExtractor):
+    def close(self):
+        self._trunk.close()
+        super(AdaptiveDepthExtractor, self).close()
 
-    def __init__(self):
-        super(VggL5Extractor, self).__init__()
 
-    def _build_network(self, input_height, input_width):
-        assert not input_height % self._resolution and not input_width % self._resolution
-        if self._session:
-            self._session.close()
-        self._graph = tf.Graph()
-        self._feature_height = input_height
-        self._feature_width = input_width
-        print('Starting building the network for h={:d} w={:d}'.format(input_height, input_width))
-        with self._graph.as_default():
-            _input_shape = (None, input_height, input_width, 3)
-            self._input_holder = tf.placeholder(tf.float32, shape=_input_shape)
-            _mean = tf.Variable(VGG_MEAN, trainable=False)
-            _sub_mean = self._input_holder - _mean
-
-            _conv_11_w = tf.Variable(self._conv_data_11_weights)
-            _conv_11_b = tf.Variable(self._conv_data_11_bias)
-            _conv_11_output = tf.nn.conv2d(_sub_mean, _conv_11_w, [1, 1, 1, 1], padding='SAME') + _conv_11_b
-            _conv_11_act = tf.nn.relu(_conv_11_output)
-
-            _conv_12_w = tf.Variable(self._conv_data_12_weights)
-            _conv_12_b = tf.Variable(self._conv_data_12_bias)
-            _conv_12_output = tf.nn.conv2d(_conv_11_act, _conv_12_w, [1, 1, 1, 1], padding='SAME') + _conv_12_b
-            _conv_12_act = tf.nn.relu(_conv_12_output)
-            _max_pool_12_output = tf.nn.max_pool(_conv_12_act, (1, 2, 2, 1), (1, 2, 2, 1), padding='SAME')
-
-            _conv_21_w = tf.Variable(self._conv_data_21_weights)
-            _conv_21_b = tf.Variable(self._conv_data_21_bias)
-            _conv_21_output = tf.nn.conv2d(_max_pool_12_output, _conv_21_w, (1, 1, 1, 1), padding='SAME') + _conv_21_b
-            _conv_21_act = tf.nn.relu(_conv_21_output)
-
-            _conv_22_w = tf.Variable(self._conv_data_22_weights)
-            _conv_22_b = tf.Variable(self._conv_data_22_bias)
-            _conv_22_output = tf.nn.conv2d(_conv_21_act, _conv_22_w, (1, 1, 1, 1), padding='SAME') + _conv_22_b
-            _conv_22_act = tf.nn.relu(_conv_22_output)
-            _max_pool_22_output = tf.nn.max_pool(_conv_22_act, (1, 2, 2, 1), (1, 2, 2, 1,), padding='SAME')
-
-            _conv_31_w = tf.Variable(self._conv_data_31_weights)
-            _conv_31_b = tf.Variable(self._conv_data_31_bias)
-            _conv_31_output = tf.nn.conv2d(_max_pool_22_output, _conv_31_w, (1, 1, 1, 1), padding='SAME') + \
-                              _conv_31_b
-            _conv_31_act = tf.nn.relu(_conv_31_output)
-
-            _conv_32_w = tf.Variable(self._conv_data_32_weights)
-            _conv_32_b = tf.Variable(self._conv_data_31_bias)
-            _conv_32_output = tf.nn.conv2d(_conv_31_act, _conv_32_w, (1, 1, 1, 1), padding='SAME') + _conv_32_b
-            _conv_32_act = tf.nn.relu(_conv_32_output)
-
-            _conv_33_w = tf.Variable(self._conv_data_33_weights)
-            _conv_33_b = tf.Variable(self._conv_data_33_bias)
-            _conv_33_output = tf.nn.conv2d(_conv_32_act, _conv_33_w, (1, 1, 1, 1), padding='SAME') + _conv_33_b
-            _conv_33_act = tf.nn.relu(_conv_33_output)
-
-            _conv_41_w = tf.Variable(self._conv_data_41_weights)
-            _conv_41_b = tf.Variable(self._conv_data_41_bias)
-            _conv_41_output = tf.nn.conv2d(_conv_33_act, _conv_41_w, (1, 1, 1, 1), padding='SAME') + \
-                              _conv_41_b
-            _conv_41_act = tf.nn.relu(_conv_41_output)
-
-            _conv_42_w = tf.Variable(self._conv_data_42_weights)
-            _conv_42_b = tf.Variable(self._conv_data_42_bias)
-            _conv_42_output = tf.nn.conv2d(_conv_41_act, _conv_42_w, (1, 1, 1, 1), padding='SAME') + _conv_42_b
-            _conv_42_act = tf.nn.relu(_conv_42_output)
-
-            _conv_43_w = tf.Variable(self._conv_data_43_weights)
-            _conv_43_b = tf.Variable(self._conv_data_43_bias)
-            _conv_43_output = tf.nn.conv2d(_conv_42_act, _conv_43_w, (1, 1, 1, 1), padding='SAME') + _conv_43_b
-            _conv_43_act = tf.nn.relu(_conv_43_output)
-
-            _conv_51_w = tf.Variable(self._conv_data_51_weights)
-            _conv_51_b = tf.Variable(self._conv_data_51_bias)
-            _conv_51_output = tf.nn.conv2d(_conv_43_act, _conv_51_w, (1,1,1,1), padding='SAME') + _conv_51_b
-            _conv_51_act = tf.nn.relu(_conv_51_output)
-
-            _conv_52_w = tf.Variable(self._conv_data_52_weights)
-            _conv_52_b = tf.Variable(self._conv_data_52_bias)
-            _conv_52_output = tf.nn.conv2d(_conv_51_act, _conv_52_w, (1,1,1,1), padding='SAME') + _conv_52_b
-            _conv_52_act = tf.nn.relu(_conv_52_output)
-
-            _conv_53_w = tf.Variable(self._conv_data_53_weights)
-            _conv_53_b = tf.Variable(self._conv_data_53_bias)
-            _conv_53_output = tf.nn.conv2d(_conv_52_act, _conv_53_w, (1,1,1,1), padding='SAME') + _conv_53_b
-            _conv_53_act = tf.nn.relu(_conv_53_output)
-
-            self._output_feature = _conv_53_act
-            self._session = tf.Session(graph=self._graph)
-            self._session.run(tf.global_variables_initializer())
+def save_activation_ranges(ranges, path=None):
+    np.savez(path or TrainDataCfg.VGG_CALIBRATION_PATH, **{k: np.float32(v) for k, v in ranges.items()})
 
-    def _load_data(self):
-        with np.load(VGG_MODEL_PATH) as npz_file:
-            self._conv_data_11_weights = npz_file['conv1_1/weights']
-            self._conv_data_11_bias = npz_file['conv1_1/biases']
-            self._conv_data_12_weights = npz_file['conv1_2/weights']
-            self._conv_data_12_bias = npz_file['conv1_2/biases']
-            self._conv_data_21_weights = npz_file['conv2_1/weights']
-            self._conv_data_21_bias = npz_file['conv2_1/biases']
-            self._conv_data_22_weights = npz_file['conv2_2/weights']
-            self._conv_data_22_bias = npz_file['conv2_2/biases']
-            self._conv_data_31_weights = npz_file['conv3_1/weights']
-            self._conv_data_31_bias = npz_file['conv3_1/biases']
-            self._conv_data_32_weights = npz_file['conv3_2/weights']
-            self._conv_data_32_bias = npz_file['conv3_2/biases']
-            self._conv_data_33_weights = npz_file['conv3_3/weights']
-            self._conv_data_33_bias = npz_file['conv3_3/biases']
-            self._conv_data_41_weights = npz_file['conv4_1/weights']
-            self._conv_data_41_bias = npz_file['conv4_1/biases']
-            self._conv_data_42_weights = npz_file['conv4_2/weights']
-            self._conv_data_42_bias = npz_file['conv4_2/biases']
-            self._conv_data_43_weights = npz_file['conv4_3/weights']
-            self._conv_data_43_bias = npz_file['conv4_3/biases']
-            self._conv_data_51_weights = npz_file['conv5_1/weights']
-            self._conv_data_51_bias = npz_file['conv5_1/biases']
-            self._conv_data_52_weights = npz_file['conv5_2/weights']
-            self._conv_data_52_bias = npz_file['conv5_2/biases']
-            self._conv_data_53_weights = npz_file['conv5_3/weights']
-            self._conv_data_53_bias = npz_file['conv5_3/biases']
-        print('VggL5 parameters loaded successfully!')
+
+def load_activation_ranges(path=None):
+    with np.load(path or TrainDataCfg.VGG_CALIBRATION_PATH) as npz_file:
+        return {k: float(npz_file[k]) for k in npz_file.files}
 
 
 def _test_load_data():
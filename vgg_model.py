@@ -0,0 +1,116 @@
+
+import numpy as np
+import cv2
+
+
+# a layer is either POOL, a 2x2 max pooling with stride 2, or (weights key, biases key) of a 3x3 conv + relu
+POOL = 'pool'
+
+
+def _conv(name, bias_name=None):
+    return '{:s}/weights'.format(name), '{:s}/biases'.format(bias_name or name)
+
+
+VGG_L1_LAYERS = [_conv('conv1_1'), POOL, _conv('conv1_2'), POOL]
+VGG_L2_LAYERS = [_conv('conv1_1'), _conv('conv1_2'), POOL, _conv('conv2_1'), _conv('conv2_2'), POOL]
+# conv3_2 has always been built with the biases of conv3_1, it is kept so that the features do not change
+VGG_L3_LAYERS = VGG_L2_LAYERS + [_conv('conv3_1'), _conv('conv3_2', 'conv3_1'), _conv('conv3_3')]
+VGG_L4_LAYERS = VGG_L3_LAYERS + [_conv('conv4_1'), _conv('conv4_2'), _conv('conv4_3')]
+VGG_L5_LAYERS = VGG_L4_LAYERS + [_conv('conv5_1'), _conv('conv5_2'), _conv('conv5_3')]
+
+
+def load_layer_weights(layers, model_path):
+    """
+    :return: list of (weights, biases) with the order of layers, None for the pooling layers
+    """
+    layer_weights = []
+    with np.load(model_path) as npz_file:
+        for layer in layers:
+            if layer == POOL:
+                layer_weights.append(None)
+            else:
+                layer_weights.append((npz_file[layer[0]], npz_file[layer[1]]))
+    return layer_weights
+
+
+def get_last_conv_index(layers):
+    return max(i for i, layer in enumerate(layers) if layer != POOL)
+
+
+def select_last_channels(layers, layer_weights, channels):
+    """
+    :return: layer_weights with only the output channels of the last conv layer in channels, unchanged for None
+    """
+    if channels is None:
+        return layer_weights
+    _last_conv = get_last_conv_index(layers)
+    layer_weights = list(layer_weights)
+    _weights, _bias = layer_weights[_last_conv]
+    layer_weights[_last_conv] = (_weights[:, :, :, channels], _bias[channels])
+    return layer_weights
+
+
+def score_channels(features, target_mask):
+    """
+    Fisher score of each channel between the cells of the target and the cells of the background.
+
+    :param features: ndarray, (h, w, c)
+    :param target_mask: ndarray of bool, (h, w)
+    :return: ndarray, (c,)
+    """
+    _target = features[target_mask]
+    _background = features[~target_mask]
+    _between = (np.mean(_target, axis=0) - np.mean(_background, axis=0)) ** 2
+    _within = np.var(_target, axis=0) + np.var(_background, axis=0)
+    return _between / (_within + 1e-6 * np.max(_within) + 1e-12)
+
+
+class FeatureReduction(object):
+    def __init__(self, image_feature, max_components):
+        assert image_feature.ndim == 3
+        feature = np.reshape(image_feature, (-1, image_feature.shape[2]))
+        _mean = np.mean(feature, axis=0, keepdims=True)
+        self.mean, self.eigen_vecs = cv2.PCACompute(feature, _mean, maxComponents=max_components)
+        print('\tPCA computed!')
+
+    def project(self, images_features, out=None):
+        """
+        :param out: optional float32 ndarray the projection is written into, of the shape of the result
+        """
+        assert images_features.ndim == 4
+        data = np.reshape(images_features, (-1, images_features.shape[3]))
+        if out is not None:
+            cv2.PCAProject(data, self.mean, self.eigen_vecs, result=np.reshape(out, (data.shape[0], -1)))
+            return out
+        coeffs = cv2.PCAProject(data, self.mean, self.eigen_vecs)
+        re_shape = list(images_features.shape)
+        re_shape[3] = len(self.eigen_vecs)
+        re_features = np.reshape(coeffs, re_shape)
+        return re_features
+
+
+PRECISIONS = ['float32', 'float16', 'int8']
+
+
+def quantize_weights(weights):
+    """
+    Symmetric int8 quantization with one scale per output channel.
+
+    :param weights: ndarray, (kh, kw, ci, co)
+    :return: (ndarray of int8 with the shape of weights, ndarray of float32, (co,))
+    """
+    _max = np.max(np.abs(weights.reshape(-1, weights.shape[-1])), axis=0)
+    scales = (np.maximum(_max, 1e-12) / 127.0).astype(np.float32)
+    quantized = np.clip(np.round(weights / scales), -127, 127).astype(np.int8)
+    return quantized, scales
+
+
+def dequantize_weights(quantized, scales):
+    return quantized.astype(np.float32) * scales
+
+
+def get_activation_range(layer_output, percentile):
+    """
+    Upper end of the int8 range of a relu output, the larger values are clipped.
+    """
+    return float(np.percentile(layer_output, percentile))
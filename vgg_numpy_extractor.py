@@ -0,0 +1,197 @@
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from feature_extractor import FeatureExtractor
+import vgg_model
+from vgg_model import FeatureReduction
+from conv_reg_config import TrainDataCfg
+
+VGG_MODEL_PATH = TrainDataCfg.VGG_MODEL_PATH
+VGG_MEAN = np.array(TrainDataCfg.VGG_MEAN, dtype=np.float32)
+
+
+def conv3x3_relu(features, weights, biases):
+    """
+    SAME 3x3 convolution followed by relu, as 9 shifted BLAS matrix products so that no im2col buffer is needed.
+
+    :param features: ndarray, (n, h, w, ci)
+    :param weights: ndarray, (3, 3, ci, co)
+    :param biases: ndarray, (co,)
+    :return: ndarray, (n, h, w, co)
+    """
+    n, h, w, ci = features.shape
+    _padded = np.pad(features, ((0, 0), (1, 1), (1, 1), (0, 0)), 'constant')
+    output = np.empty((n * h * w, weights.shape[3]), dtype=np.float32)
+    output[:] = biases
+    for dy in range(3):
+        for dx in range(3):
+            _shifted = np.ascontiguousarray(_padded[:, dy:dy+h, dx:dx+w, :]).reshape(-1, ci)
+            output += _shifted.dot(weights[dy, dx])
+    np.maximum(output, 0.0, out=output)
+    return output.reshape(n, h, w, -1)
+
+
+def max_pool2x2(features):
+    """
+    2x2 max pooling with stride 2 and SAME padding, an odd last row or column is pooled alone.
+    """
+    n, h, w, c = features.shape
+    if h % 2 or w % 2:
+        _padded = np.full((n, h + h % 2, w + w % 2, c), -np.inf, dtype=features.dtype)
+        _padded[:, :h, :w, :] = features
+        features = _padded
+    return features.reshape(n, features.shape[1] // 2, 2, features.shape[2] // 2, 2, c).max(axis=(2, 4))
+
+
+class VggNumpyExtractor(FeatureExtractor):
+    """
+    The VggExtractor api run with NumPy on the weights of the same npz, without importing TensorFlow.
+
+    Nothing is built per input size, so there is no start-up cost and no graph cache. The convolutions go
+    through the BLAS numpy is linked with, which wins on small windows and loses to the TF kernels on large ones,
+    see _benchmark_backends.
+    """
+    _name = 'VggNumpy'
+    # the layers of the network, see vgg_model
+    _layers = []
+
+    def __init__(self):
+        super(VggNumpyExtractor, self).__init__()
+        self._channel_num = 64
+        self._resolution = 4
+        self._use_pca = True
+        self.pca = None
+        self._layer_weights = None
+        # output channels of the last conv layer kept by select_channels, None for all of them
+        self.selected_channels = None
+        self._selected_layer_weights = None
+        self._load_data()
+
+    def _load_data(self):
+        self._layer_weights = vgg_model.load_layer_weights(self._layers, VGG_MODEL_PATH)
+        self._selected_layer_weights = self._layer_weights
+        print('{:s} parameters loaded successfully!'.format(self._name))
+
+    def _run_layers(self, features, start, stop):
+        for layer_weight in self._selected_layer_weights[start:stop]:
+            if layer_weight is None:
+                features = max_pool2x2(features)
+            else:
+                features = conv3x3_relu(features, *layer_weight)
+        return features
+
+    def select_channels(self, raw_features, target_mask, channel_num):
+        """
+        See VggExtractor.select_channels.
+        """
+        assert not self._use_pca or channel_num >= self._channel_num, \
+            'cannot keep {:d} channels, the pca reduces to {:d}'.format(channel_num, self._channel_num)
+        _scores = vgg_model.score_channels(raw_features, target_mask)
+        _channels = np.sort(np.argsort(_scores)[::-1][:channel_num])
+        if self.selected_channels is not None:
+            _channels = self.selected_channels[_channels]
+        self.selected_channels = _channels
+        self._selected_layer_weights = vgg_model.select_last_channels(self._layers, self._layer_weights, _channels)
+        self.pca = None
+
+    def extract_layer_features(self, input_images, layer_num):
+        """
+        Raw features after the first layer_num layers, the following layers are not run.
+        """
+        _input = np.subtract(np.asarray(input_images), VGG_MEAN, dtype=np.float32)
+        return self._run_layers(_input, 0, layer_num)
+
+    def extend_layer_features(self, layer_features, layer_num):
+        """
+        Raw features of the last layer, computed from the output of extract_layer_features.
+        """
+        return self._run_layers(layer_features, layer_num, len(self._layers))
+
+    def extract_raw_features(self, input_images):
+        return self.extract_layer_features(input_images, len(self._layers))
+
+    def reduce_features(self, raw_features):
+        if not self._use_pca:
+            return raw_features
+        return self.pca.project(raw_features).astype(np.float32)
+
+    def extract_multiple_features(self, input_images):
+        """
+        The reduced features are written into a reused output array, valid until the next call with the same shape.
+        """
+        assert len(input_images) > 0
+        raw_features = self.extract_raw_features(input_images)
+        if not self._use_pca:
+            return raw_features
+        if not self.pca:
+            self.pca = FeatureReduction(raw_features[0], self._channel_num)
+        _output = self._get_output_buffer(raw_features.shape[0], raw_features.shape[1:3] + (self._channel_num,),
+                                          np.float32)
+        return self.pca.project(raw_features, out=_output)
+
+
+class VggL1NumpyExtractor(VggNumpyExtractor):
+    _name = 'VggL1Numpy'
+    _layers = vgg_model.VGG_L1_LAYERS
+
+    def __init__(self):
+        super(VggL1NumpyExtractor, self).__init__()
+        self._use_pca = False
+
+
+class VggL2NumpyExtractor(VggNumpyExtractor):
+    _name = 'VggL2Numpy'
+    _layers = vgg_model.VGG_L2_LAYERS
+
+
+class VggL3NumpyExtractor(VggNumpyExtractor):
+    _name = 'VggL3Numpy'
+    _layers = vgg_model.VGG_L3_LAYERS
+
+
+class VggL4NumpyExtractor(VggNumpyExtractor):
+    _name = 'VggL4Numpy'
+    _layers = vgg_model.VGG_L4_LAYERS
+
+
+class VggL5NumpyExtractor(VggNumpyExtractor):
+    _name = 'VggL5Numpy'
+    _layers = vgg_model.VGG_L5_LAYERS
+
+
+def _benchmark_backends(repeat=10):
+    # cold start (import, weights, first call) and steady state of each backend, on the search window sizes of
+    # small to large targets
+    start = time.time()
+    import vgg_feature_extractor
+    tf_import_time = time.time() - start
+    print('tensorflow import: {:.2f}s'.format(tf_import_time))
+
+    rng = np.random.RandomState(0)
+    for tf_class, numpy_class in [(vgg_feature_extractor.VggL3Extractor, VggL3NumpyExtractor),
+                                  (vgg_feature_extractor.VggL4Extractor, VggL4NumpyExtractor)]:
+        for input_h, input_w, batch_size in [(40, 72, 1), (80, 144, 1), (80, 144, 3), (160, 288, 3)]:
+            images = [rng.randint(0, 256, (input_h, input_w, 3)).astype(np.uint8) for _ in range(batch_size)]
+            line = '{:12s} {:>8s} x{:d} |'.format(numpy_class._name, '{}x{}'.format(input_h, input_w), batch_size)
+            features = {}
+            for name, extractor_class in [('tf', tf_class), ('numpy', numpy_class)]:
+                # the cold start builds the network, not a pooled one
+                vgg_feature_extractor.VggExtractor.clear_network_pool()
+                start = time.time()
+                extractor = extractor_class()
+                features[name] = extractor.extract_raw_features(images)
+                cold_time = time.time() - start
+                start = time.time()
+                for _ in range(repeat):
+                    extractor.extract_raw_features(images)
+                line += ' {:s}: cold {:6.2f}s, {:8.2f}ms |'.format(name, cold_time,
+                                                                   (time.time() - start) / repeat * 1000)
+                extractor.close()
+            error = np.max(np.abs(features['numpy'] - features['tf'])) / np.max(np.abs(features['tf']))
+            print(line + ' err {:.1e}'.format(error))
+
+
+if __name__ == '__main__':
+    _benchmark_backends()